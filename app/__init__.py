@@ -1,58 +1,99 @@
+import time
+_import_start = time.perf_counter()
+
+import logging
 import os
+from contextlib import contextmanager
 from flask import Flask
-from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 from flask import Flask, redirect, url_for
 from dotenv import load_dotenv
 
 load_dotenv()
 
+from .database import build_engine, database_url
+from . import log
+
+logger = logging.getLogger(__name__)
+
+# ----------------- TEMPI DI AVVIO -----------------
+# STARTUP_REPORT=true stampa quanto costa ogni fase dell'avvio (vedi anche bench/startup_bench.py)
+STARTUP_REPORT = os.environ.get("STARTUP_REPORT", "false").lower() == "true"
+STARTUP_TIMINGS = {"import app": time.perf_counter() - _import_start}  # fase -> secondi
+
+@contextmanager
+def _fase(nome):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[nome] = time.perf_counter() - start
+
+def startup_report():
+    righe = [f"   {nome:<14} {sec * 1000:8.1f} ms" for nome, sec in STARTUP_TIMINGS.items()]
+    totale = sum(STARTUP_TIMINGS.values())
+    return "\n".join(["⏱️ Avvio app (pid %d):" % os.getpid()] + righe + [f"   {'totale':<14} {totale * 1000:8.1f} ms"])
+
 def create_app():
     app = Flask(__name__)
+    # per primo: request id disponibile anche negli hook registrati dopo
+    log.init_app(app)
     app.secret_key = os.environ.get("SECRET_KEY", "default_secret")
 
     # Config DB
-    DATABASE_URL = os.environ.get("DATABASE_URL")
-    if not DATABASE_URL:
-        raise Exception("⚠️ DATABASE_URL non impostata!")
-    
-    if "sslmode" not in DATABASE_URL:
-        if "?" in DATABASE_URL:
-            DATABASE_URL += "&sslmode=require"
-        else:
-            DATABASE_URL += "?sslmode=require"
+    DATABASE_URL = database_url()
 
     try:
-        engine = create_engine(DATABASE_URL, pool_pre_ping=True, connect_args={"sslmode": "require"})
-    except Exception as e:
-        print("❌ Errore nella connessione al database Supabase:")
-        print(e)
+        # pool dimensionato da DB_POOL_* (vedi database.py); nessuna connessione viene aperta qui
+        with _fase("engine"):
+            engine = build_engine(DATABASE_URL)
+    except Exception:
+        logger.exception("Errore nella configurazione del database")
         raise
 
     from . import models
+    models.engine = engine
     models.db = scoped_session(sessionmaker(bind=engine))
-    models.init_db_if_needed()
+    # lo schema si aggiorna con "flask db upgrade" (fase release del Procfile), non a ogni avvio;
+    # AUTO_MIGRATE=true lo applica all'avvio, comodo solo in sviluppo
+    from . import migrate
+    app.cli.add_command(migrate.db_cli)
+    from .importazione import import_cli
+    app.cli.add_command(import_cli)
+    if os.environ.get("AUTO_MIGRATE", "false").lower() == "true":
+        with _fase("migrazioni"):
+            migrate.upgrade(engine)
+    # sessioni lato server (vedi sessioni.py): nel cookie resta solo un id casuale
+    from . import sessioni
+    sessioni.init_app(app)
+    # ogni richiesta restituisce la connessione al pool alla fine
+    app.teardown_appcontext(models.shutdown_session)
+    # latenza per route, query per richiesta, Server-Timing e /metrics (vedi metrics.py)
+    from . import metrics
+    metrics.init_app(app, engine)
 
-    # Registrazione blueprints
-    from .routes.user import user_bp
-    from .routes.admin import admin_bp
-    from .routes.prenotazioni import prenotazioni_bp
+    # Registrazione blueprints (i client esterni, Supabase Auth e SMTP, nascono al primo utilizzo)
+    with _fase("import route"):
+        from .routes.user import user_bp
+        from .routes.admin import admin_bp
+        from .routes.prenotazioni import prenotazioni_bp
 
-    app.register_blueprint(user_bp, url_prefix="/user")
-    app.register_blueprint(admin_bp, url_prefix="/admin")
-    app.register_blueprint(prenotazioni_bp, url_prefix="/prenota")
+    with _fase("blueprint"):
+        app.register_blueprint(user_bp, url_prefix="/user")
+        app.register_blueprint(admin_bp, url_prefix="/admin")
+        app.register_blueprint(prenotazioni_bp, url_prefix="/prenota")
 
     # ✅ Redirect root "/" -> "/user"
     @app.route("/")
     def root():
         return redirect(url_for("user_bp.home"))
-    
+
      # Gestore errori globale
     @app.errorhandler(Exception)
     def handle_exception(e):
-        import traceback
-        print("❌ Errore globale:", e)
-        traceback.print_exc()
+        logger.exception("Errore non gestito")
         return "Internal Server Error", 500
 
+    if STARTUP_REPORT:
+        logger.info(startup_report(), extra={"startup_ms": {k: round(v * 1000, 1) for k, v in STARTUP_TIMINGS.items()}})
     return app
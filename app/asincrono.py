@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+from . import create_app, limiti, log, metrics, sessioni, stato_utenti
+from .booking import PRENOTA_SQL, GIA_PRENOTATA, PIENA, PRENOTATA, esito_prenotazione
+from .cache import LISTING_CACHE_BACKEND, invalida_elenco
+from .database import DB_ASYNC_POOL_SIZE, build_async_engine, database_url
+from .routes.prenotazioni import MESSAGGI_PRENOTA, MESSAGGIO_LOGIN, MESSAGGIO_NON_ATTIVO
+
+logger = logging.getLogger(__name__)
+
+# ----------------- CONFIGURAZIONE -----------------
+# Modalità ASGI (asgi.py, "hypercorn asgi:app"): un processo con un event loop.
+# POST /prenota/<id> gira su asyncio con l'engine asyncpg, quindi centinaia di prenotazioni
+# possono essere in volo insieme; tutte le altre route di user_bp, admin_bp e prenotazioni_bp
+# sono le stesse dell'app Flask, eseguite in un pool di ASYNC_WSGI_THREADS thread.
+# Pacchetti opzionali richiesti: quart (con hypercorn) e asyncpg, vedi requirements-async.txt.
+ASYNC_WSGI_THREADS = int(os.environ.get("ASYNC_WSGI_THREADS", "16"))
+# su asyncio aspettare il proprio turno costa poco: la coda di ammissione può essere lunga
+ASYNC_PRENOTA_MAX_CONCORRENTI = int(os.environ.get("ASYNC_PRENOTA_MAX_CONCORRENTI", str(DB_ASYNC_POOL_SIZE)))
+ASYNC_PRENOTA_CODA_MAX = int(os.environ.get("ASYNC_PRENOTA_CODA_MAX", "500"))
+# corpo massimo accettato dal ponte WSGI (hypercorn di default si ferma a 64 KB: troppo poco
+# per gli import CSV di /admin/import)
+ASYNC_MAX_BODY = int(os.environ.get("ASYNC_MAX_BODY", str(50 * 1024 * 1024)))
+
+# ----------------- AMMISSIONE -----------------
+class AmmissioneAsync:
+    """Come limiti.Ammissione, ma le richieste in coda aspettano sull'event loop e non occupano thread"""
+    def __init__(self, nome, concorrenti, coda, attesa):
+        self.nome = nome
+        self.semaforo = asyncio.Semaphore(max(concorrenti, 1))
+        self.coda = coda
+        self.attesa = attesa
+        self.in_coda = 0
+
+    async def entra(self):
+        if not self.semaforo.locked():
+            await self.semaforo.acquire()  # posto libero: nessuna attesa
+            return True
+        if self.in_coda >= self.coda:
+            return False
+        self.in_coda += 1
+        try:
+            await asyncio.wait_for(self.semaforo.acquire(), self.attesa)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.in_coda -= 1
+
+    def esci(self):
+        self.semaforo.release()
+
+# ----------------- SESSIONI -----------------
+def _interfaccia_sessioni(flask_app, engine):
+    from quart.sessions import SessionInterface
+
+    class SessioniAsync(SessionInterface):
+        """
+        Le stesse sessioni dell'app Flask (sessioni.py): stesso cookie, stessa tabella.
+        Con SESSION_BACKEND=postgres lettura e scrittura usano l'engine asyncpg
+        (e la stessa cache del processo), con redis passano da un thread.
+        """
+        def __init__(self):
+            self.sincrona = flask_app.session_interface
+
+        async def open_session(self, app, request):
+            sid = request.cookies.get(self.sincrona.get_cookie_name(flask_app))
+            if sid:
+                chiave = sessioni.hash_sid(sid)
+                if isinstance(self.sincrona, sessioni.PostgresSessioni):
+                    trovata, gen = sessioni.da_cache(chiave)
+                    if trovata is None:
+                        async with engine.connect() as conn:
+                            row = (await conn.execute(sessioni.PostgresSessioni.CARICA_SQL, {"id": chiave})).fetchone()
+                        trovata = (row.dati, row.scadenza) if row else None
+                        sessioni.memorizza(chiave, trovata, gen)
+                else:
+                    trovata = await asyncio.to_thread(self.sincrona.carica, chiave)
+                if trovata is not None:
+                    dati, scadenza = trovata
+                    return sessioni.SessioneServer(self.sincrona.serializer.loads(dati), sid, scadenza)
+            return sessioni.SessioneServer()
+
+        async def _salva(self, chiave, user_id, dati, scadenza):
+            if isinstance(self.sincrona, sessioni.PostgresSessioni):
+                sessioni.memorizza(chiave, (dati, scadenza), sessioni.generazione())
+                try:
+                    async with engine.begin() as conn:
+                        await conn.execute(sessioni.PostgresSessioni.SALVA_SQL,
+                                           {"id": chiave, "uid": user_id, "dati": dati, "scadenza": scadenza})
+                except Exception:
+                    sessioni.invalida_sessione(chiave)
+                    raise
+            else:
+                await asyncio.to_thread(self.sincrona.salva, chiave, user_id, dati, scadenza)
+
+        async def _elimina(self, chiave):
+            if isinstance(self.sincrona, sessioni.PostgresSessioni):
+                async with engine.begin() as conn:
+                    await conn.execute(sessioni.PostgresSessioni.ELIMINA_SQL, {"id": chiave})
+                sessioni.invalida_sessione(chiave)
+            else:
+                await asyncio.to_thread(self.sincrona.elimina, chiave)
+
+        async def save_session(self, app, session, response):
+            # stessa logica di sessioni._SessioniServer.save_session
+            s = self.sincrona
+            nome, dominio, path = s.get_cookie_name(flask_app), s.get_cookie_domain(flask_app), s.get_cookie_path(flask_app)
+            if not session:
+                if session.sid:
+                    await self._elimina(sessioni.hash_sid(session.sid))
+                    response.delete_cookie(nome, domain=dominio, path=path)
+                return
+            scadenza = s.da_salvare(flask_app, session)
+            if scadenza is None:
+                return
+            if session.ruota and session.sid:
+                await self._elimina(sessioni.hash_sid(session.sid))
+                session.sid = None
+            nuovo_cookie = session.sid is None
+            if nuovo_cookie:
+                session.sid = secrets.token_urlsafe(32)
+            user_id = session.get("user_id")
+            try:
+                await self._salva(sessioni.hash_sid(session.sid), str(user_id) if user_id else None,
+                                  s.serializer.dumps(dict(session)), scadenza)
+            except Exception:
+                logger.exception("Salvataggio sessione non riuscito")
+                return
+            if nuovo_cookie or session.permanent:
+                response.set_cookie(
+                    nome, session.sid,
+                    expires=s.get_expiration_time(flask_app, session),
+                    httponly=s.get_cookie_httponly(flask_app),
+                    domain=dominio,
+                    path=path,
+                    secure=s.get_cookie_secure(flask_app),
+                    samesite=s.get_cookie_samesite(flask_app),
+                )
+
+    return SessioniAsync()
+
+# ----------------- APP NATIVA (QUART) -----------------
+def _crea_nativa(flask_app):
+    from quart import Blueprint, Quart, flash, g, redirect, render_template, request, session
+
+    nativa = Quart(__name__, static_folder=None)
+    nativa.secret_key = flask_app.secret_key
+    nativa.config["SESSION_COOKIE_NAME"] = flask_app.config["SESSION_COOKIE_NAME"]
+    # i template (layout.html) costruiscono i link con gli endpoint dell'app Flask
+    urls = flask_app.url_map.bind("localhost")
+    nativa.jinja_env.globals["url_for"] = lambda endpoint, **valori: urls.build(endpoint, valori)
+    home = urls.build("user_bp.home")
+    login = urls.build("user_bp.user_login")
+
+    stato = {"engine": None}
+    ammissione = AmmissioneAsync("prenota_async", ASYNC_PRENOTA_MAX_CONCORRENTI, ASYNC_PRENOTA_CODA_MAX,
+                                 limiti.PRENOTA_ATTESA_MAX)
+
+    @nativa.before_serving
+    async def _avvio():
+        loop = asyncio.get_running_loop()
+        # thread per le route Flask (e per asyncio.to_thread)
+        loop.set_default_executor(ThreadPoolExecutor(ASYNC_WSGI_THREADS, thread_name_prefix="wsgi"))
+        stato["engine"] = build_async_engine(database_url())
+        if metrics.METRICS_ENABLED:
+            metrics.strumenta_engine(stato["engine"].sync_engine)
+        if sessioni.SESSION_BACKEND != "cookie":
+            nativa.session_interface = _interfaccia_sessioni(flask_app, stato["engine"])
+        # con SESSION_BACKEND=cookie resta il cookie firmato di Quart, compatibile con quello di Flask
+        logger.info("Modalità ASGI pronta", extra={"wsgi_threads": ASYNC_WSGI_THREADS})
+
+    @nativa.after_serving
+    async def _arresto():
+        if stato["engine"] is not None:
+            await stato["engine"].dispose()
+
+    # request id e metriche, come log.init_app e metrics.init_app per Flask
+    @nativa.before_request
+    async def _inizio():
+        log.request_id.set(request.headers.get(log.REQUEST_ID_HEADER, "")[:64] or log.nuovo_request_id())
+        g.metrics_start = time.perf_counter()
+        metrics.inizia_conteggio()
+
+    @nativa.after_request
+    async def _fine(response):
+        response.headers[log.REQUEST_ID_HEADER] = log.request_id.get()
+        if metrics.METRICS_ENABLED:
+            endpoint = request.url_rule.endpoint if request.url_rule else "nessuno"
+            response.headers.add("Server-Timing", metrics.registra_richiesta(
+                endpoint, request.method, response.status_code, request.path, g.metrics_start
+            ))
+        return response
+
+    async def _bloccante(f, *args, bloccante=True):
+        """f nel pool di thread se fa I/O, direttamente se resta in memoria (microsecondi)"""
+        return await asyncio.to_thread(f, *args) if bloccante else f(*args)
+
+    async def _rifiuta(messaggio, secondi, status):
+        secondi = max(1, int(secondi + 0.999))
+        corpo = await render_template("troppe_richieste.html", messaggio=messaggio, secondi=secondi)
+        return corpo, status, {"Retry-After": str(secondi)}
+
+    async def _stato_utente(user_id):
+        user_id = str(user_id)
+        stato_corrente, gen = stato_utenti.da_cache(user_id)
+        if stato_corrente is None:
+            async with stato["engine"].connect() as conn:
+                stato_corrente = (await conn.execute(stato_utenti.LEGGI_SQL, {"id": user_id})).scalar()
+            stato_utenti.memorizza(user_id, stato_corrente, gen)
+        return stato_corrente
+
+    # ----------------- PRENOTA CLASSE -----------------
+    # stessi controlli e stesso esito di routes/prenotazioni.prenota (decoratori compresi);
+    # blueprint con lo stesso nome, così l'endpoint nelle metriche è lo stesso
+    prenotazioni_bp = Blueprint("prenotazioni_bp", __name__, url_prefix="/prenota")
+
+    @prenotazioni_bp.post("/<int:classe_id>")
+    async def prenota(classe_id):
+        user_id = session.get("user_id")
+        if limiti.RATE_LIMIT:
+            secondi = await _bloccante(limiti.controlla, "prenota", limiti.ip_client(request), user_id,
+                                       bloccante=limiti.RATE_LIMIT_BACKEND != "memory")
+            if secondi is not None:
+                return await _rifiuta(limiti.MESSAGGIO_LIMITE, secondi, 429)
+
+        if not user_id:
+            await flash(MESSAGGIO_LOGIN)
+            return redirect(login)
+        stato_corrente = await _stato_utente(user_id)
+        if stato_corrente is None:
+            session.clear()  # utente eliminato
+            await flash(MESSAGGIO_LOGIN)
+            return redirect(login)
+        if stato_corrente != "attivo":
+            await flash(MESSAGGIO_NON_ATTIVO)
+            return redirect(login)
+
+        if not await ammissione.entra():
+            metrics.AMMISSIONE_RIFIUTATE.incrementa((ammissione.nome, "coda"))
+            return await _rifiuta(limiti.MESSAGGIO_AMMISSIONE, limiti.RETRY_AFTER_AMMISSIONE, 503)
+        try:
+            try:
+                async with stato["engine"].begin() as conn:
+                    row = (await conn.execute(PRENOTA_SQL, {"cid": classe_id, "uid": str(user_id)})).fetchone()
+                esito = esito_prenotazione(row)
+            except IntegrityError:
+                esito = GIA_PRENOTATA  # doppio invio concorrente: statement annullato per intero
+        except Exception:
+            logger.exception("Errore DB in prenota (asincrona)")
+            await flash("Si è verificato un errore. Riprova più tardi.")
+            return redirect(home)
+        finally:
+            ammissione.esci()
+
+        if esito in (PRENOTATA, PIENA):
+            await _bloccante(invalida_elenco, bloccante=LISTING_CACHE_BACKEND == "redis")
+        await flash(MESSAGGI_PRENOTA[esito])
+        return redirect(home)
+
+    nativa.register_blueprint(prenotazioni_bp)
+    return nativa
+
+# ----------------- SMISTAMENTO -----------------
+class Smistatore:
+    """
+    App ASGI: le richieste che corrispondono a una route nativa vanno a Quart,
+    tutte le altre all'app Flask attraverso il ponte WSGI di hypercorn (nel pool di thread).
+    """
+    def __init__(self, nativa, flask_app):
+        from hypercorn.middleware import AsyncioWSGIMiddleware
+        self.nativa = nativa
+        self.flask = AsyncioWSGIMiddleware(flask_app, max_body_size=ASYNC_MAX_BODY)
+        self.route_native = nativa.url_map.bind("localhost")
+
+    def _nativa(self, scope):
+        try:
+            self.route_native.match(scope["path"], method=scope["method"])
+            return True
+        except HTTPException:
+            return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan" or (scope["type"] == "http" and self._nativa(scope)):
+            await self.nativa(scope, receive, send)
+        else:
+            await self.flask(scope, receive, send)
+
+def create_asgi_app():
+    """App ASGI con le stesse route dell'app Flask (create_app), prenota su asyncio"""
+    flask_app = create_app()
+    return Smistatore(_crea_nativa(flask_app), flask_app)
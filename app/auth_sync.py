@@ -0,0 +1,248 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from . import models
+from .log import request_id
+
+logger = logging.getLogger(__name__)
+
+# ----------------- CONFIGURAZIONE -----------------
+AUTH_SYNC_BATCH_SIZE = int(os.environ.get("AUTH_SYNC_BATCH_SIZE", "20"))
+AUTH_SYNC_POLL_INTERVAL = float(os.environ.get("AUTH_SYNC_POLL_INTERVAL", "2"))
+AUTH_SYNC_MAX_ATTEMPTS = int(os.environ.get("AUTH_SYNC_MAX_ATTEMPTS", "10"))
+AUTH_SYNC_CONCURRENCY = int(os.environ.get("AUTH_SYNC_CONCURRENCY", "5"))  # chiamate Auth in parallelo
+AUTH_SYNC_RETRY_BACKOFF = int(os.environ.get("AUTH_SYNC_RETRY_BACKOFF", "15"))  # secondi, raddoppia a ogni tentativo
+AUTH_SYNC_LEASE = int(os.environ.get("AUTH_SYNC_LEASE", "300"))  # secondi di presa in carico di un blocco
+# SUPABASE_FAKE_AUTH=true -> client Auth in memoria, per sviluppo e test offline
+SUPABASE_FAKE_AUTH = os.environ.get("SUPABASE_FAKE_AUTH", "false").lower() == "true"
+BAN_DURATION = "876000h"  # ~100 anni: equivale a disattivare l'utente
+
+# ----------------- CLIENT AUTH -----------------
+class FakeAuthError(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+class FakeAuthAdmin:
+    """Stessa interfaccia di supabase.auth.admin (solo i metodi usati qui), con gli utenti in un dict"""
+
+    def __init__(self):
+        self.users = {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get_user_by_id(self, uid):
+        with self.lock:
+            self.calls.append(("get", uid))
+            if uid not in self.users:
+                raise FakeAuthError("User not found", 404)
+            return dict(self.users[uid])
+
+    def create_user(self, attributes):
+        with self.lock:
+            self.calls.append(("create", attributes.get("id")))
+            uid = attributes.get("id") or str(uuid.uuid4())
+            if uid in self.users:
+                raise FakeAuthError("User already registered", 422)
+            self.users[uid] = dict(attributes, id=uid)
+            return dict(self.users[uid])
+
+    def update_user_by_id(self, uid, attributes):
+        with self.lock:
+            self.calls.append(("update", uid))
+            if uid not in self.users:
+                raise FakeAuthError("User not found", 404)
+            self.users[uid].update(attributes)
+            return dict(self.users[uid])
+
+    def delete_user(self, uid):
+        with self.lock:
+            self.calls.append(("delete", uid))
+            if uid not in self.users:
+                raise FakeAuthError("User not found", 404)
+            del self.users[uid]
+
+_auth_admin = None
+_auth_lock = threading.Lock()
+
+def get_auth_admin():
+    """API admin di Supabase Auth (o il fake), creata al primo utilizzo"""
+    global _auth_admin
+    with _auth_lock:
+        if _auth_admin is None:
+            if SUPABASE_FAKE_AUTH:
+                _auth_admin = FakeAuthAdmin()
+            else:
+                from supabase import create_client
+                client = create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_KEY"))
+                _auth_admin = client.auth.admin
+        return _auth_admin
+
+def _status(e):
+    return getattr(e, "status", None)
+
+# ----------------- SCRITTURA (WEB) -----------------
+def accoda_sync(user_id):
+    """
+    Chiede di allineare l'utente su Supabase Auth, nella transazione corrente.
+    La chiave di idempotenza è l'utente: più richieste ravvicinate diventano un solo job,
+    che applica lo stato locale presente al momento dell'esecuzione.
+    """
+    models.db.execute(
+        text("""
+            INSERT INTO auth_sync (idempotency_key, user_id, request_id)
+            VALUES (:key, :uid, :rid)
+            ON CONFLICT (idempotency_key) DO UPDATE
+            SET completata_at = NULL, tentativi = 0, errore = NULL, prossimo_tentativo = now(),
+                request_id = EXCLUDED.request_id
+        """),
+        {"key": f"utente:{user_id}", "uid": str(user_id), "rid": request_id.get()}
+    )
+
+def accoda_sync_batch(user_ids):
+    """Come accoda_sync, per più utenti con un solo statement"""
+    if not user_ids:
+        return
+    models.db.execute(
+        text("""
+            INSERT INTO auth_sync (idempotency_key, user_id, request_id)
+            SELECT 'utente:' || uid, uid, :rid FROM unnest(CAST(:uids AS text[])) AS uid
+            ON CONFLICT (idempotency_key) DO UPDATE
+            SET completata_at = NULL, tentativi = 0, errore = NULL, prossimo_tentativo = now(),
+                request_id = EXCLUDED.request_id
+        """),
+        {"uids": [str(u) for u in user_ids], "rid": request_id.get()}
+    )
+
+# ----------------- RICONCILIAZIONE (WORKER) -----------------
+def riconcilia_utente(admin, user_id, utente):
+    """Porta l'utente Auth nello stato dell'utente locale (None = eliminato). Idempotente."""
+    if utente is None:
+        try:
+            admin.delete_user(user_id)
+        except Exception as e:
+            if _status(e) != 404:
+                raise
+        return
+
+    attivo = utente.stato == "attivo"
+    attributes = {
+        "email_confirm": attivo,
+        "ban_duration": BAN_DURATION if utente.stato == "sospeso" else "none",
+    }
+    try:
+        admin.get_user_by_id(user_id)
+    except Exception as e:
+        if _status(e) != 404:
+            raise
+        admin.create_user({"id": user_id, "email": utente.email, "email_confirm": attivo})
+    admin.update_user_by_id(user_id, attributes)
+
+# Presa in carico: i job scelti (FOR UPDATE SKIP LOCKED: più worker non si pestano i piedi)
+# ricevono un lease di AUTH_SYNC_LEASE secondi e un tentativo in più, poi si fa subito commit.
+# Le chiamate ad Auth avvengono senza transazione aperta, così un accoda_sync sullo stesso
+# utente (approvazione, sospensione, registrazione) non resta bloccato sul lock di riga.
+# Se il worker muore a metà, allo scadere del lease il job torna disponibile.
+CLAIM_SQL = text("""
+    WITH scelti AS (
+        SELECT idempotency_key, user_id
+        FROM auth_sync
+        WHERE completata_at IS NULL
+          AND tentativi < :max_attempts
+          AND prossimo_tentativo <= now()
+        ORDER BY prossimo_tentativo
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE auth_sync s
+    SET tentativi = s.tentativi + 1,
+        prossimo_tentativo = now() + make_interval(secs => :lease)
+    FROM scelti
+    LEFT JOIN utenti u ON u.id = CAST(scelti.user_id AS uuid)
+    WHERE s.idempotency_key = scelti.idempotency_key
+    RETURNING s.idempotency_key, s.user_id, s.tentativi, s.request_id, s.prossimo_tentativo AS lease,
+              u.email, u.stato, u.id IS NOT NULL AS esiste
+""")
+
+# L'esito si registra solo se il job non è stato riaccodato durante le chiamate
+# (accoda_sync rimette prossimo_tentativo = now()): in quel caso va rieseguito con lo stato nuovo.
+COMPLETA_SQL = text("""
+    UPDATE auth_sync SET completata_at = now(), errore = NULL
+    WHERE idempotency_key = :key AND prossimo_tentativo = :lease
+""")
+RITENTA_SQL = text("""
+    UPDATE auth_sync
+    SET errore = :errore,
+        prossimo_tentativo = now() + make_interval(secs => :ritardo)
+    WHERE idempotency_key = :key AND prossimo_tentativo = :lease
+""")
+
+def sincronizza_batch(limit=AUTH_SYNC_BATCH_SIZE):
+    """
+    Prende in carico un blocco di job pendenti (transazione breve), chiama Auth senza
+    transazioni aperte e registra l'esito in una seconda transazione breve.
+    Restituisce il numero di job presi.
+    """
+    admin = get_auth_admin()
+    rows = models.db.execute(CLAIM_SQL, {
+        "max_attempts": AUTH_SYNC_MAX_ATTEMPTS, "limit": limit, "lease": AUTH_SYNC_LEASE,
+    }).fetchall()
+    models.db.commit()
+    if not rows:
+        return 0
+
+    def esegui(row):
+        # il thread del pool riporta nei log il request id di chi ha accodato il job
+        token = request_id.set(row.request_id)
+        try:
+            riconcilia_utente(admin, row.user_id, row if row.esiste else None)
+            return None
+        except Exception as e:
+            logger.warning("Allineamento Auth fallito, da ritentare", extra={"user_id": row.user_id, "tentativi": row.tentativi})
+            return e
+        finally:
+            request_id.reset(token)
+
+    # chiamate HTTP verso Auth in parallelo, al massimo AUTH_SYNC_CONCURRENCY alla volta
+    with ThreadPoolExecutor(max_workers=max(1, min(AUTH_SYNC_CONCURRENCY, len(rows)))) as executor:
+        errori = list(executor.map(esegui, rows))
+
+    fatti, falliti = [], []
+    for row, e in zip(rows, errori):
+        if e is None:
+            fatti.append({"key": row.idempotency_key, "lease": row.lease})
+        else:
+            falliti.append({
+                "key": row.idempotency_key,
+                "lease": row.lease,
+                "errore": str(e)[:500],
+                "ritardo": AUTH_SYNC_RETRY_BACKOFF * (2 ** (row.tentativi - 1)),
+            })
+
+    if fatti:
+        models.db.execute(COMPLETA_SQL, fatti)
+    if falliti:
+        models.db.execute(RITENTA_SQL, falliti)
+    models.db.commit()
+    logger.info("Auth sync: %d allineati, %d da ritentare", len(fatti), len(falliti),
+                extra={"allineati": len(fatti), "da_ritentare": len(falliti)})
+    return len(rows)
+
+def run_worker(should_stop=lambda: False):
+    """Ciclo di riconciliazione con Supabase Auth"""
+    try:
+        while not should_stop():
+            try:
+                presi = sincronizza_batch()
+            except Exception:
+                models.db.rollback()
+                logger.exception("Errore worker auth sync")
+                presi = 0
+            if presi < AUTH_SYNC_BATCH_SIZE:
+                time.sleep(AUTH_SYNC_POLL_INTERVAL)
+    finally:
+        models.db.remove()
@@ -0,0 +1,286 @@
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from . import models
+from .outbox import accoda_email_batch
+
+# Esiti possibili di una prenotazione
+PRENOTATA = "prenotata"
+PIENA = "piena"
+GIA_PRENOTATA = "gia_prenotata"
+INESISTENTE = "inesistente"
+# Esiti di un annullamento
+ANNULLATA = "annullata"
+NON_PRENOTATA = "non_prenotata"
+FUORI_TEMPO = "fuori_tempo"
+# Esiti dell'iscrizione alla lista d'attesa
+IN_ATTESA = "in_attesa"
+GIA_IN_ATTESA = "gia_in_attesa"
+POSTI_LIBERI = "posti_liberi"
+
+# Ore prima dell'inizio della lezione oltre le quali non si può più annullare
+CANCELLAZIONE_CUTOFF_ORE = float(os.environ.get("CANCELLAZIONE_CUTOFF_ORE", "2"))
+
+# Un solo statement: l'UPDATE del contatore fa da controllo di capienza e blocca la riga
+# della classe, l'INSERT avviene solo se l'UPDATE è andato a buon fine. Le prenotazioni
+# concorrenti sulla stessa classe si serializzano sul lock di riga e ricontrollano
+# posti_prenotati < max_posti sulla versione aggiornata della riga.
+PRENOTA_SQL = text("""
+    WITH posto AS (
+        UPDATE classi SET posti_prenotati = posti_prenotati + 1
+        WHERE id = :cid
+          AND posti_prenotati < max_posti
+          AND NOT EXISTS (
+              SELECT 1 FROM prenotazioni WHERE user_id = :uid AND classe_id = :cid
+          )
+        RETURNING id
+    ), nuova AS (
+        INSERT INTO prenotazioni (user_id, classe_id)
+        SELECT :uid, id FROM posto
+        RETURNING id
+    )
+    SELECT
+        (SELECT id FROM nuova) AS prenotazione_id,
+        c.id IS NOT NULL AS esiste,
+        EXISTS (
+            SELECT 1 FROM prenotazioni WHERE user_id = :uid AND classe_id = :cid
+        ) AS gia_prenotata
+    FROM (VALUES (1)) AS v(x)
+    LEFT JOIN classi c ON c.id = :cid
+""")
+
+# ----------------- PRENOTAZIONE ATOMICA -----------------
+def prenota_classe(classe_id, user_id):
+    """
+    Prenota un posto con un solo round-trip e restituisce l'esito
+    (PRENOTATA, PIENA, GIA_PRENOTATA, INESISTENTE).
+    Il commit spetta al chiamante (unit_of_work).
+    """
+    try:
+        row = models.db.execute(PRENOTA_SQL, {"cid": classe_id, "uid": user_id}).fetchone()
+    except IntegrityError:
+        # doppio invio concorrente dello stesso utente: l'indice univoco
+        # annulla l'intero statement, contatore compreso
+        models.db.rollback()
+        return GIA_PRENOTATA
+    return esito_prenotazione(row)
+
+def esito_prenotazione(row):
+    """Esito dalla riga di PRENOTA_SQL (condiviso con la modalità asincrona, vedi asincrono.py)"""
+    if row.prenotazione_id is not None:
+        return PRENOTATA
+    if not row.esiste:
+        return INESISTENTE
+    if row.gia_prenotata:
+        return GIA_PRENOTATA
+    return PIENA
+
+# ----------------- ANNULLAMENTO -----------------
+# Un solo statement, come PRENOTA_SQL: lock sulla riga della classe, DELETE della
+# prenotazione (solo entro il limite) e decremento del contatore. Il lock serializza
+# annullamenti e prenotazioni concorrenti sulla stessa classe.
+ANNULLA_SQL = text("""
+    WITH classe AS (
+        SELECT id, (data + ora) > :limite AS in_tempo
+        FROM classi WHERE id = :cid
+        FOR UPDATE
+    ), tolta AS (
+        DELETE FROM prenotazioni p
+        USING classe c
+        WHERE p.classe_id = c.id AND p.user_id = :uid AND c.in_tempo
+        RETURNING p.id
+    ), posto AS (
+        UPDATE classi SET posti_prenotati = posti_prenotati - 1
+        WHERE id = :cid AND EXISTS (SELECT 1 FROM tolta)
+        RETURNING id
+    )
+    SELECT
+        (SELECT id FROM tolta) AS annullata_id,
+        c.id IS NOT NULL AS esiste,
+        COALESCE(c.in_tempo, false) AS in_tempo,
+        EXISTS (
+            SELECT 1 FROM prenotazioni WHERE user_id = :uid AND classe_id = :cid
+        ) AS prenotata
+    FROM (VALUES (1)) AS v(x)
+    LEFT JOIN classe c ON true
+""")
+
+def annulla_prenotazione(classe_id, user_id, now=None):
+    """
+    Annulla la prenotazione dell'utente e libera il posto, che passa subito al primo
+    in lista d'attesa. Restituisce l'esito (ANNULLATA, NON_PRENOTATA, FUORI_TEMPO, INESISTENTE).
+    Il commit spetta al chiamante (unit_of_work).
+    """
+    # orari delle classi in ora locale, come in listing._filtro_classi
+    limite = (now or datetime.now()) + timedelta(hours=CANCELLAZIONE_CUTOFF_ORE)
+    row = models.db.execute(ANNULLA_SQL, {"cid": classe_id, "uid": user_id, "limite": limite}).fetchone()
+
+    if row.annullata_id is not None:
+        promuovi_lista_attesa(classe_id)
+        return ANNULLATA
+    if not row.esiste:
+        return INESISTENTE
+    if not row.prenotata:
+        return NON_PRENOTATA
+    return FUORI_TEMPO
+
+def prenotazioni_utente(user_id, now=None):
+    """Prenotazioni e iscrizioni in lista d'attesa dell'utente per le lezioni future"""
+    now = now or datetime.now()
+    params = {
+        "uid": user_id,
+        "oggi": now.date(),
+        "adesso": now.time().replace(microsecond=0),
+        "limite": now + timedelta(hours=CANCELLAZIONE_CUTOFF_ORE),
+    }
+    prenotate = models.db.execute(
+        text("""
+            SELECT c.id, c.data, c.ora, (c.data + c.ora) > :limite AS annullabile
+            FROM prenotazioni p
+            JOIN classi c ON c.id = p.classe_id
+            WHERE p.user_id = :uid AND (c.data, c.ora) >= (:oggi, :adesso)
+            ORDER BY c.data, c.ora
+        """),
+        params
+    ).fetchall()
+    in_attesa = models.db.execute(
+        text("""
+            SELECT c.id, c.data, c.ora,
+                   (SELECT COUNT(*) + 1 FROM lista_attesa x WHERE x.classe_id = la.classe_id AND x.id < la.id) AS posizione
+            FROM lista_attesa la
+            JOIN classi c ON c.id = la.classe_id
+            WHERE la.user_id = :uid AND (c.data, c.ora) >= (:oggi, :adesso)
+            ORDER BY c.data, c.ora
+        """),
+        params
+    ).fetchall()
+    return prenotate, in_attesa
+
+# ----------------- CONTATORE POSTI -----------------
+RILASCIA_POSTI_SQL = text("""
+    UPDATE classi c SET posti_prenotati = c.posti_prenotati - x.n
+    FROM (
+        SELECT classe_id, COUNT(*) AS n
+        FROM prenotazioni
+        WHERE user_id = ANY(CAST(:uids AS uuid[]))
+        GROUP BY classe_id
+    ) x
+    WHERE c.id = x.classe_id
+    RETURNING c.id
+""")
+
+def rilascia_posti_utenti(user_ids):
+    """
+    Decrementa il contatore delle classi prenotate dagli utenti (prima di cancellarne le prenotazioni).
+    Restituisce gli id delle classi con posti liberati, da passare a promuovi_lista_attesa.
+    """
+    return models.db.execute(RILASCIA_POSTI_SQL, {"uids": [str(u) for u in user_ids]}).scalars().all()
+
+# ----------------- LISTA D'ATTESA -----------------
+# Il lock sulla riga della classe (FOR UPDATE) serializza iscrizioni e promozioni:
+# chi si iscrive mentre si libera un posto o entra in coda prima della promozione,
+# o vede il posto libero e può prenotare direttamente.
+ISCRIVI_ATTESA_SQL = text("""
+    WITH classe AS (
+        SELECT id, posti_prenotati < max_posti AS posti_liberi
+        FROM classi WHERE id = :cid
+        FOR UPDATE
+    ), prenotato AS (
+        SELECT EXISTS (
+            SELECT 1 FROM prenotazioni WHERE user_id = :uid AND classe_id = :cid
+        ) AS si
+    ), nuova AS (
+        INSERT INTO lista_attesa (user_id, classe_id)
+        SELECT :uid, c.id FROM classe c, prenotato p
+        WHERE NOT c.posti_liberi AND NOT p.si
+        ON CONFLICT (user_id, classe_id) DO NOTHING
+        RETURNING id
+    ), mia AS (
+        SELECT id FROM nuova
+        UNION ALL
+        SELECT id FROM lista_attesa WHERE user_id = :uid AND classe_id = :cid
+    )
+    SELECT
+        (SELECT id FROM nuova) AS attesa_id,
+        c.id IS NOT NULL AS esiste,
+        COALESCE(c.posti_liberi, false) AS posti_liberi,
+        p.si AS gia_prenotata,
+        (SELECT COUNT(*) + 1 FROM lista_attesa la
+         WHERE la.classe_id = :cid AND la.id < (SELECT min(id) FROM mia)) AS posizione
+    FROM prenotato p
+    LEFT JOIN classe c ON true
+""")
+
+def iscrivi_lista_attesa(classe_id, user_id):
+    """
+    Mette l'utente in coda per una classe piena.
+    Restituisce (esito, posizione in coda o None); il commit spetta al chiamante.
+    """
+    row = models.db.execute(ISCRIVI_ATTESA_SQL, {"cid": classe_id, "uid": user_id}).fetchone()
+    if not row.esiste:
+        return INESISTENTE, None
+    if row.gia_prenotata:
+        return GIA_PRENOTATA, None
+    if row.attesa_id is not None:
+        return IN_ATTESA, row.posizione
+    if row.posti_liberi:
+        return POSTI_LIBERI, None
+    return GIA_IN_ATTESA, row.posizione
+
+def esci_lista_attesa(classe_id, user_id):
+    """Toglie l'utente dalla coda; True se c'era"""
+    return models.db.execute(
+        text("DELETE FROM lista_attesa WHERE user_id = :uid AND classe_id = :cid RETURNING id"),
+        {"cid": classe_id, "uid": user_id}
+    ).fetchone() is not None
+
+# Primi N della coda (N = posti liberi, solo utenti attivi) spostati in prenotazioni
+# con un solo statement, contatore compreso. Eseguito dopo il lock sulla classe.
+PROMUOVI_SQL = text("""
+    WITH scelti AS (
+        SELECT la.id
+        FROM lista_attesa la
+        JOIN utenti u ON u.id = la.user_id AND u.stato = 'attivo'
+        WHERE la.classe_id = :cid
+        ORDER BY la.id
+        LIMIT (SELECT GREATEST(max_posti - posti_prenotati, 0) FROM classi WHERE id = :cid)
+    ), promossi AS (
+        DELETE FROM lista_attesa la
+        USING scelti s
+        WHERE la.id = s.id
+        RETURNING la.user_id, la.classe_id
+    ), nuove AS (
+        INSERT INTO prenotazioni (user_id, classe_id)
+        SELECT user_id, classe_id FROM promossi
+        ON CONFLICT (user_id, classe_id) DO NOTHING
+        RETURNING user_id
+    ), posti AS (
+        UPDATE classi SET posti_prenotati = posti_prenotati + (SELECT COUNT(*) FROM nuove)
+        WHERE id = :cid AND EXISTS (SELECT 1 FROM nuove)
+        RETURNING data, ora
+    )
+    SELECT u.id, u.nome, u.cognome, u.email, p.data, p.ora
+    FROM nuove n
+    JOIN utenti u ON u.id = n.user_id
+    CROSS JOIN posti p
+""")
+
+def mail_promozione(row):
+    """(destinatario, oggetto, corpo) della notifica di promozione dalla lista d'attesa"""
+    return (
+        row.email,
+        "Posto confermato dalla lista d'attesa",
+        f"Ciao {row.nome} {row.cognome},\n\nSi è liberato un posto: sei stato iscritto alla lezione del {row.data} alle {row.ora:%H:%M}.\nSe non puoi partecipare, annulla la prenotazione per lasciare il posto al prossimo in coda.\n\nGrazie!"
+    )
+
+def promuovi_lista_attesa(classe_id):
+    """
+    Assegna i posti liberi della classe ai primi in lista d'attesa (FIFO) e accoda le email
+    nella stessa transazione. Da chiamare dopo ogni modifica che libera posti;
+    il commit spetta al chiamante. Restituisce il numero di utenti promossi.
+    """
+    models.db.execute(text("SELECT id FROM classi WHERE id = :cid FOR UPDATE"), {"cid": classe_id})
+    promossi = models.db.execute(PROMUOVI_SQL, {"cid": classe_id}).fetchall()
+    accoda_email_batch([mail_promozione(r) for r in promossi if r.email])
+    return len(promossi)
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, time as dtime, timezone
+from sqlalchemy.exc import SQLAlchemyError
+from . import models
+from .listing import lista_classi
+
+logger = logging.getLogger(__name__)
+
+# ----------------- CONFIGURAZIONE -----------------
+# Cache dell'elenco classi della home (la pagina più visitata).
+# LISTING_CACHE_TTL=0 disattiva la cache; i posti mostrati non sono mai più vecchi del TTL.
+LISTING_CACHE_TTL = float(os.environ.get("LISTING_CACHE_TTL", "5"))  # secondi
+# LISTING_CACHE_BACKEND=memory -> dict nel processo (ogni worker gunicorn ha la sua copia)
+# LISTING_CACHE_BACKEND=redis  -> Redis locale condiviso tra i worker (pacchetto "redis" richiesto)
+LISTING_CACHE_BACKEND = os.environ.get("LISTING_CACHE_BACKEND", "memory").lower()
+LISTING_CACHE_MAX_ENTRIES = int(os.environ.get("LISTING_CACHE_MAX_ENTRIES", "256"))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# ----------------- STATISTICHE -----------------
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "invalidations": 0, "errors": 0}
+
+def _conta(chiave):
+    with _stats_lock:
+        _stats[chiave] += 1
+
+def cache_stats():
+    """Hit/miss dell'elenco classi, per /admin/cache"""
+    with _stats_lock:
+        stats = dict(_stats)
+    richieste = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = stats["hits"] / richieste if richieste else 0.0
+    stats.update({"backend": LISTING_CACHE_BACKEND, "ttl": LISTING_CACHE_TTL})
+    try:
+        stats["entries"] = _backend().size()
+    except Exception:
+        stats["entries"] = None
+    return stats
+
+# ----------------- BACKEND -----------------
+# L'invalidazione incrementa una "generazione": una voce caricata prima dell'invalidazione
+# non viene salvata (memoria) o finisce sotto una chiave che nessuno legge più (Redis).
+class MemoryBackend:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.voci = {}  # chiave -> (scadenza monotonic, voce)
+        self.gen = 0
+
+    def generazione(self):
+        return self.gen
+
+    def get(self, chiave):
+        with self.lock:
+            trovata = self.voci.get(chiave)
+            if trovata is None:
+                return None
+            if trovata[0] <= time.monotonic():
+                del self.voci[chiave]
+                return None
+            return trovata[1]
+
+    def set(self, chiave, voce, gen):
+        with self.lock:
+            if gen != self.gen:
+                return
+            self.voci.pop(chiave, None)
+            self.voci[chiave] = (time.monotonic() + LISTING_CACHE_TTL, voce)
+            while len(self.voci) > LISTING_CACHE_MAX_ENTRIES:
+                self.voci.pop(next(iter(self.voci)))  # la più vecchia (ordine di inserimento)
+
+    def invalida(self):
+        with self.lock:
+            self.gen += 1
+            self.voci.clear()
+
+    def size(self):
+        return len(self.voci)
+
+def _json_default(v):
+    if isinstance(v, (date, dtime)):
+        return v.isoformat()
+    raise TypeError(type(v))
+
+def _decodifica_riga(r):
+    return dict(r, data=date.fromisoformat(r["data"]), ora=dtime.fromisoformat(r["ora"]))
+
+class RedisBackend:
+    PREFIX = "fundbooking:elenco:"
+
+    def __init__(self, url):
+        import redis  # dipendenza opzionale (requirements-extra.txt), solo con LISTING_CACHE_BACKEND=redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.gen_key = self.PREFIX + "gen"
+
+    def generazione(self):
+        return int(self.client.get(self.gen_key) or 0)
+
+    def get(self, chiave):
+        raw = self.client.get(f"{self.PREFIX}{self.generazione()}:{chiave}")
+        if raw is None:
+            return None
+        voce = json.loads(raw)
+        voce["righe"] = [_decodifica_riga(r) for r in voce["righe"]]
+        return voce
+
+    def set(self, chiave, voce, gen):
+        self.client.set(f"{self.PREFIX}{gen}:{chiave}", json.dumps(voce, default=_json_default),
+                        px=int(LISTING_CACHE_TTL * 1000))
+
+    def invalida(self):
+        self.client.incr(self.gen_key)
+
+    def size(self):
+        return None  # non calcolato: richiederebbe uno SCAN
+
+_backend_istanza = None
+_backend_lock = threading.Lock()
+
+def _backend():
+    """Backend creato al primo utilizzo (niente connessioni Redis all'import)"""
+    global _backend_istanza
+    with _backend_lock:
+        if _backend_istanza is None:
+            if LISTING_CACHE_BACKEND == "redis":
+                _backend_istanza = RedisBackend(REDIS_URL)
+            else:
+                _backend_istanza = MemoryBackend()
+        return _backend_istanza
+
+# ----------------- API -----------------
+# un solo caricamento per chiave alla volta nel processo: alla scadenza del TTL
+# le richieste concorrenti aspettano il primo caricamento invece di andare tutte al DB
+_caricamenti = [threading.Lock() for _ in range(32)]
+
+@models.read_only
+def _carica(da, a, cursor):
+    righe, next_cursor = lista_classi(da=da, a=a, cursor=cursor)
+    righe = [dict(r._mapping) for r in righe]
+    contenuto = json.dumps([righe, next_cursor], default=_json_default, sort_keys=True)
+    return {
+        "righe": righe,
+        "next_cursor": next_cursor,
+        "etag": hashlib.sha1(contenuto.encode("utf-8")).hexdigest(),
+        "caricata_at": int(time.time()),
+    }
+
+def elenco_classi(da=None, a=None, cursor=None):
+    """
+    Elenco classi della home attraverso la cache (read-through).
+    Restituisce un dict con righe, next_cursor, etag (del contenuto) e caricata_at (epoch).
+    """
+    if LISTING_CACHE_TTL <= 0:
+        return _carica(da, a, cursor)
+
+    chiave = f"{da or ''}|{a or ''}|{cursor or ''}"
+    try:
+        backend = _backend()
+        voce = backend.get(chiave)
+        if voce is None:
+            with _caricamenti[hash(chiave) % len(_caricamenti)]:
+                voce = backend.get(chiave)  # caricata nel frattempo da un'altra richiesta?
+                if voce is None:
+                    gen = backend.generazione()
+                    voce = _carica(da, a, cursor)
+                    backend.set(chiave, voce, gen)
+                    _conta("misses")
+                    return voce
+    except SQLAlchemyError:
+        raise  # errori del database: li gestisce la route
+    except Exception as e:
+        # cache non raggiungibile (es. Redis giù): si legge direttamente dal database
+        _conta("errors")
+        logger.warning("Cache elenco non disponibile: %s", e)
+        return _carica(da, a, cursor)
+    _conta("hits")
+    return voce
+
+def invalida_elenco():
+    """Da chiamare dopo il commit di ogni modifica a classi o posti prenotati"""
+    _conta("invalidations")
+    try:
+        _backend().invalida()
+    except Exception as e:
+        # senza invalidazione la voce scade comunque entro LISTING_CACHE_TTL
+        _conta("errors")
+        logger.warning("Invalidazione cache elenco non riuscita: %s", e)
+
+def ultima_modifica(voce):
+    """caricata_at come datetime UTC, per l'header Last-Modified"""
+    return datetime.fromtimestamp(voce["caricata_at"], tz=timezone.utc)
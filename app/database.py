@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import NullPool, QueuePool
+
+# ----------------- CONFIGURAZIONE POOL -----------------
+# DB_POOL_MODE=queue     -> pool locale per worker (default), dimensionato con le variabili sotto
+# DB_POOL_MODE=pgbouncer -> nessun pool locale (NullPool): il pooling lo fa PgBouncer/Supavisor
+#                           in transaction mode, davanti a Supabase
+DB_POOL_MODE = os.environ.get("DB_POOL_MODE", "queue").lower()
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "2"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+# DB_POOL_PING=idle   -> ping solo se la connessione è rimasta ferma più di DB_PING_IDLE_SECONDS
+# DB_POOL_PING=always -> pool_pre_ping di SQLAlchemy (un round-trip a ogni checkout)
+# DB_POOL_PING=off    -> nessun ping, ci si affida solo a pool_recycle
+DB_POOL_PING = os.environ.get("DB_POOL_PING", "idle").lower()
+DB_PING_IDLE_SECONDS = float(os.environ.get("DB_PING_IDLE_SECONDS", "60"))
+DB_SSLMODE = os.environ.get("DB_SSLMODE", "require")
+# pool dell'engine asyncpg della modalità ASGI (asincrono.py): un solo processo serve
+# centinaia di richieste insieme, quindi più connessioni di un worker sync
+DB_ASYNC_POOL_SIZE = int(os.environ.get("DB_ASYNC_POOL_SIZE", "20"))
+DB_ASYNC_MAX_OVERFLOW = int(os.environ.get("DB_ASYNC_MAX_OVERFLOW", "5"))
+
+# ----------------- METRICHE CHECKOUT -----------------
+_stats_lock = threading.Lock()
+_stats = {"checkouts": 0, "wait_total": 0.0, "wait_max": 0.0, "timeouts": 0, "pings": 0, "ping_failures": 0}
+
+def _record_wait(elapsed, timeout=False):
+    with _stats_lock:
+        if timeout:
+            _stats["timeouts"] += 1
+            return
+        _stats["checkouts"] += 1
+        _stats["wait_total"] += elapsed
+        if elapsed > _stats["wait_max"]:
+            _stats["wait_max"] = elapsed
+
+class _TimedCheckoutMixin:
+    """Misura il tempo di attesa per ottenere una connessione dal pool"""
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except Exception:
+            _record_wait(0, timeout=True)
+            raise
+        _record_wait(time.perf_counter() - start)
+        return conn
+
+class TimedQueuePool(_TimedCheckoutMixin, QueuePool):
+    pass
+
+class TimedNullPool(_TimedCheckoutMixin, NullPool):
+    pass
+
+def pool_stats(engine):
+    """Statistiche del pool: attese di checkout (secondi) e stato corrente"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["wait_avg"] = stats["wait_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+    stats["mode"] = DB_POOL_MODE
+    pool = engine.pool
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "checked_in": pool.checkedin(),
+        })
+    return stats
+
+# ----------------- PING SU CONNESSIONI INATTIVE -----------------
+def _install_idle_ping(engine):
+    """Ping solo per le connessioni rimaste inattive a lungo, invece che a ogni checkout"""
+    @event.listens_for(engine, "checkin")
+    def _on_checkin(dbapi_connection, connection_record):
+        connection_record.info["last_used"] = time.monotonic()
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        last_used = connection_record.info.get("last_used")
+        if last_used is None or time.monotonic() - last_used < DB_PING_IDLE_SECONDS:
+            return
+        with _stats_lock:
+            _stats["pings"] += 1
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        except Exception:
+            with _stats_lock:
+                _stats["ping_failures"] += 1
+            # il pool scarta la connessione e ne apre una nuova
+            raise DisconnectionError()
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+# ----------------- CREAZIONE ENGINE -----------------
+def database_url():
+    """DATABASE_URL dall'ambiente, con sslmode aggiunto se manca"""
+    url = os.environ.get("DATABASE_URL")
+    if not url:
+        raise Exception("⚠️ DATABASE_URL non impostata!")
+
+    if "sslmode" not in url:
+        if "?" in url:
+            url += f"&sslmode={DB_SSLMODE}"
+        else:
+            url += f"?sslmode={DB_SSLMODE}"
+    return url
+
+def build_engine(database_url):
+    """Engine SQLAlchemy configurato dalle variabili d'ambiente DB_*"""
+    connect_args = {"sslmode": DB_SSLMODE}
+
+    if DB_POOL_MODE == "pgbouncer":
+        # Transaction pooling: ogni transazione può finire su una connessione server diversa.
+        # psycopg2 non usa prepared statement lato server, quindi non serve disattivarli;
+        # niente pool locale né ping, la connessione vive solo per la durata del checkout.
+        return create_engine(database_url, poolclass=TimedNullPool, connect_args=connect_args)
+
+    engine = create_engine(
+        database_url,
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PING == "always",
+        pool_use_lifo=True,  # le connessioni in eccesso restano inattive e vengono riciclate
+        connect_args=connect_args,
+    )
+    if DB_POOL_PING == "idle":
+        _install_idle_ping(engine)
+    return engine
+
+def build_async_engine(database_url):
+    """
+    Engine asincrono (asyncpg) per la modalità ASGI, dalle stesse variabili DB_*.
+    Richiede i pacchetti opzionali asyncpg e greenlet.
+    """
+    from sqlalchemy.engine import make_url
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = make_url(database_url).set(drivername="postgresql+asyncpg")
+    # asyncpg non conosce sslmode: lo stesso valore passa come parametro ssl
+    connect_args = {"ssl": url.query.get("sslmode", DB_SSLMODE)}
+    url = url.difference_update_query(["sslmode"])
+
+    if DB_POOL_MODE == "pgbouncer":
+        # asyncpg prepara ogni statement sul server: in transaction mode la connessione
+        # cambia tra una transazione e l'altra, quindi niente cache di prepared statement
+        url = url.update_query_dict({"prepared_statement_cache_size": "0"})
+        connect_args["statement_cache_size"] = 0
+        return create_async_engine(url, poolclass=NullPool, connect_args=connect_args)
+
+    return create_async_engine(
+        url,
+        pool_size=DB_ASYNC_POOL_SIZE,
+        max_overflow=DB_ASYNC_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PING != "off",
+        pool_use_lifo=True,
+        connect_args=connect_args,
+    )
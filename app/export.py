@@ -0,0 +1,126 @@
+import csv
+import io
+import os
+import tempfile
+import uuid
+from datetime import datetime
+from sqlalchemy import text
+from . import models
+
+# Righe lette dal cursore lato server a ogni giro (e scritte in un blocco di CSV)
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+XLSX_CHUNK = 64 * 1024
+
+# ----------------- QUERY DI EXPORT -----------------
+# nome -> (intestazioni, SQL). I filtri (:classe, :da, :a) sono opzionali: NULL = nessun filtro.
+EXPORTS = {
+    "utenti": (
+        ["id", "cognome", "nome", "data_nascita", "luogo_nascita", "indirizzo", "citta", "comune", "cap",
+         "email", "telefono", "username", "stato"],
+        """
+            SELECT id, cognome, nome, data_nascita, luogo_nascita, indirizzo, citta, comune, cap,
+                   email, telefono, username, stato
+            FROM utenti
+            ORDER BY stato DESC, cognome ASC, nome ASC
+        """,
+    ),
+    "roster": (
+        ["classe_id", "data", "ora", "cognome", "nome", "username", "email", "telefono", "prenotata_il"],
+        """
+            SELECT c.id, c.data, c.ora, u.cognome, u.nome, u.username, u.email, u.telefono, p.created_at
+            FROM classi c
+            JOIN prenotazioni p ON p.classe_id = c.id
+            JOIN utenti u ON u.id = p.user_id
+            WHERE (CAST(:classe AS integer) IS NULL OR c.id = :classe)
+              AND (CAST(:da AS date) IS NULL OR c.data >= :da)
+              AND (CAST(:a AS date) IS NULL OR c.data <= :a)
+            ORDER BY c.data, c.ora, c.id, u.cognome, u.nome
+        """,
+    ),
+    "prenotazioni": (
+        ["prenotazione_id", "prenotata_il", "classe_id", "data", "ora", "username", "email"],
+        """
+            SELECT p.id, p.created_at, c.id, c.data, c.ora, u.username, u.email
+            FROM prenotazioni p
+            JOIN classi c ON c.id = p.classe_id
+            JOIN utenti u ON u.id = p.user_id
+            WHERE (CAST(:da AS date) IS NULL OR c.data >= :da)
+              AND (CAST(:a AS date) IS NULL OR c.data <= :a)
+            ORDER BY p.id
+        """,
+    ),
+}
+
+# ----------------- LETTURA IN STREAMING -----------------
+def stream_righe(nome, params):
+    """
+    Generatore di blocchi di righe da un cursore lato server (stream_results + yield_per):
+    in memoria resta al massimo un blocco di EXPORT_BATCH_SIZE righe.
+    Usa una connessione propria, perché il generatore viene consumato dopo la fine della view.
+    """
+    sql = EXPORTS[nome][1]
+    conn = models.engine.connect().execution_options(
+        stream_results=True, yield_per=EXPORT_BATCH_SIZE, postgresql_readonly=True
+    )
+    try:
+        result = conn.execute(text(sql), params)
+        for blocco in result.partitions(EXPORT_BATCH_SIZE):
+            yield blocco
+    finally:
+        conn.close()  # rollback della transazione di sola lettura e connessione restituita al pool
+
+def _valore(v):
+    return "" if v is None else v
+
+def _cella(v):
+    """Valore accettato da openpyxl: UUID come testo, datetime senza fuso (Excel non li supporta)"""
+    if isinstance(v, uuid.UUID):
+        return str(v)
+    if isinstance(v, datetime) and v.tzinfo is not None:
+        return v.replace(tzinfo=None)
+    return v
+
+def genera_csv(nome, params):
+    """CSV a blocchi (con BOM UTF-8, così Excel riconosce gli accenti)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(EXPORTS[nome][0])
+    for blocco in stream_righe(nome, params):
+        writer.writerows([_valore(v) for v in riga] for riga in blocco)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+def xlsx_disponibile():
+    try:
+        import openpyxl  # noqa: F401  dipendenza opzionale (requirements-extra.txt)
+        return True
+    except ImportError:
+        return False
+
+def genera_xlsx(nome, params):
+    """
+    XLSX con openpyxl in modalità write_only: le righe finiscono su file temporaneo man mano
+    che arrivano dal cursore. Il formato zip si può inviare solo a file chiuso, quindi il
+    download parte a fine lettura, ma la memoria resta comunque costante.
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(nome)
+    ws.append(EXPORTS[nome][0])
+    for blocco in stream_righe(nome, params):
+        for riga in blocco:
+            ws.append([_cella(v) for v in riga])
+
+    with tempfile.TemporaryFile() as f:
+        wb.save(f)
+        f.seek(0)
+        while True:
+            chunk = f.read(XLSX_CHUNK)
+            if not chunk:
+                break
+            yield chunk
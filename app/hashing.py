@@ -0,0 +1,98 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# ----------------- CONFIGURAZIONE -----------------
+# Metodo e costo nel formato di werkzeug, es. "scrypt:32768:8:1" oppure "pbkdf2:sha256:600000"
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+PASSWORD_SALT_LENGTH = int(os.environ.get("PASSWORD_SALT_LENGTH", "16"))
+# HASH_WORKERS=0 -> hashing sul thread della richiesta (nessun pool di processi).
+# Ogni worker web ha il suo pool: di default i core divisi per i worker (WEB_CONCURRENCY),
+# così worker x processi di hashing non superano i core. Con i worker sync di gunicorn
+# (un thread per processo) il pool non porta concorrenza e viene spento, vedi configura_pool.
+HASH_WORKERS_ENV = os.environ.get("HASH_WORKERS")
+HASH_WORKERS = int(HASH_WORKERS_ENV) if HASH_WORKERS_ENV else max(
+    1, (os.cpu_count() or 1) // max(int(os.environ.get("WEB_CONCURRENCY", "1")), 1))
+HASH_TIMEOUT = float(os.environ.get("HASH_TIMEOUT", "10"))
+
+logger = logging.getLogger(__name__)
+
+# ----------------- POOL DI PROCESSI -----------------
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    """Pool creato al primo utilizzo, quindi dopo il fork dei worker gunicorn"""
+    global _executor
+    # i worker di hypercorn (modalità ASGI) sono processi daemon e non possono avere figli
+    if HASH_WORKERS <= 0 or multiprocessing.current_process().daemon:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+        return _executor
+
+def configura_pool(workers, threads):
+    """
+    Chiamata da gunicorn.conf.py dopo il fork, se HASH_WORKERS non è impostata:
+    pool dimensionato sui core per worker e solo se il processo serve più richieste insieme.
+    """
+    global HASH_WORKERS
+    if HASH_WORKERS_ENV:
+        return
+    if threads <= 1:
+        HASH_WORKERS = 0  # worker sync: aspetterebbe comunque il risultato, tanto vale calcolare qui
+    else:
+        HASH_WORKERS = max(1, min(threads, (os.cpu_count() or 1) // max(workers, 1)))
+
+def _run(fn, *args):
+    global _executor
+    executor = _get_executor()
+    if executor is None:
+        return fn(*args)
+    future = executor.submit(fn, *args)
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except FutureTimeoutError:
+        # pool saturo: se il calcolo non è ancora partito lo si toglie dalla coda e si fa qui,
+        # altrimenti si aspetta il processo che lo sta già eseguendo
+        if future.cancel():
+            logger.warning("Pool di hashing saturo da oltre %ss, calcolo in linea", HASH_TIMEOUT)
+            return fn(*args)
+        return future.result()
+    except BrokenProcessPool:
+        # un processo del pool è morto: si ricrea al prossimo uso, intanto calcolo in linea
+        with _executor_lock:
+            _executor = None
+        return fn(*args)
+
+def shutdown():
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(shutdown)
+
+# ----------------- API -----------------
+def hash_password(password):
+    """Hash di una password con metodo e costo configurati"""
+    return _run(generate_password_hash, password, PASSWORD_HASH_METHOD, PASSWORD_SALT_LENGTH)
+
+def verify_password(hash_pw, password):
+    """Verifica che la password corrisponda all'hash"""
+    return _run(check_password_hash, hash_pw, password)
+
+@lru_cache(maxsize=1)
+def _current_prefix():
+    # werkzeug normalizza il metodo (es. "pbkdf2" -> "pbkdf2:sha256:1000000"): lo si ricava da un hash vero
+    return generate_password_hash("", PASSWORD_HASH_METHOD, 1).split("$", 1)[0]
+
+def needs_rehash(hash_pw):
+    """True se l'hash salvato usa un metodo o un costo diversi da quelli configurati"""
+    return hash_pw.split("$", 1)[0] != _current_prefix()
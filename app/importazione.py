@@ -0,0 +1,248 @@
+import csv
+import io
+import os
+import re
+from datetime import date, time
+import click
+import psycopg2
+from flask.cli import AppGroup
+from sqlalchemy import text
+from . import models
+from .auth_sync import accoda_sync_batch
+from .outbox import accoda_email_batch
+
+# ----------------- CONFIGURAZIONE -----------------
+IMPORT_MAX_RIGHE = int(os.environ.get("IMPORT_MAX_RIGHE", "50000"))
+IMPORT_MAX_ERRORI = 500  # errori riportati nel dettaglio (il totale viene comunque contato)
+# Password non utilizzabile (check_password_hash la rifiuta sempre): l'utente importato
+# imposta la sua con "Password dimenticata"
+PASSWORD_DA_IMPOSTARE = "!"
+
+_EMAIL = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+_SI = {"1", "si", "sì", "s", "true", "yes", "x"}
+
+# ----------------- VALIDAZIONE RIGHE -----------------
+def _obbligatorio(valore, campo):
+    valore = (valore or "").strip()
+    if not valore:
+        raise ValueError(f"{campo} mancante")
+    return valore
+
+def _valida_classe(r):
+    data = _obbligatorio(r.get("data"), "data")
+    ora = _obbligatorio(r.get("ora"), "ora")
+    try:
+        data = date.fromisoformat(data)
+    except ValueError:
+        raise ValueError("data non valida (AAAA-MM-GG)")
+    try:
+        ora = time.fromisoformat(ora)
+    except ValueError:
+        raise ValueError("ora non valida (HH:MM)")
+    max_posti = _obbligatorio(r.get("max_posti"), "max_posti")
+    if not max_posti.isdigit() or int(max_posti) < 1:
+        raise ValueError("max_posti deve essere un intero positivo")
+    return (data.isoformat(), ora.isoformat(), max_posti)
+
+def _valida_utente(r):
+    valori = [_obbligatorio(r.get(c), c) for c in
+              ("nome", "cognome", "data_nascita", "luogo_nascita", "indirizzo", "citta", "comune", "cap")]
+    try:
+        valori[2] = date.fromisoformat(valori[2]).isoformat()
+    except ValueError:
+        raise ValueError("data_nascita non valida (AAAA-MM-GG)")
+    email = _obbligatorio(r.get("email"), "email").lower()
+    if not _EMAIL.match(email):
+        raise ValueError("email non valida")
+    telefono = (r.get("telefono") or "").strip()
+    username = _obbligatorio(r.get("username"), "username")
+    if (r.get("consenso_privacy") or "").strip().lower() not in _SI:
+        raise ValueError("consenso_privacy mancante")
+    return tuple(valori) + (email, telefono, username)
+
+# tipo -> (colonne della tabella di staging, validatore, DDL della tabella di staging)
+TIPI = {
+    "classi": (
+        ["data", "ora", "max_posti"],
+        _valida_classe,
+        "riga INTEGER, data DATE, ora TIME, max_posti INTEGER",
+    ),
+    "utenti": (
+        ["nome", "cognome", "data_nascita", "luogo_nascita", "indirizzo", "citta", "comune", "cap",
+         "email", "telefono", "username"],
+        _valida_utente,
+        "riga INTEGER, nome TEXT, cognome TEXT, data_nascita DATE, luogo_nascita TEXT, indirizzo TEXT, "
+        "citta TEXT, comune TEXT, cap TEXT, email TEXT, telefono TEXT, username TEXT",
+    ),
+}
+
+# ----------------- COPY IN STREAMING -----------------
+class _CopyStream:
+    """
+    File-like per copy_expert: valida le righe del CSV man mano che COPY le legge e
+    passa a Postgres solo quelle valide. Il file non viene mai caricato tutto in memoria.
+    """
+    def __init__(self, reader, valida, esito):
+        self.reader = reader
+        self.valida = valida
+        self.esito = esito
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.finito = False
+        self.errore = None  # ValueError sollevato durante la lettura (psycopg2 lo avvolge)
+
+    def _prossima(self):
+        for riga in self.reader:
+            n = self.reader.line_num
+            self.esito["lette"] += 1
+            if self.esito["lette"] > IMPORT_MAX_RIGHE:
+                self.errore = ValueError(f"Troppe righe: massimo {IMPORT_MAX_RIGHE}")
+                raise self.errore
+            try:
+                valori = self.valida(riga)
+            except ValueError as e:
+                aggiungi_errore(self.esito, n, str(e))
+                continue
+            self.writer.writerow((n,) + valori)
+            return True
+        return False
+
+    def read(self, size=-1):
+        while not self.finito and (size < 0 or self.buffer.tell() < size):
+            if not self._prossima():
+                self.finito = True
+        dati = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return dati
+
+def aggiungi_errore(esito, riga, messaggio):
+    esito["errori_totali"] += 1
+    if len(esito["errori"]) < IMPORT_MAX_ERRORI:
+        esito["errori"].append({"riga": riga, "errore": messaggio})
+
+# ----------------- MERGE -----------------
+# Righe in conflitto con i dati esistenti o duplicate nel file: (riga, motivo)
+CONFLITTI_SQL = {
+    "classi": """
+        SELECT riga, CASE
+                   WHEN EXISTS (SELECT 1 FROM classi c WHERE c.data = s.data AND c.ora = s.ora)
+                       THEN 'lezione già presente in quella data e ora'
+                   ELSE 'lezione duplicata nel file (riga ' || prima || ')'
+               END
+        FROM (SELECT *, min(riga) OVER (PARTITION BY data, ora) AS prima FROM import_classi) s
+        WHERE riga > prima
+           OR EXISTS (SELECT 1 FROM classi c WHERE c.data = s.data AND c.ora = s.ora)
+    """,
+    "utenti": """
+        SELECT riga, CASE
+                   WHEN EXISTS (SELECT 1 FROM utenti u WHERE u.email = s.email) THEN 'email già registrata'
+                   WHEN EXISTS (SELECT 1 FROM utenti u WHERE u.username = s.username) THEN 'username già in uso'
+                   WHEN riga > prima_email THEN 'email duplicata nel file (riga ' || prima_email || ')'
+                   ELSE 'username duplicato nel file (riga ' || prima_username || ')'
+               END
+        FROM (
+            SELECT *, min(riga) OVER (PARTITION BY email) AS prima_email,
+                      min(riga) OVER (PARTITION BY username) AS prima_username
+            FROM import_utenti
+        ) s
+        WHERE riga > prima_email OR riga > prima_username
+           OR EXISTS (SELECT 1 FROM utenti u WHERE u.email = s.email)
+           OR EXISTS (SELECT 1 FROM utenti u WHERE u.username = s.username)
+    """,
+}
+
+MERGE_SQL = {
+    "classi": """
+        INSERT INTO classi (data, ora, max_posti)
+        SELECT data, ora, max_posti FROM import_classi ORDER BY riga
+        RETURNING id
+    """,
+    "utenti": """
+        INSERT INTO utenti (nome, cognome, data_nascita, luogo_nascita, indirizzo, citta, comune, cap,
+                            email, telefono, username, password_hash, consenso_privacy, stato)
+        SELECT nome, cognome, data_nascita, luogo_nascita, indirizzo, citta, comune, cap,
+               email, NULLIF(telefono, ''), username, :password, true, 'attivo'
+        FROM import_utenti ORDER BY riga
+        RETURNING id, nome, cognome, email, username
+    """,
+}
+
+def mail_benvenuto(u, link_recupero):
+    """(destinatario, oggetto, corpo) per un utente importato, che deve ancora impostare la password"""
+    dove = f":\n{link_recupero}" if link_recupero else " nella pagina di login."
+    return (
+        u.email,
+        "Il tuo account è pronto",
+        f"Ciao {u.nome} {u.cognome},\n\nÈ stato creato il tuo account (username: {u.username}).\nPer scegliere la password usa \"Password dimenticata\"{dove}\n\nGrazie!"
+    )
+
+def importa_csv(tipo, file_testo, tutto_o_niente=False, link_recupero=None):
+    """
+    Valida il CSV in un solo passaggio, lo carica con COPY in una tabella di staging temporanea
+    e inserisce in classi/utenti le righe senza errori né conflitti.
+    Con tutto_o_niente=True basta un errore per non importare nulla.
+    Gli utenti importati sono già attivi: job di allineamento Auth ed email di benvenuto
+    partono dalla stessa transazione. Il commit spetta al chiamante (unit_of_work).
+    Restituisce un dict con lette, importate, errori (dettaglio) ed errori_totali.
+    ValueError se mancano colonne o le righe superano IMPORT_MAX_RIGHE.
+    """
+    colonne, valida, ddl = TIPI[tipo]
+    staging = f"import_{tipo}"
+    esito = {"tipo": tipo, "lette": 0, "importate": 0, "errori": [], "errori_totali": 0}
+
+    reader = csv.DictReader(file_testo)
+    richieste = colonne + (["consenso_privacy"] if tipo == "utenti" else [])
+    mancanti = [c for c in richieste if c not in (reader.fieldnames or [])]
+    if mancanti:
+        raise ValueError(f"Colonne mancanti nel CSV: {', '.join(mancanti)}")
+
+    models.db.execute(text(f"CREATE TEMP TABLE {staging} ({ddl}) ON COMMIT DROP"))
+    stream = _CopyStream(reader, valida, esito)
+    cursor = models.db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {staging} (riga, {', '.join(colonne)}) FROM STDIN WITH (FORMAT csv)", stream)
+    except psycopg2.Error:
+        if stream.errore:
+            raise stream.errore
+        raise
+    finally:
+        cursor.close()
+
+    conflitti = models.db.execute(text(CONFLITTI_SQL[tipo])).fetchall()
+    for riga, motivo in conflitti:
+        aggiungi_errore(esito, riga, motivo)
+    esito["errori"].sort(key=lambda e: e["riga"])
+    if tutto_o_niente and esito["errori_totali"]:
+        return esito
+
+    if conflitti:
+        models.db.execute(text(f"DELETE FROM {staging} WHERE riga = ANY(:righe)"), {"righe": [r[0] for r in conflitti]})
+    inserite = models.db.execute(text(MERGE_SQL[tipo]), {"password": PASSWORD_DA_IMPOSTARE}).fetchall()
+    esito["importate"] = len(inserite)
+
+    if tipo == "utenti":
+        accoda_sync_batch([str(u.id) for u in inserite])
+        accoda_email_batch([mail_benvenuto(u, link_recupero) for u in inserite])
+    return esito
+
+# ----------------- CLI (flask importa ...) -----------------
+import_cli = AppGroup("importa", help="Import massivo da CSV")
+
+@import_cli.command("csv")
+@click.argument("tipo", type=click.Choice(list(TIPI)))
+@click.argument("file", type=click.File("r", encoding="utf-8-sig"))
+@click.option("--tutto-o-niente", is_flag=True, help="non importare nulla se c'è anche un solo errore")
+@click.option("--link-recupero", envvar="LINK_RECUPERO_PASSWORD", help="URL della pagina 'Password dimenticata' per l'email di benvenuto")
+def import_command(tipo, file, tutto_o_niente, link_recupero):
+    """Importa classi o utenti pre-approvati da un file CSV"""
+    try:
+        with models.unit_of_work():
+            esito = importa_csv(tipo, file, tutto_o_niente, link_recupero)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for e in esito["errori"]:
+        click.echo(f"❌ riga {e['riga']}: {e['errore']}")
+    if esito["errori_totali"] > len(esito["errori"]):
+        click.echo(f"... e altri {esito['errori_totali'] - len(esito['errori'])} errori")
+    click.echo(f"✅ Import {tipo}: {esito['importate']} righe importate su {esito['lette']} lette, {esito['errori_totali']} errori")
@@ -0,0 +1,353 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from functools import wraps
+from flask import make_response, render_template, request, session
+from sqlalchemy import text
+from . import metrics, models
+from .database import DB_POOL_SIZE
+
+logger = logging.getLogger(__name__)
+
+# ----------------- CONFIGURAZIONE -----------------
+# RATE_LIMIT=false disattiva i limiti (i decoratori restituiscono la route così com'è)
+RATE_LIMIT = os.environ.get("RATE_LIMIT", "true").lower() == "true"
+# RATE_LIMIT_BACKEND=memory   -> bucket nel processo: pochi microsecondi, ma ogni worker
+#                                gunicorn ha i suoi (il limite effettivo è moltiplicato per i worker)
+# RATE_LIMIT_BACKEND=postgres -> tabella rate_limit (migrazione 0006), condivisa: una query per controllo
+# RATE_LIMIT_BACKEND=redis    -> Redis condiviso (pacchetto "redis" richiesto), con REDIS_URL
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_MAX_CHIAVI = int(os.environ.get("RATE_LIMIT_MAX_CHIAVI", "100000"))  # bucket in memoria
+# dietro un proxy (Render, Heroku, nginx) remote_addr è il proxy: l'IP del client è
+# l'N-esimo elemento da destra di X-Forwarded-For, con N = proxy fidati davanti all'app
+RATE_LIMIT_PROXY_HOPS = int(os.environ.get("RATE_LIMIT_PROXY_HOPS", "0"))
+RATE_LIMIT_PULIZIA_SECONDI = 600  # ogni quanto un processo cancella un blocco di bucket inattivi
+RATE_LIMIT_PULIZIA_BLOCCO = 1000
+
+# Regole "richieste/secondi": tanti tentativi di fila, poi uno ogni secondi/richieste.
+# Sovrascrivibili con RATE_LIMIT_<NOME>, es. RATE_LIMIT_LOGIN_UTENTE=5/300
+_DEFAULT = {
+    "login_ip": "30/60",
+    "login_utente": "10/300",
+    "recupero_ip": "10/600",       # recover_username e recover_password (mail in uscita)
+    "recupero_utente": "3/3600",
+    "reset_ip": "10/600",          # reset_password: ogni POST con token valido costa un hash scrypt
+    "prenota_ip": "120/60",        # largo: in palestra molti iscritti escono dallo stesso IP
+    "prenota_utente": "30/60",
+}
+
+# Controllo di ammissione su prenota: al massimo PRENOTA_MAX_CONCORRENTI prenotazioni insieme
+# per processo (default: le connessioni del pool), PRENOTA_CODA_MAX in attesa per al massimo
+# PRENOTA_ATTESA_MAX secondi; le altre ricevono subito 503 "riprova tra poco".
+# PRENOTA_MAX_CONCORRENTI=0 disattiva il controllo.
+PRENOTA_MAX_CONCORRENTI = int(os.environ.get("PRENOTA_MAX_CONCORRENTI", str(DB_POOL_SIZE)))
+PRENOTA_CODA_MAX = int(os.environ.get("PRENOTA_CODA_MAX", str(2 * PRENOTA_MAX_CONCORRENTI)))
+PRENOTA_ATTESA_MAX = float(os.environ.get("PRENOTA_ATTESA_MAX", "2"))
+# con i worker sync di gunicorn la coda è davanti al processo: se il router indica quando
+# ha ricevuto la richiesta (X-Request-Start, Heroku/Render/nginx) quelle che hanno già
+# aspettato più di PRENOTA_CODA_ROUTER_MS vengono scartate subito (0 = controllo spento)
+PRENOTA_CODA_ROUTER_MS = float(os.environ.get("PRENOTA_CODA_ROUTER_MS", "0"))
+RETRY_AFTER_AMMISSIONE = 2  # secondi suggeriti al client con il 503
+
+class Regola:
+    def __init__(self, nome, valore):
+        richieste, secondi = valore.split("/")
+        self.nome = nome
+        self.capacita = int(richieste)
+        self.periodo = float(secondi)
+        self.ricarica = self.capacita / self.periodo  # gettoni al secondo
+
+REGOLE = {nome: Regola(nome, os.environ.get(f"RATE_LIMIT_{nome.upper()}", valore))
+          for nome, valore in _DEFAULT.items()}
+
+# ----------------- BACKEND -----------------
+# consuma() -> (consentita, secondi prima del prossimo gettone)
+class MemoryBackend:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bucket = {}  # chiave -> [gettoni, ultimo aggiornamento monotonic]
+
+    def consuma(self, chiave, regola):
+        adesso = time.monotonic()
+        with self.lock:
+            b = self.bucket.get(chiave)
+            if b is None:
+                if len(self.bucket) >= RATE_LIMIT_MAX_CHIAVI:
+                    self.bucket.pop(next(iter(self.bucket)))  # il più vecchio (ordine di inserimento)
+                self.bucket[chiave] = [regola.capacita - 1, adesso]
+                return True, 0
+            gettoni = min(regola.capacita, b[0] + (adesso - b[1]) * regola.ricarica)
+            b[1] = adesso
+            if gettoni >= 1:
+                b[0] = gettoni - 1
+                return True, 0
+            b[0] = gettoni
+            return False, (1 - gettoni) / regola.ricarica
+
+class PostgresBackend:
+    """Un upsert per controllo: ricarica, consumo ed esito calcolati dal database in modo atomico"""
+    CONSUMA_SQL = text("""
+        INSERT INTO rate_limit AS r (chiave, gettoni, aggiornato, consentita)
+        VALUES (:chiave, :capacita - 1, now(), true)
+        ON CONFLICT (chiave) DO UPDATE SET
+            gettoni = CASE
+                WHEN LEAST(:capacita, r.gettoni + EXTRACT(EPOCH FROM now() - r.aggiornato) * :ricarica) >= 1
+                THEN LEAST(:capacita, r.gettoni + EXTRACT(EPOCH FROM now() - r.aggiornato) * :ricarica) - 1
+                ELSE LEAST(:capacita, r.gettoni + EXTRACT(EPOCH FROM now() - r.aggiornato) * :ricarica)
+            END,
+            consentita = LEAST(:capacita, r.gettoni + EXTRACT(EPOCH FROM now() - r.aggiornato) * :ricarica) >= 1,
+            aggiornato = now()
+        RETURNING consentita, gettoni
+    """)
+
+    def __init__(self):
+        self.ultima_pulizia = time.monotonic()
+        self.lock = threading.Lock()
+        # un bucket fermo da più del periodo più lungo è di nuovo pieno: si può cancellare
+        self.inattivo = max(r.periodo for r in REGOLE.values())
+
+    def consuma(self, chiave, regola):
+        # connessione propria: il controllo precede la route e non ne apre la transazione
+        with models.engine.begin() as conn:
+            row = conn.execute(self.CONSUMA_SQL, {
+                "chiave": chiave, "capacita": regola.capacita, "ricarica": regola.ricarica
+            }).fetchone()
+        self._pulisci()
+        if row.consentita:
+            return True, 0
+        return False, (1 - row.gettoni) / regola.ricarica
+
+    def _pulisci(self):
+        with self.lock:
+            if time.monotonic() - self.ultima_pulizia < RATE_LIMIT_PULIZIA_SECONDI:
+                return
+            self.ultima_pulizia = time.monotonic()
+        with models.engine.begin() as conn:
+            conn.execute(
+                text("""
+                    DELETE FROM rate_limit WHERE chiave IN (
+                        SELECT chiave FROM rate_limit
+                        WHERE aggiornato < now() - make_interval(secs => :secondi) LIMIT :n
+                    )
+                """),
+                {"secondi": self.inattivo, "n": RATE_LIMIT_PULIZIA_BLOCCO}
+            )
+
+class RedisBackend:
+    PREFIX = "fundbooking:rate:"
+    # stesso algoritmo di MemoryBackend, eseguito atomicamente da Redis con il suo orologio
+    # (i numeri tornano come stringhe: Lua convertirebbe i decimali in interi)
+    SCRIPT = """
+        local t = redis.call('TIME')
+        local adesso = tonumber(t[1]) + tonumber(t[2]) / 1000000
+        local capacita = tonumber(ARGV[1])
+        local ricarica = tonumber(ARGV[2])
+        local b = redis.call('HMGET', KEYS[1], 'g', 't')
+        local gettoni = capacita
+        if b[1] then
+            gettoni = math.min(capacita, tonumber(b[1]) + (adesso - tonumber(b[2])) * ricarica)
+        end
+        local consentita = 0
+        if gettoni >= 1 then
+            gettoni = gettoni - 1
+            consentita = 1
+        end
+        redis.call('HSET', KEYS[1], 'g', tostring(gettoni), 't', tostring(adesso))
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacita / ricarica) + 1)
+        return {consentita, tostring(gettoni)}
+    """
+
+    def __init__(self, url):
+        import redis  # dipendenza opzionale (requirements-extra.txt), solo con RATE_LIMIT_BACKEND=redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def consuma(self, chiave, regola):
+        consentita, gettoni = self.script(keys=[self.PREFIX + chiave], args=[regola.capacita, regola.ricarica])
+        if consentita:
+            return True, 0
+        return False, (1 - float(gettoni)) / regola.ricarica
+
+_backend_istanza = None
+_backend_lock = threading.Lock()
+_locale = MemoryBackend()  # anche ripiego quando il backend condiviso non risponde
+_ultimo_avviso = 0.0
+
+def _backend():
+    """Backend creato al primo utilizzo (niente connessioni Redis all'import)"""
+    global _backend_istanza
+    if _backend_istanza is None:
+        with _backend_lock:
+            if _backend_istanza is None:
+                if RATE_LIMIT_BACKEND == "postgres":
+                    _backend_istanza = PostgresBackend()
+                elif RATE_LIMIT_BACKEND == "redis":
+                    from .cache import REDIS_URL
+                    _backend_istanza = RedisBackend(REDIS_URL)
+                else:
+                    _backend_istanza = _locale
+    return _backend_istanza
+
+def _consuma(chiave, regola):
+    global _ultimo_avviso
+    try:
+        return _backend().consuma(chiave, regola)
+    except Exception as e:
+        # backend condiviso giù: si continua con i bucket del processo (un avviso al minuto)
+        if time.monotonic() - _ultimo_avviso > 60:
+            _ultimo_avviso = time.monotonic()
+            logger.warning("Rate limit %s non disponibile, uso i limiti locali: %s", RATE_LIMIT_BACKEND, e)
+        return _locale.consuma(chiave, regola)
+
+# ----------------- CHIAVI -----------------
+def ip_client(richiesta=None):
+    """IP del client della richiesta Flask corrente (o di quella passata, es. Quart)"""
+    richiesta = richiesta or request
+    if RATE_LIMIT_PROXY_HOPS > 0:
+        inoltri = [ip.strip() for ip in richiesta.headers.get("X-Forwarded-For", "").split(",") if ip.strip()]
+        if len(inoltri) >= RATE_LIMIT_PROXY_HOPS:
+            return inoltri[-RATE_LIMIT_PROXY_HOPS]
+    return richiesta.remote_addr or "-"
+
+def _chiave(regola, valore):
+    # username ed email non finiscono in chiaro in tabella/Redis
+    return regola.nome + ":" + hashlib.blake2b(valore.encode("utf-8"), digest_size=12).hexdigest()
+
+# ----------------- RISPOSTE -----------------
+MESSAGGIO_LIMITE = "Troppi tentativi in poco tempo."
+MESSAGGIO_AMMISSIONE = "Il servizio è molto richiesto in questo momento."
+
+def _rifiuta(messaggio, secondi, status):
+    secondi = max(1, math.ceil(secondi))
+    response = make_response(render_template("troppe_richieste.html", messaggio=messaggio, secondi=secondi), status)
+    response.headers["Retry-After"] = str(secondi)
+    return response
+
+def controlla(nome, ip, valore=None):
+    """
+    Consuma un gettone dal bucket dell'IP (regola <nome>_ip) e, se c'è un valore, da quello
+    dell'utente/email (<nome>_utente). None se la richiesta può procedere, altrimenti i
+    secondi da attendere.
+    """
+    controlli = [(REGOLE[f"{nome}_ip"], ip)]
+    regola_utente = REGOLE.get(f"{nome}_utente")
+    if valore and regola_utente:
+        controlli.append((regola_utente, str(valore).strip().lower()))
+    for regola, v in controlli:
+        consentita, secondi = _consuma(_chiave(regola, v), regola)
+        if not consentita:
+            metrics.LIMITATE.incrementa((regola.nome,))
+            logger.warning("Rate limit superato", extra={"regola": regola.nome, "ip": ip})
+            return secondi
+    return None
+
+# ----------------- DECORATORI -----------------
+def limita(nome, identita=None, metodi=("POST",)):
+    """
+    Token bucket per IP (regola <nome>_ip) e, se identita() restituisce un valore,
+    per utente/email (regola <nome>_utente). Oltre il limite: 429 con Retry-After.
+    """
+    def decoratore(f):
+        if not RATE_LIMIT:
+            return f
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.method in metodi:
+                secondi = controlla(nome, ip_client(), identita() if identita else None)
+                if secondi is not None:
+                    return _rifiuta(MESSAGGIO_LIMITE, secondi, 429)
+            return f(*args, **kwargs)
+        return wrapper
+    return decoratore
+
+class Ammissione:
+    """
+    Al massimo `concorrenti` esecuzioni insieme nel processo; fino a `coda` richieste
+    aspettano il proprio turno per al massimo `attesa` secondi, le altre vengono rifiutate subito.
+    Con `coda_router_ms` > 0 sono scartate anche quelle rimaste più a lungo nella coda del router.
+    concorrenti <= 0 disattiva il controllo.
+    """
+    def __init__(self, nome, concorrenti, coda, attesa, coda_router_ms=0):
+        self.nome = nome
+        self.capacita = concorrenti
+        self.coda_router_ms = coda_router_ms
+        self.semaforo = threading.BoundedSemaphore(max(concorrenti, 1))
+        self.coda = coda
+        self.attesa = attesa
+        self.lock = threading.Lock()
+        self.in_corso = 0
+        self.in_coda = 0
+
+    def entra(self):
+        if not self.semaforo.acquire(blocking=False):
+            with self.lock:
+                if self.in_coda >= self.coda:
+                    return False
+                self.in_coda += 1
+            try:
+                if not self.semaforo.acquire(timeout=self.attesa):
+                    return False
+            finally:
+                with self.lock:
+                    self.in_coda -= 1
+        with self.lock:
+            self.in_corso += 1
+        return True
+
+    def esci(self):
+        with self.lock:
+            self.in_corso -= 1
+        self.semaforo.release()
+
+PRENOTA = Ammissione("prenota", PRENOTA_MAX_CONCORRENTI, PRENOTA_CODA_MAX, PRENOTA_ATTESA_MAX,
+                      PRENOTA_CODA_ROUTER_MS)
+
+def _attesa_router_ms():
+    """Millisecondi passati da quando il router ha ricevuto la richiesta (None se non indicato)"""
+    valore = request.headers.get("X-Request-Start", "").removeprefix("t=")
+    try:
+        inizio = float(valore)
+    except ValueError:
+        return None
+    # Heroku lo manda in millisecondi, nginx in secondi con decimali, alcuni in microsecondi
+    if inizio > 1e14:
+        inizio /= 1e6
+    elif inizio > 1e11:
+        inizio /= 1e3
+    return (time.time() - inizio) * 1000
+
+def ammetti(ammissione):
+    """Controllo di ammissione: oltre la capacità 503 "riprova tra poco" invece di un timeout"""
+    def decoratore(f):
+        if ammissione.capacita <= 0:
+            return f
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if ammissione.coda_router_ms > 0:
+                attesa = _attesa_router_ms()
+                if attesa is not None and attesa > ammissione.coda_router_ms:
+                    metrics.AMMISSIONE_RIFIUTATE.incrementa((ammissione.nome, "router"))
+                    return _rifiuta(MESSAGGIO_AMMISSIONE, RETRY_AFTER_AMMISSIONE, 503)
+            if not ammissione.entra():
+                metrics.AMMISSIONE_RIFIUTATE.incrementa((ammissione.nome, "coda"))
+                logger.warning("Richiesta rifiutata dal controllo di ammissione", extra={"ammissione": ammissione.nome})
+                return _rifiuta(MESSAGGIO_AMMISSIONE, RETRY_AFTER_AMMISSIONE, 503)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                ammissione.esci()
+        return wrapper
+    return decoratore
+
+def utente_sessione():
+    return session.get("user_id")
+
+def limiti_stats():
+    """Richieste in corso e in coda nel controllo di ammissione, per /metrics"""
+    with PRENOTA.lock:
+        return {"prenota_in_corso": PRENOTA.in_corso, "prenota_in_coda": PRENOTA.in_coda}
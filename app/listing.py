@@ -0,0 +1,117 @@
+import os
+from datetime import date, datetime, time
+from sqlalchemy import text
+from . import models
+
+HOME_PAGE_SIZE = int(os.environ.get("HOME_PAGE_SIZE", "50"))
+ADMIN_PAGE_SIZE = int(os.environ.get("ADMIN_PAGE_SIZE", "50"))
+MIN_ISCRITTI = int(os.environ.get("MIN_ISCRITTI", "2"))  # minimo iscritti per classe
+
+# ----------------- CURSORE KEYSET -----------------
+def encode_cursor(row):
+    """Cursore (data, ora, id) dell'ultima riga di una pagina, es. '2025-10-15_19:00:00_12'"""
+    return f"{row.data.isoformat()}_{row.ora.isoformat()}_{row.id}"
+
+def decode_cursor(cursor):
+    """Restituisce la tupla (data, ora, id) oppure None se il cursore non è valido"""
+    if not cursor:
+        return None
+    try:
+        d, o, i = cursor.split("_")
+        return date.fromisoformat(d), time.fromisoformat(o), int(i)
+    except ValueError:
+        return None
+
+def _filtro_classi(da, a, cursor, solo_future, now):
+    """Clausola WHERE e parametri comuni: finestra di date, solo future, keyset"""
+    where = []
+    params = {}
+
+    if solo_future:
+        now = now or datetime.now()
+        where.append("(c.data, c.ora) >= (:oggi, :adesso)")
+        params["oggi"] = now.date()
+        params["adesso"] = now.time().replace(microsecond=0)
+    if da:
+        where.append("c.data >= :da")
+        params["da"] = da
+    if a:
+        where.append("c.data <= :a")
+        params["a"] = a
+
+    dopo = decode_cursor(cursor)
+    if dopo:
+        where.append("(c.data, c.ora, c.id) > (:k_data, :k_ora, :k_id)")
+        params.update({"k_data": dopo[0], "k_ora": dopo[1], "k_id": dopo[2]})
+
+    return (" WHERE " + " AND ".join(where)) if where else "", params
+
+def _pagina(righe, limit):
+    """Taglia la riga in più letta per sapere se esiste una pagina successiva"""
+    if len(righe) > limit:
+        righe = righe[:limit]
+        return righe, encode_cursor(righe[-1])
+    return righe, None
+
+# ----------------- ELENCO CLASSI CON PRENOTATI -----------------
+def query_lista_classi(da=None, a=None, cursor=None, limit=HOME_PAGE_SIZE, solo_future=True, now=None):
+    """(statement, parametri) di lista_classi, usati anche da flask db explain"""
+    where, params = _filtro_classi(da, a, cursor, solo_future, now)
+    params["limit"] = limit + 1
+    sql = f"""
+        SELECT c.id, c.data, c.ora, c.max_posti, c.posti_prenotati AS prenotati
+        FROM classi c
+        {where}
+        ORDER BY c.data ASC, c.ora ASC, c.id ASC
+        LIMIT :limit
+    """
+    return text(sql), params
+
+def lista_classi(da=None, a=None, cursor=None, limit=HOME_PAGE_SIZE, solo_future=True, now=None):
+    """
+    Classi con il numero di prenotati (contatore posti_prenotati) in una sola query.
+    Restituisce (righe, cursore_pagina_successiva o None).
+    """
+    righe = models.db.execute(*query_lista_classi(da, a, cursor, limit, solo_future, now)).fetchall()
+    return _pagina(righe, limit)
+
+# ----------------- ROSTER PER LA DASHBOARD ADMIN -----------------
+def query_roster_classi(da=None, a=None, cursor=None, limit=ADMIN_PAGE_SIZE, now=None):
+    """(statement, parametri) di roster_classi, usati anche da flask db explain"""
+    where, params = _filtro_classi(da, a, cursor, False, now)
+    params.update({"limit": limit + 1, "min_iscritti": MIN_ISCRITTI})
+    # prima si sceglie la pagina di classi, poi si aggregano solo le loro prenotazioni
+    sql = f"""
+        WITH pagina AS (
+            SELECT c.id, c.data, c.ora, c.max_posti
+            FROM classi c
+            {where}
+            ORDER BY c.data ASC, c.ora ASC, c.id ASC
+            LIMIT :limit
+        )
+        SELECT r.*,
+               CASE
+                   WHEN r.count >= r.max_posti THEN 'piena'
+                   WHEN r.count < :min_iscritti THEN 'sotto_minimo'
+                   ELSE 'ok'
+               END AS stato
+        FROM (
+            SELECT c.id, c.data, c.ora, c.max_posti,
+                   COUNT(u.id) AS count,
+                   COALESCE(array_agg(u.username ORDER BY u.username) FILTER (WHERE u.id IS NOT NULL), '{{}}') AS prenotati
+            FROM pagina c
+            LEFT JOIN prenotazioni p ON p.classe_id = c.id
+            LEFT JOIN utenti u ON u.id = p.user_id
+            GROUP BY c.id, c.data, c.ora, c.max_posti
+        ) r
+        ORDER BY r.data ASC, r.ora ASC, r.id ASC
+    """
+    return text(sql), params
+
+def roster_classi(da=None, a=None, cursor=None, limit=ADMIN_PAGE_SIZE, now=None):
+    """
+    Una pagina di classi con conteggio, elenco username (array_agg) e stato
+    ('piena', 'sotto_minimo', 'ok') calcolati in SQL con una sola query.
+    """
+    righe = models.db.execute(*query_roster_classi(da, a, cursor, limit, now)).fetchall()
+    return _pagina(righe, limit)
@@ -0,0 +1,149 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import uuid
+from datetime import datetime, timezone
+
+# ----------------- CONFIGURAZIONE -----------------
+# LOG_LEVEL=DEBUG riattiva i messaggi di debug delle route (spenti di default in produzione)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# LOG_FORMAT=json -> una riga JSON per evento (default); LOG_FORMAT=text -> leggibile in sviluppo
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# ----------------- REQUEST ID -----------------
+# Il contextvar segue la richiesta; email_outbox e auth_sync lo salvano con la riga
+# e worker.py lo reimposta mentre la consegna
+request_id = contextvars.ContextVar("request_id", default=None)
+
+def nuovo_request_id():
+    return uuid.uuid4().hex
+
+class _RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id.get()
+        return True
+
+# ----------------- FORMATO -----------------
+# attributi standard di LogRecord: tutto il resto arriva da extra={...} e finisce nel JSON
+_ATTRIBUTI_STANDARD = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        evento = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.request_id:
+            evento["request_id"] = record.request_id
+        for chiave, valore in vars(record).items():
+            if chiave not in _ATTRIBUTI_STANDARD:
+                evento[chiave] = valore
+        if record.exc_text:
+            evento["exc"] = record.exc_text
+        return json.dumps(evento, ensure_ascii=False, default=str)
+
+class _TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record):
+        record.request_id = record.request_id or "-"
+        testo = super().format(record)
+        return testo if not record.exc_text or record.exc_text in testo else f"{testo}\n{record.exc_text}"
+
+# ----------------- HANDLER A CODA -----------------
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Il thread della richiesta prepara il record (messaggio, request id, traceback come testo)
+    e lo mette in coda senza bloccare; la scrittura su stdout la fa il thread del listener.
+    Con la coda piena il record viene scartato invece di rallentare la richiesta.
+    """
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+_listener = None
+_pid = None
+
+def configura_logging():
+    """
+    Logger root con QueueHandler + QueueListener (un thread per processo).
+    Idempotente; dopo un fork (gunicorn con preload) ricrea il listener nel figlio.
+    """
+    global _listener, _pid
+    if _pid == os.getpid():
+        return
+    if _listener is not None:
+        try:
+            _listener.stop()
+        except Exception:
+            pass  # thread del listener rimasto nel processo padre
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter())
+    coda = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = _QueueHandler(coda)
+    handler.addFilter(_RequestIdFilter())
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        if isinstance(h, _QueueHandler):
+            root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(coda, output, respect_handler_level=True)
+    _listener.start()
+    _pid = os.getpid()
+
+def _ferma_listener():
+    # svuota la coda in uscita, così gli ultimi log (es. shutdown del worker) non vanno persi
+    if _listener is not None and _pid == os.getpid():
+        _listener.stop()
+
+atexit.register(_ferma_listener)
+
+# ----------------- FLASK -----------------
+def _inizio_richiesta():
+    from flask import g, request
+    rid = request.headers.get(REQUEST_ID_HEADER, "")[:64] or nuovo_request_id()
+    g.request_id_token = request_id.set(rid)
+
+def _fine_richiesta(response):
+    rid = request_id.get()
+    if rid:
+        response.headers[REQUEST_ID_HEADER] = rid
+    return response
+
+def _chiudi_richiesta(exc):
+    from flask import g
+    token = g.pop("request_id_token", None)
+    if token is not None:
+        request_id.reset(token)
+
+def init_app(app):
+    """Logging a coda per il processo e request id (header X-Request-ID) per ogni richiesta"""
+    configura_logging()
+    app.before_request(_inizio_richiesta)
+    app.after_request(_fine_richiesta)
+    app.teardown_request(_chiudi_richiesta)
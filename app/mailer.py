@@ -0,0 +1,76 @@
+import logging
+import os
+import smtplib
+from email.message import EmailMessage
+
+logger = logging.getLogger(__name__)
+
+# ----------------- CONFIGURAZIONE -----------------
+MAIL_USE_TLS = os.environ.get("MAIL_USE_TLS", "true").lower() == "true"
+
+def mail_config():
+    """Parametri SMTP dall'ambiente, None se incompleti. Username/password sono facoltativi (es. aiosmtpd locale)."""
+    server = os.environ.get("MAIL_SERVER")
+    port = os.environ.get("MAIL_PORT")
+    user = os.environ.get("MAIL_USERNAME")
+    sender = os.environ.get("MAIL_FROM", user)
+    if not all([server, port, sender]):
+        logger.warning("Config mail non completa")
+        return None
+    try:
+        port = int(port)
+    except ValueError:
+        logger.warning("MAIL_PORT non è un numero valido")
+        return None
+    return {
+        "server": server,
+        "port": port,
+        "user": user,
+        "password": os.environ.get("MAIL_PASSWORD"),
+        "sender": sender,
+    }
+
+def build_message(sender, to_email, subject, body):
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = sender
+    msg['To'] = to_email
+    msg.set_content(body)
+    return msg
+
+# ----------------- CONNESSIONE SMTP PERSISTENTE -----------------
+class SMTPConnection:
+    """Una sessione SMTP riusata tra più messaggi (STARTTLS e login una sola volta)"""
+
+    def __init__(self, config):
+        self.config = config
+        self.smtp = None
+
+    def connect(self):
+        cfg = self.config
+        smtp = smtplib.SMTP(cfg["server"], cfg["port"], timeout=30)
+        if MAIL_USE_TLS:
+            smtp.starttls()
+        if cfg["user"] and cfg["password"]:
+            smtp.login(cfg["user"], cfg["password"])
+        self.smtp = smtp
+
+    def send(self, msg):
+        if self.smtp is None:
+            self.connect()
+        try:
+            self.smtp.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # sessione scaduta lato server: riconnessione e un secondo tentativo
+            self.close()
+            self.connect()
+            self.smtp.send_message(msg)
+
+    def close(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except Exception:
+            pass
+        self.smtp = None
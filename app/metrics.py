@@ -0,0 +1,261 @@
+import contextvars
+import hmac
+import logging
+import os
+import re
+import threading
+import time
+from flask import Response, g, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# ----------------- CONFIGURAZIONE -----------------
+# METRICS_ENABLED=false disattiva hook, header Server-Timing ed endpoint /metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+# /metrics espone query, endpoint e stato del pool: con METRICS_TOKEN richiede
+# "Authorization: Bearer <token>", senza risponde solo alle richieste dirette da localhost
+# (niente X-Forwarded-For: dietro un proxy sulla stessa macchina tutto sembrerebbe locale).
+# In produzione va impostata nell'ambiente del processo web, con lo stesso token nello scraper
+# (Prometheus: authorization.credentials nello scrape_config).
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# oltre questa soglia di query in una sola richiesta viene stampato un avviso (loop N+1)
+METRICS_QUERY_WARN = int(os.environ.get("METRICS_QUERY_WARN", "20"))
+METRICS_SLOW_TOP = int(os.environ.get("METRICS_SLOW_TOP", "10"))  # statement più lenti esposti
+METRICS_MAX_STATEMENTS = 200  # statement distinti tenuti in memoria
+
+BUCKET_SECONDI = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKET_QUERY = (1, 2, 3, 5, 10, 20, 50, 100)
+
+# ----------------- CONTENITORI -----------------
+# Le metriche sono per processo: con gunicorn ogni worker espone le sue (etichetta pid)
+_lock = threading.Lock()
+# [query, secondi nel database] della richiesta in corso: un contextvar invece di flask.g
+# perché le query della modalità asincrona (asincrono.py) girano fuori dal contesto Flask
+_conteggio = contextvars.ContextVar("metrics_conteggio", default=None)
+
+class Istogramma:
+    def __init__(self, nome, descrizione, bucket):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.bucket = bucket
+        self.serie = {}  # etichette (tuple) -> [conteggi per bucket..., somma, totale]
+
+    def osserva(self, valore, etichette=()):
+        with _lock:
+            s = self.serie.get(etichette)
+            if s is None:
+                s = self.serie[etichette] = [0] * (len(self.bucket) + 2)
+            for i, limite in enumerate(self.bucket):
+                if valore <= limite:
+                    s[i] += 1
+            s[-2] += valore
+            s[-1] += 1
+
+class Contatore:
+    def __init__(self, nome, descrizione):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.serie = {}  # etichette (tuple) -> valore
+
+    def incrementa(self, etichette=(), valore=1):
+        with _lock:
+            self.serie[etichette] = self.serie.get(etichette, 0) + valore
+
+RICHIESTE = Contatore("fundbooking_http_requests_total", "Richieste HTTP per endpoint, metodo e stato")
+DURATA_RICHIESTE = Istogramma("fundbooking_http_request_duration_seconds", "Durata delle richieste per endpoint", BUCKET_SECONDI)
+QUERY_PER_RICHIESTA = Istogramma("fundbooking_db_queries_per_request", "Query SQL eseguite in una richiesta, per endpoint", BUCKET_QUERY)
+DURATA_DB_RICHIESTA = Istogramma("fundbooking_db_time_per_request_seconds", "Tempo speso nel database in una richiesta, per endpoint", BUCKET_SECONDI)
+DURATA_QUERY = Istogramma("fundbooking_db_query_duration_seconds", "Durata delle singole query SQL", BUCKET_SECONDI)
+ERRORI_DB = Contatore("fundbooking_db_errors_total", "Errori sollevati dal driver durante le query")
+LIMITATE = Contatore("fundbooking_rate_limited_total", "Richieste respinte con 429 dal rate limit, per regola")
+AMMISSIONE_RIFIUTATE = Contatore("fundbooking_admission_rejected_total", "Richieste respinte con 503 dal controllo di ammissione")
+
+_statement = {}  # testo normalizzato -> [esecuzioni, secondi totali, secondi max]
+
+def _normalizza(statement):
+    return re.sub(r"\s+", " ", statement).strip()[:300]
+
+def _registra_statement(statement, durata):
+    chiave = _normalizza(statement)
+    with _lock:
+        s = _statement.get(chiave)
+        if s is None:
+            if len(_statement) >= METRICS_MAX_STATEMENTS:
+                # pieno: si fa posto solo se questo è più lento del più veloce tenuto
+                piu_veloce = min(_statement, key=lambda k: _statement[k][2])
+                if _statement[piu_veloce][2] >= durata:
+                    return
+                del _statement[piu_veloce]
+            s = _statement[chiave] = [0, 0.0, 0.0]
+        s[0] += 1
+        s[1] += durata
+        if durata > s[2]:
+            s[2] = durata
+
+def statement_lenti(n=None):
+    """I più lenti per durata massima: [(statement, esecuzioni, totale, max)]"""
+    with _lock:
+        voci = [(k, *v) for k, v in _statement.items()]
+    voci.sort(key=lambda v: v[3], reverse=True)
+    return voci[:n or METRICS_SLOW_TOP]
+
+# ----------------- HOOK SQLALCHEMY -----------------
+def strumenta_engine(engine):
+    """Conta e cronometra ogni query; dentro una richiesta le somma anche per la richiesta"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def _prima(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _dopo(conn, cursor, statement, parameters, context, executemany):
+        durata = time.perf_counter() - conn.info["metrics_start"].pop()
+        DURATA_QUERY.osserva(durata)
+        _registra_statement(statement, durata)
+        conteggio = _conteggio.get()
+        if conteggio is not None:
+            conteggio[0] += 1
+            conteggio[1] += durata
+
+    @event.listens_for(engine, "handle_error")
+    def _errore(context):
+        ERRORI_DB.incrementa()
+        # errore durante l'esecuzione: after_cursor_execute non arriverà
+        if context.execution_context is not None and context.connection is not None:
+            avvii = context.connection.info.get("metrics_start")
+            if avvii:
+                avvii.pop()
+
+# ----------------- PER RICHIESTA -----------------
+def inizia_conteggio():
+    """Azzera query e tempo DB della richiesta corrente; restituisce il token per il reset"""
+    return _conteggio.set([0, 0.0])
+
+def registra_richiesta(endpoint, metodo, status, path, inizio):
+    """Registra la richiesta corrente nelle metriche e restituisce il valore dell'header Server-Timing"""
+    durata = time.perf_counter() - inizio
+    query, db = _conteggio.get() or (0, 0.0)
+    RICHIESTE.incrementa((endpoint, metodo, str(status)))
+    DURATA_RICHIESTE.osserva(durata, (endpoint,))
+    QUERY_PER_RICHIESTA.osserva(query, (endpoint,))
+    DURATA_DB_RICHIESTA.osserva(db, (endpoint,))
+    if query > METRICS_QUERY_WARN:
+        logger.warning("Possibile loop N+1: %d query in %s", query, endpoint, extra={"path": path, "query": query})
+    return f'app;dur={durata * 1000:.1f}, db;dur={db * 1000:.1f};desc="{query} query"'
+
+# ----------------- HOOK FLASK -----------------
+def _inizio_richiesta():
+    g.metrics_start = time.perf_counter()
+    g.metrics_token = inizia_conteggio()
+
+def _fine_richiesta(response):
+    if "metrics_start" not in g:
+        return response
+    response.headers.add("Server-Timing", registra_richiesta(
+        request.endpoint or "nessuno", request.method, response.status_code, request.path, g.metrics_start
+    ))
+    return response
+
+def _chiudi_richiesta(exc):
+    token = g.pop("metrics_token", None)
+    if token is not None:
+        _conteggio.reset(token)
+
+# ----------------- FORMATO PROMETHEUS -----------------
+def _escape(valore):
+    return str(valore).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _etichette(nomi, valori, extra=None):
+    coppie = list(zip(nomi, valori)) + (extra or [])
+    if not coppie:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in coppie) + "}"
+
+def _numero(v):
+    return repr(float(v)) if isinstance(v, float) else str(int(v))
+
+def _righe_contatore(c, nomi):
+    yield f"# HELP {c.nome} {c.descrizione}"
+    yield f"# TYPE {c.nome} counter"
+    for valori, v in sorted(c.serie.items()):
+        yield f"{c.nome}{_etichette(nomi, valori)} {_numero(v)}"
+
+def _righe_istogramma(h, nomi):
+    yield f"# HELP {h.nome} {h.descrizione}"
+    yield f"# TYPE {h.nome} histogram"
+    for valori, s in sorted(h.serie.items()):
+        for limite, conteggio in zip(h.bucket, s):
+            yield f"{h.nome}_bucket{_etichette(nomi, valori, [('le', limite)])} {conteggio}"
+        yield f"{h.nome}_bucket{_etichette(nomi, valori, [('le', '+Inf')])} {s[-1]}"
+        yield f"{h.nome}_sum{_etichette(nomi, valori)} {_numero(s[-2])}"
+        yield f"{h.nome}_count{_etichette(nomi, valori)} {s[-1]}"
+
+def _righe_gauge(nome, descrizione, valori):
+    """valori: {chiave: numero}, esposti come etichetta "chiave" (None e non numerici saltati)"""
+    yield f"# HELP {nome} {descrizione}"
+    yield f"# TYPE {nome} gauge"
+    for chiave, v in valori.items():
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            yield f'{nome}{{chiave="{_escape(chiave)}"}} {_numero(v)}'
+
+def genera_metriche(engine):
+    from .cache import cache_stats
+    from .database import pool_stats
+    from .limiti import limiti_stats
+    from .outbox import outbox_stats
+    from .sessioni import sessioni_cache_stats
+    from .stato_utenti import stato_cache_stats
+
+    with _lock:
+        righe = [
+            *_righe_contatore(RICHIESTE, ("endpoint", "method", "status")),
+            *_righe_istogramma(DURATA_RICHIESTE, ("endpoint",)),
+            *_righe_istogramma(QUERY_PER_RICHIESTA, ("endpoint",)),
+            *_righe_istogramma(DURATA_DB_RICHIESTA, ("endpoint",)),
+            *_righe_istogramma(DURATA_QUERY, ()),
+            *_righe_contatore(ERRORI_DB, ()),
+            *_righe_contatore(LIMITATE, ("regola",)),
+            *_righe_contatore(AMMISSIONE_RIFIUTATE, ("ammissione", "motivo")),
+        ]
+    lenti = statement_lenti()
+    righe += [
+        "# HELP fundbooking_db_statement_max_seconds Durata massima degli statement più lenti",
+        "# TYPE fundbooking_db_statement_max_seconds gauge",
+        *(f'fundbooking_db_statement_max_seconds{{statement="{_escape(s)}"}} {_numero(mx)}' for s, _, _, mx in lenti),
+        "# HELP fundbooking_db_statement_calls_total Esecuzioni degli statement più lenti",
+        "# TYPE fundbooking_db_statement_calls_total counter",
+        *(f'fundbooking_db_statement_calls_total{{statement="{_escape(s)}"}} {n}' for s, n, _, _ in lenti),
+    ]
+    righe += _righe_gauge("fundbooking_db_pool", "Stato del pool di connessioni (vedi /admin/pool)", pool_stats(engine))
+    righe += _righe_gauge("fundbooking_listing_cache", "Statistiche della cache elenco classi (vedi /admin/cache)", cache_stats())
+    righe += _righe_gauge("fundbooking_stato_cache", "Cache dello stato utenti (hit, miss, invalidazioni)", stato_cache_stats())
+    righe += _righe_gauge("fundbooking_sessioni_cache", "Cache delle sessioni lato server (hit, miss, invalidazioni)", sessioni_cache_stats())
+    righe += _righe_gauge("fundbooking_admission", "Controllo di ammissione: richieste in corso e in coda", limiti_stats())
+    righe += _righe_gauge("fundbooking_email_outbox", "Email in attesa di consegna e età della più vecchia (secondi)", outbox_stats())
+    righe += [
+        "# HELP fundbooking_process_info Processo che espone le metriche (un worker gunicorn)",
+        "# TYPE fundbooking_process_info gauge",
+        f'fundbooking_process_info{{pid="{os.getpid()}"}} 1',
+    ]
+    return "\n".join(righe) + "\n"
+
+# ----------------- REGISTRAZIONE -----------------
+def _accesso_consentito():
+    if METRICS_TOKEN:
+        return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}")
+    return request.remote_addr in ("127.0.0.1", "::1") and "X-Forwarded-For" not in request.headers
+
+def init_app(app, engine):
+    """Hook su engine e app, endpoint /metrics (formato testo Prometheus)"""
+    if not METRICS_ENABLED:
+        return
+    strumenta_engine(engine)
+    app.before_request(_inizio_richiesta)
+    app.after_request(_fine_richiesta)
+    app.teardown_request(_chiudi_richiesta)
+
+    @app.route("/metrics")
+    def metrics():
+        if not _accesso_consentito():
+            return "Non autorizzato", 401
+        return Response(genera_metriche(engine), mimetype="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,273 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# Migrazioni versionate: file app/migrations/NNNN_descrizione.sql applicati in ordine,
+# una volta sola (flask db upgrade, fase "release" del Procfile) e non a ogni avvio dei worker.
+# Un file che inizia con "-- migrate: no-transaction" viene eseguito statement per statement
+# in autocommit (serve per CREATE INDEX CONCURRENTLY).
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+NO_TRANSACTION = "-- migrate: no-transaction"
+LOCK_KEY = 7_340_001  # pg_advisory_lock: due deploy in parallelo non applicano la stessa migrazione
+
+_NOME_FILE = re.compile(r"^(\d{4})_(\w+)\.sql$")
+
+# ----------------- LETTURA FILE -----------------
+def migrazioni_disponibili():
+    """Lista ordinata di (versione, nome, percorso) presenti in MIGRATIONS_DIR"""
+    trovate = []
+    for nome_file in sorted(os.listdir(MIGRATIONS_DIR)):
+        m = _NOME_FILE.match(nome_file)
+        if m:
+            trovate.append((m.group(1), m.group(2), os.path.join(MIGRATIONS_DIR, nome_file)))
+    return trovate
+
+def _checksum(sql):
+    return hashlib.sha256(sql.encode("utf-8")).hexdigest()
+
+def _statements(sql):
+    """Divide un file in statement (solo per i file no-transaction, che non contengono funzioni)"""
+    righe = [r for r in sql.splitlines() if not r.strip().startswith("--")]
+    return [s.strip() for s in "\n".join(righe).split(";") if s.strip()]
+
+# ----------------- ESECUZIONE -----------------
+def _applicate(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            versione TEXT PRIMARY KEY,
+            nome TEXT NOT NULL,
+            checksum TEXT NOT NULL,
+            applicata_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    cursor.execute("SELECT versione, checksum FROM schema_migrations")
+    return dict(cursor.fetchall())
+
+def upgrade(engine=None):
+    """Applica le migrazioni mancanti. Restituisce la lista delle versioni applicate."""
+    engine = engine or models.engine
+    # connessione DBAPI diretta: i file SQL vanno eseguiti così come sono (niente bind di SQLAlchemy)
+    conn = engine.raw_connection()
+    dbapi_conn = conn.dbapi_connection
+    applicate_ora = []
+    try:
+        dbapi_conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_lock(%s)", (LOCK_KEY,))
+        try:
+            applicate = _applicate(cursor)
+            for versione, nome, percorso in migrazioni_disponibili():
+                with open(percorso, encoding="utf-8") as f:
+                    sql = f.read()
+                checksum = _checksum(sql)
+                if versione in applicate:
+                    if applicate[versione] != checksum:
+                        logger.warning("Migrazione %s_%s modificata dopo essere stata applicata", versione, nome)
+                    continue
+
+                if sql.lstrip().startswith(NO_TRANSACTION):
+                    # ogni statement deve essere idempotente: se il file si interrompe a metà
+                    # viene rieseguito per intero al prossimo upgrade
+                    for statement in _statements(sql):
+                        cursor.execute(statement)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (versione, nome, checksum) VALUES (%s, %s, %s)",
+                        (versione, nome, checksum)
+                    )
+                else:
+                    dbapi_conn.autocommit = False
+                    try:
+                        cursor.execute(sql)
+                        cursor.execute(
+                            "INSERT INTO schema_migrations (versione, nome, checksum) VALUES (%s, %s, %s)",
+                            (versione, nome, checksum)
+                        )
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    finally:
+                        dbapi_conn.autocommit = True
+                applicate_ora.append(versione)
+                logger.info("Migrazione applicata: %s_%s", versione, nome)
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+            cursor.close()
+    finally:
+        dbapi_conn.autocommit = False  # la connessione torna al pool in modalità normale
+        conn.close()
+    return applicate_ora
+
+def status(engine=None):
+    """Lista di (versione, nome, applicata_at o None)"""
+    engine = engine or models.engine
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        _applicate(cursor)
+        cursor.execute("SELECT versione, applicata_at FROM schema_migrations")
+        date_applicazione = dict(cursor.fetchall())
+        conn.commit()
+    finally:
+        conn.close()
+    return [(v, nome, date_applicazione.get(v)) for v, nome, _ in migrazioni_disponibili()]
+
+# ----------------- VERIFICA INDICI (EXPLAIN) -----------------
+# Query calde con gli indici che il planner deve usare (una tupla dentro gli attesi = uno
+# qualsiasi fra quelli). Gli statement sono le costanti SQL dei moduli che le eseguono,
+# con parametri d'esempio: se una route cambia la sua query, flask db explain verifica quella nuova.
+UUID_ESEMPIO = "00000000-0000-4000-8000-000000000000"
+
+def query_calde():
+    """Lista di (descrizione, statement, parametri, indici attesi)"""
+    # import qui: i moduli delle route importano Flask e i blueprint, servono solo al comando
+    from datetime import datetime
+    from . import booking, listing, outbox, sessioni, stato_utenti, token_reset
+    from .routes import admin, user
+
+    adesso = datetime.now().replace(microsecond=0)
+    cursore = f"{adesso.date().isoformat()}_{adesso.time().isoformat()}_1"
+    param_uid = {"uid": UUID_ESEMPIO}
+    pg = sessioni.PostgresSessioni
+    return [
+        ("home: elenco classi future (listing.lista_classi)",
+         *listing.query_lista_classi(cursor=cursore, now=adesso),
+         ("idx_classi_data_ora",)),
+        ("dashboard: roster per classe (listing.roster_classi)",
+         *listing.query_roster_classi(da=adesso.date(), now=adesso),
+         ("idx_classi_data_ora", "idx_prenotazioni_classe", "utenti_pkey")),
+        ("prenota (booking.PRENOTA_SQL)",
+         booking.PRENOTA_SQL, {"cid": 1, **param_uid},
+         ("classi_pkey", "idx_unique_booking")),
+        ("annulla (booking.ANNULLA_SQL)",
+         booking.ANNULLA_SQL, {"cid": 1, **param_uid, "limite": adesso},
+         ("classi_pkey", "idx_unique_booking")),
+        ("lista d'attesa: iscrizione (booking.ISCRIVI_ATTESA_SQL)",
+         booking.ISCRIVI_ATTESA_SQL, {"cid": 1, **param_uid},
+         ("classi_pkey", "idx_unique_booking", "idx_lista_attesa_fifo")),
+        # senza statistiche il planner può partire dagli utenti attivi e sondare la coda
+        # per (user_id, classe_id): l'importante è che lista_attesa non venga scandita
+        ("lista d'attesa: promozione (booking.PROMUOVI_SQL)",
+         booking.PROMUOVI_SQL, {"cid": 1},
+         (("idx_lista_attesa_fifo", "idx_lista_attesa_utente"), "lista_attesa_pkey")),
+        ("admin delete: posti liberati (booking.RILASCIA_POSTI_SQL)",
+         booking.RILASCIA_POSTI_SQL, {"uids": [UUID_ESEMPIO]},
+         ("idx_unique_booking", "classi_pkey")),
+        ("admin delete: prenotazioni degli utenti (admin.ELIMINA_PRENOTAZIONI_UTENTI_SQL)",
+         admin.ELIMINA_PRENOTAZIONI_UTENTI_SQL, {"ids": [UUID_ESEMPIO]},
+         ("idx_unique_booking",)),
+        ("delete_classe: prenotazioni della classe (admin.ELIMINA_PRENOTAZIONI_CLASSE_SQL)",
+         admin.ELIMINA_PRENOTAZIONI_CLASSE_SQL, {"cid": 1},
+         ("idx_prenotazioni_classe",)),
+        ("admin_users: ordinamento per stato, cognome, nome (admin.UTENTI_SQL)",
+         admin.UTENTI_SQL, {},
+         ("idx_utenti_stato_cognome_nome",)),
+        ("login: ricerca per username (user.LOGIN_SQL)",
+         user.LOGIN_SQL, {"username": "x"},
+         ("utenti_username_key",)),
+        ("recupero credenziali: ricerca per email (user.UTENTE_PER_EMAIL_SQL)",
+         user.UTENTE_PER_EMAIL_SQL, {"email": "x"},
+         ("utenti_email_key",)),
+        ("stato utente a ogni richiesta (stato_utenti.LEGGI_SQL)",
+         stato_utenti.LEGGI_SQL, {"id": UUID_ESEMPIO},
+         ("utenti_pkey",)),
+        ("sessioni: lettura a ogni richiesta (sessioni.PostgresSessioni.CARICA_SQL)",
+         pg.CARICA_SQL, {"id": "x"},
+         ("sessioni_pkey",)),
+        ("sessioni: revoca per utente (sessioni.PostgresSessioni.REVOCA_SQL)",
+         pg.REVOCA_SQL, {"ids": [UUID_ESEMPIO]},
+         ("idx_sessioni_utente",)),
+        ("sessioni: pulizia delle scadute (sessioni.PostgresSessioni.PULIZIA_SQL)",
+         pg.PULIZIA_SQL, {"n": sessioni.SESSION_PULIZIA_BLOCCO},
+         ("idx_sessioni_scadenza", "sessioni_pkey")),
+        ("reset_password: verifica del token (token_reset.CONTROLLA_SQL)",
+         token_reset.CONTROLLA_SQL, {"id": "x"},
+         ("token_reset_pkey",)),
+        ("reset_password: consumo del token (token_reset.CONSUMA_SQL)",
+         token_reset.CONSUMA_SQL, {"id": "x"},
+         ("token_reset_pkey",)),
+        ("recover_password: sostituzione dei token (token_reset.SOSTITUISCI_SQL)",
+         token_reset.SOSTITUISCI_SQL, param_uid,
+         ("idx_token_reset_utente",)),
+        ("outbox: profondità della coda (outbox.STATO_SQL)",
+         outbox.STATO_SQL, {"max_attempts": outbox.OUTBOX_MAX_ATTEMPTS},
+         ("idx_email_outbox_pending",)),
+        ("token reset: pulizia degli scaduti (token_reset.PULIZIA_SQL)",
+         token_reset.PULIZIA_SQL, {"n": token_reset.TOKEN_PULIZIA_BLOCCO},
+         ("idx_token_reset_scadenza", "token_reset_pkey")),
+    ]
+
+def _indici_usati(piano):
+    """Nomi degli indici in un piano EXPLAIN (FORMAT JSON), a qualsiasi profondità"""
+    trovati = set()
+    nodi = [piano]
+    while nodi:
+        nodo = nodi.pop()
+        if isinstance(nodo, dict):
+            if "Index Name" in nodo:
+                trovati.add(nodo["Index Name"])
+            nodi.extend(nodo.values())
+        elif isinstance(nodo, list):
+            nodi.extend(nodo)
+    return trovati
+
+def verifica_indici(engine=None):
+    """
+    EXPLAIN di ogni query calda con enable_seqscan = off: su tabelle piccole il planner
+    preferirebbe comunque la scansione sequenziale, così si controlla che gli indici adatti
+    esistano e siano utilizzabili. EXPLAIN senza ANALYZE non esegue lo statement (nemmeno
+    i DELETE/UPDATE), e la transazione viene comunque annullata.
+    Restituisce la lista di (descrizione, indici attesi, indici usati, ok).
+    """
+    engine = engine or models.engine
+    risultati = []
+    with engine.connect() as conn:
+        for descrizione, statement, params, attesi in query_calde():
+            with conn.begin() as trans:
+                conn.execute(text("SET LOCAL enable_seqscan = off"))
+                piano = conn.execute(text("EXPLAIN (FORMAT JSON) " + statement.text), params).scalar()
+                trans.rollback()
+            if isinstance(piano, str):
+                piano = json.loads(piano)
+            usati = _indici_usati(piano)
+            ok = all(not usati.isdisjoint(a if isinstance(a, tuple) else (a,)) for a in attesi)
+            attesi = [" o ".join(a) if isinstance(a, tuple) else a for a in attesi]
+            risultati.append((descrizione, attesi, sorted(usati), ok))
+    return risultati
+
+# ----------------- CLI (flask db ...) -----------------
+db_cli = AppGroup("db", help="Migrazioni dello schema")
+
+@db_cli.command("upgrade")
+def upgrade_command():
+    """Applica le migrazioni mancanti"""
+    if not upgrade():
+        click.echo("✅ Schema già aggiornato")
+
+@db_cli.command("status")
+def status_command():
+    """Mostra le migrazioni applicate e quelle in attesa"""
+    for versione, nome, applicata_at in status():
+        stato = applicata_at.isoformat(timespec="seconds") if applicata_at else "in attesa"
+        click.echo(f"{versione}_{nome}: {stato}")
+
+@db_cli.command("explain")
+def explain_command():
+    """Verifica con EXPLAIN che le query calde usino un indice"""
+    falliti = 0
+    for descrizione, attesi, usati, ok in verifica_indici():
+        if ok:
+            click.echo(f"✅ {descrizione}: {', '.join(attesi)}")
+        else:
+            falliti += 1
+            click.echo(f"❌ {descrizione}: attesi {', '.join(attesi)}, usati {', '.join(usati) or 'nessun indice'}")
+    if falliti:
+        raise click.ClickException(f"{falliti} query senza l'indice atteso")
@@ -0,0 +1,93 @@
+-- Schema di partenza. Idempotente: su un database già esistente (creato da
+-- init_db_if_needed o da schema_postgres.sql) aggiunge solo ciò che manca.
+
+-- CLASSI
+CREATE TABLE IF NOT EXISTS classi (
+    id SERIAL PRIMARY KEY,
+    data DATE NOT NULL,
+    ora TIME NOT NULL,
+    max_posti INTEGER NOT NULL
+);
+
+-- UTENTI (id = id dell'utente su Supabase Auth)
+CREATE TABLE IF NOT EXISTS utenti (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    nome TEXT NOT NULL,
+    cognome TEXT NOT NULL,
+    data_nascita DATE NOT NULL,
+    luogo_nascita TEXT NOT NULL,
+    indirizzo TEXT NOT NULL,
+    citta TEXT NOT NULL,
+    comune TEXT NOT NULL,
+    cap TEXT NOT NULL,
+    email TEXT NOT NULL UNIQUE,
+    telefono TEXT,
+    username TEXT NOT NULL UNIQUE,
+    password_hash TEXT NOT NULL,
+    consenso_privacy BOOLEAN NOT NULL,
+    stato TEXT NOT NULL DEFAULT 'pending' -- pending | attivo | sospeso
+);
+
+-- colonne presenti in schema_postgres.sql ma mai create da init_db_if_needed
+ALTER TABLE utenti ADD COLUMN IF NOT EXISTS reset_token TEXT;
+ALTER TABLE utenti ADD COLUMN IF NOT EXISTS reset_token_expiry TIMESTAMPTZ;
+ALTER TABLE utenti ADD COLUMN IF NOT EXISTS username_recovery_token TEXT;
+ALTER TABLE utenti ADD COLUMN IF NOT EXISTS username_recovery_expiry TIMESTAMPTZ;
+
+-- PRENOTAZIONI
+CREATE TABLE IF NOT EXISTS prenotazioni (
+    id SERIAL PRIMARY KEY,
+    user_id UUID NOT NULL REFERENCES utenti(id) ON DELETE CASCADE,
+    classe_id INTEGER NOT NULL REFERENCES classi(id) ON DELETE CASCADE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Un utente non può prenotare due volte la stessa classe
+CREATE UNIQUE INDEX IF NOT EXISTS idx_unique_booking ON prenotazioni(user_id, classe_id);
+
+-- Contatore denormalizzato dei posti prenotati (aggiornato insieme a prenotazioni)
+ALTER TABLE classi ADD COLUMN IF NOT EXISTS posti_prenotati INTEGER NOT NULL DEFAULT 0 CHECK (posti_prenotati >= 0);
+UPDATE classi c SET posti_prenotati = x.n
+FROM (
+    SELECT c2.id, COUNT(p.id) AS n
+    FROM classi c2 LEFT JOIN prenotazioni p ON p.classe_id = c2.id
+    GROUP BY c2.id
+) x
+WHERE c.id = x.id AND c.posti_prenotati <> x.n;
+
+-- OUTBOX EMAIL (scritta nella stessa transazione della modifica, consegnata da worker.py)
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    destinatario TEXT NOT NULL,
+    oggetto TEXT NOT NULL,
+    corpo TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    tentativi INTEGER NOT NULL DEFAULT 0,
+    prossimo_tentativo TIMESTAMPTZ NOT NULL DEFAULT now(),
+    inviata_at TIMESTAMPTZ,
+    errore TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_email_outbox_pending
+ON email_outbox(prossimo_tentativo) WHERE inviata_at IS NULL;
+
+-- ALLINEAMENTO SUPABASE AUTH (un job per utente, eseguito da worker.py)
+CREATE TABLE IF NOT EXISTS auth_sync (
+    idempotency_key TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    tentativi INTEGER NOT NULL DEFAULT 0,
+    prossimo_tentativo TIMESTAMPTZ NOT NULL DEFAULT now(),
+    completata_at TIMESTAMPTZ,
+    errore TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_auth_sync_pending
+ON auth_sync(prossimo_tentativo) WHERE completata_at IS NULL;
+
+-- Abilita Row Level Security
+ALTER TABLE utenti ENABLE ROW LEVEL SECURITY;
+ALTER TABLE classi ENABLE ROW LEVEL SECURITY;
+ALTER TABLE prenotazioni ENABLE ROW LEVEL SECURITY;
+ALTER TABLE email_outbox ENABLE ROW LEVEL SECURITY;
+ALTER TABLE auth_sync ENABLE ROW LEVEL SECURITY;
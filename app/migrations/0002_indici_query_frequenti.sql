@@ -0,0 +1,15 @@
+-- migrate: no-transaction
+-- Indici per le query più frequenti delle route, creati CONCURRENTLY per non
+-- bloccare le scritture in produzione (quindi fuori da una transazione).
+
+-- roster della dashboard, rilascio posti, conteggi per classe
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_prenotazioni_classe ON prenotazioni(classe_id);
+
+-- elenco home/dashboard: filtro per data e paginazione keyset (data, ora, id)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_classi_data_ora ON classi(data, ora, id);
+
+-- reset_password: ricerca per token (solo le righe con un token attivo)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_utenti_reset_token ON utenti(reset_token) WHERE reset_token IS NOT NULL;
+
+-- admin_users: ORDER BY stato DESC, cognome ASC, nome ASC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_utenti_stato_cognome_nome ON utenti(stato DESC, cognome, nome);
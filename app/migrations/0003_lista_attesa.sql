@@ -0,0 +1,16 @@
+-- Lista d'attesa per le classi piene: ordine FIFO per id, promozione automatica
+-- quando si libera un posto (vedi booking.promuovi_lista_attesa).
+CREATE TABLE IF NOT EXISTS lista_attesa (
+    id BIGSERIAL PRIMARY KEY,
+    user_id UUID NOT NULL REFERENCES utenti(id) ON DELETE CASCADE,
+    classe_id INTEGER NOT NULL REFERENCES classi(id) ON DELETE CASCADE,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Un utente compare al massimo una volta per classe
+CREATE UNIQUE INDEX IF NOT EXISTS idx_lista_attesa_utente ON lista_attesa(user_id, classe_id);
+
+-- Prossimi in coda per una classe
+CREATE INDEX IF NOT EXISTS idx_lista_attesa_fifo ON lista_attesa(classe_id, id);
+
+ALTER TABLE lista_attesa ENABLE ROW LEVEL SECURITY;
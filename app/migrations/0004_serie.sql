@@ -0,0 +1,20 @@
+-- Serie ricorrenti: una riga per serie, le occorrenze sono righe di classi con serie_id.
+CREATE TABLE IF NOT EXISTS serie (
+    id SERIAL PRIMARY KEY,
+    giorni SMALLINT[] NOT NULL,          -- giorni della settimana, 0 = lunedì
+    ora TIME NOT NULL,
+    data_inizio DATE NOT NULL,
+    data_fine DATE NOT NULL,
+    max_posti INTEGER NOT NULL,
+    escluse DATE[] NOT NULL DEFAULT '{}', -- date saltate (festività, chiusure)
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    CHECK (data_fine >= data_inizio)
+);
+
+-- Eliminando la serie le lezioni restano, come lezioni singole
+ALTER TABLE classi ADD COLUMN IF NOT EXISTS serie_id INTEGER REFERENCES serie(id) ON DELETE SET NULL;
+
+-- Modifica/eliminazione delle occorrenze (future) di una serie
+CREATE INDEX IF NOT EXISTS idx_classi_serie ON classi(serie_id, data) WHERE serie_id IS NOT NULL;
+
+ALTER TABLE serie ENABLE ROW LEVEL SECURITY;
@@ -0,0 +1,30 @@
+-- Sessioni lato server (SESSION_BACKEND=postgres): nel cookie c'è solo l'id casuale,
+-- qui il suo sha256, così un dump della tabella non permette di impersonare nessuno.
+CREATE TABLE IF NOT EXISTS sessioni (
+    id TEXT PRIMARY KEY,
+    user_id UUID REFERENCES utenti(id) ON DELETE CASCADE,
+    dati TEXT NOT NULL,
+    scadenza TIMESTAMPTZ NOT NULL
+);
+
+-- Revoca di tutte le sessioni di un utente (sospensione/eliminazione)
+CREATE INDEX IF NOT EXISTS idx_sessioni_utente ON sessioni(user_id) WHERE user_id IS NOT NULL;
+-- Pulizia delle sessioni scadute
+CREATE INDEX IF NOT EXISTS idx_sessioni_scadenza ON sessioni(scadenza);
+
+ALTER TABLE sessioni ENABLE ROW LEVEL SECURITY;
+
+-- Cambio di stato o eliminazione di un utente -> NOTIFY stato_utenti (payload: id utente).
+-- Ogni processo web ascolta il canale e invalida la sua cache degli stati (vedi stato_utenti.py).
+-- NOTIFY è transazionale: parte solo al commit della modifica.
+CREATE OR REPLACE FUNCTION notifica_stato_utente() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('stato_utenti', OLD.id::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_utenti_stato ON utenti;
+CREATE TRIGGER trg_utenti_stato
+    AFTER UPDATE OF stato OR DELETE ON utenti
+    FOR EACH ROW EXECUTE FUNCTION notifica_stato_utente();
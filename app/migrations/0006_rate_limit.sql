@@ -0,0 +1,13 @@
+-- Token bucket condivisi tra i worker (RATE_LIMIT_BACKEND=postgres, vedi limiti.py).
+-- UNLOGGED: niente WAL, dopo un crash la tabella riparte vuota (i bucket tornano pieni).
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit (
+    chiave TEXT PRIMARY KEY,
+    gettoni DOUBLE PRECISION NOT NULL,
+    aggiornato TIMESTAMPTZ NOT NULL,
+    consentita BOOLEAN NOT NULL  -- esito dell'ultima richiesta, restituito dall'upsert
+);
+
+-- Pulizia dei bucket inattivi
+CREATE INDEX IF NOT EXISTS idx_rate_limit_aggiornato ON rate_limit(aggiornato);
+
+ALTER TABLE rate_limit ENABLE ROW LEVEL SECURITY;
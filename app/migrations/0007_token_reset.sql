@@ -0,0 +1,29 @@
+-- Token di reset password in una tabella dedicata (vedi token_reset.py): nel link c'è il
+-- token casuale, qui solo il suo sha256 (chiave primaria -> una sola lettura d'indice).
+-- Il token viene consumato con DELETE ... RETURNING, quelli scaduti li cancella il worker.
+CREATE TABLE IF NOT EXISTS token_reset (
+    id TEXT PRIMARY KEY,
+    user_id UUID NOT NULL REFERENCES utenti(id) ON DELETE CASCADE,
+    scadenza TIMESTAMPTZ NOT NULL
+);
+
+-- Un nuovo token sostituisce quelli già emessi per lo stesso utente
+CREATE INDEX IF NOT EXISTS idx_token_reset_utente ON token_reset(user_id);
+-- Pulizia dei token scaduti
+CREATE INDEX IF NOT EXISTS idx_token_reset_scadenza ON token_reset(scadenza);
+
+ALTER TABLE token_reset ENABLE ROW LEVEL SECURITY;
+
+-- I link già inviati e ancora validi restano utilizzabili
+INSERT INTO token_reset (id, user_id, scadenza)
+SELECT encode(sha256(convert_to(reset_token, 'UTF8')), 'hex'), id, reset_token_expiry
+FROM utenti
+WHERE reset_token IS NOT NULL AND reset_token_expiry > now()
+ON CONFLICT (id) DO NOTHING;
+
+-- I token in chiaro non servono più (con le colonne se ne va anche idx_utenti_reset_token);
+-- username_recovery_* non sono mai state scritte: il recupero username non usa token
+ALTER TABLE utenti DROP COLUMN IF EXISTS reset_token;
+ALTER TABLE utenti DROP COLUMN IF EXISTS reset_token_expiry;
+ALTER TABLE utenti DROP COLUMN IF EXISTS username_recovery_token;
+ALTER TABLE utenti DROP COLUMN IF EXISTS username_recovery_expiry;
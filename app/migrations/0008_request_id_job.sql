@@ -0,0 +1,4 @@
+-- Request id della richiesta web che ha accodato il messaggio o il job (vedi log.py):
+-- worker.py lo rimette nel contesto dei log durante la consegna.
+ALTER TABLE email_outbox ADD COLUMN IF NOT EXISTS request_id TEXT;
+ALTER TABLE auth_sync ADD COLUMN IF NOT EXISTS request_id TEXT;
@@ -0,0 +1,18 @@
+-- Sessione aggiornata o cancellata -> NOTIFY stato_utenti con payload "sessione:<id>:<md5 dei dati>"
+-- (solo "sessione:<id>" per le cancellate, anche quelle a cascata dall'eliminazione dell'utente).
+-- Ogni processo web tiene in memoria le sessioni lette e le invalida da qui (vedi sessioni.py).
+CREATE OR REPLACE FUNCTION notifica_sessione() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('stato_utenti', 'sessione:' || OLD.id);
+    ELSE
+        PERFORM pg_notify('stato_utenti', 'sessione:' || NEW.id || ':' || md5(NEW.dati));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_sessioni_notifica ON sessioni;
+CREATE TRIGGER trg_sessioni_notifica
+    AFTER UPDATE OR DELETE ON sessioni
+    FOR EACH ROW EXECUTE FUNCTION notifica_sessione();
@@ -0,0 +1,196 @@
+import logging
+import os
+import threading
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from . import models
+from .log import request_id
+from .mailer import mail_config, build_message, SMTPConnection
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "2"))   # secondi tra un giro e l'altro a coda vuota
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BACKOFF = int(os.environ.get("OUTBOX_RETRY_BACKOFF", "30"))    # secondi, raddoppia a ogni tentativo
+OUTBOX_RETENTION_DAYS = int(os.environ.get("OUTBOX_RETENTION_DAYS", "7"))   # righe inviate conservate
+# Limite alla coda: oltre OUTBOX_AVVISO_PENDENTI messaggi in attesa un avviso nei log, oltre
+# OUTBOX_MAX_PENDENTI accoda_email solleva OutboxPiena e la transazione che la genera fallisce
+# (meglio un "riprova più tardi" che una coda che cresce senza fine). 0 = nessun limite.
+OUTBOX_AVVISO_PENDENTI = int(os.environ.get("OUTBOX_AVVISO_PENDENTI", "1000"))
+OUTBOX_MAX_PENDENTI = int(os.environ.get("OUTBOX_MAX_PENDENTI", "20000"))
+OUTBOX_PROFONDITA_SECONDI = 5  # la profondità viene riletta al massimo ogni 5 secondi per processo
+
+class OutboxPiena(Exception):
+    pass
+
+# ----------------- PROFONDITÀ DELLA CODA -----------------
+STATO_SQL = text("""
+    SELECT COUNT(*) AS pendenti,
+           COALESCE(EXTRACT(EPOCH FROM now() - MIN(created_at)), 0) AS piu_vecchia_secondi
+    FROM email_outbox
+    WHERE inviata_at IS NULL AND tentativi < :max_attempts
+""")
+
+_stato = {"letto": None, "pendenti": 0, "piu_vecchia_secondi": 0.0}
+_stato_lock = threading.Lock()
+
+def _aggiorna_stato(conn):
+    row = conn.execute(STATO_SQL, {"max_attempts": OUTBOX_MAX_ATTEMPTS}).fetchone()
+    with _stato_lock:
+        _stato.update(letto=time.monotonic(), pendenti=row.pendenti, piu_vecchia_secondi=float(row.piu_vecchia_secondi))
+        return dict(_stato)
+
+def _da_rileggere():
+    with _stato_lock:
+        return _stato["letto"] is None or time.monotonic() - _stato["letto"] >= OUTBOX_PROFONDITA_SECONDI
+
+def outbox_stats():
+    """Messaggi in attesa e età del più vecchio (secondi), per /metrics"""
+    if _da_rileggere():
+        try:
+            with models.engine.connect() as conn:
+                return {k: v for k, v in _aggiorna_stato(conn).items() if k != "letto"}
+        except SQLAlchemyError:
+            logger.exception("Lettura profondità outbox fallita")
+    with _stato_lock:
+        return {"pendenti": _stato["pendenti"], "piu_vecchia_secondi": _stato["piu_vecchia_secondi"]}
+
+def _controlla_profondita(nuovi):
+    """Avviso o OutboxPiena in base ai messaggi in attesa (letti al più ogni OUTBOX_PROFONDITA_SECONDI)"""
+    if OUTBOX_MAX_PENDENTI <= 0 and OUTBOX_AVVISO_PENDENTI <= 0:
+        return
+    if _da_rileggere():
+        stato = _aggiorna_stato(models.db)
+        if 0 < OUTBOX_AVVISO_PENDENTI <= stato["pendenti"]:
+            logger.warning("Outbox: %d email in attesa, la più vecchia da %.0f s",
+                           stato["pendenti"], stato["piu_vecchia_secondi"],
+                           extra={"pendenti": stato["pendenti"]})
+    with _stato_lock:
+        pendenti = _stato["pendenti"]
+    if 0 < OUTBOX_MAX_PENDENTI < pendenti + nuovi:
+        raise OutboxPiena(f"Outbox piena: {pendenti} email in attesa (massimo {OUTBOX_MAX_PENDENTI})")
+
+# ----------------- SCRITTURA (WEB) -----------------
+def accoda_email(to_email, subject, body):
+    """
+    Inserisce il messaggio in email_outbox nella transazione corrente:
+    la mail parte solo se la modifica che la genera viene confermata.
+    Solleva OutboxPiena oltre OUTBOX_MAX_PENDENTI messaggi in attesa.
+    """
+    _controlla_profondita(1)
+    models.db.execute(
+        text("INSERT INTO email_outbox (destinatario, oggetto, corpo, request_id) VALUES (:to, :subject, :body, :rid)"),
+        {"to": to_email, "subject": subject, "body": body, "rid": request_id.get()}
+    )
+
+def accoda_email_batch(messaggi):
+    """Come accoda_email, ma per una lista di (destinatario, oggetto, corpo) con un solo INSERT"""
+    if not messaggi:
+        return
+    _controlla_profondita(len(messaggi))
+    to, subject, body = (list(col) for col in zip(*messaggi))
+    models.db.execute(
+        text("""
+            INSERT INTO email_outbox (destinatario, oggetto, corpo, request_id)
+            SELECT m.*, :rid FROM unnest(CAST(:to AS text[]), CAST(:subject AS text[]), CAST(:body AS text[])) AS m
+        """),
+        {"to": to, "subject": subject, "body": body, "rid": request_id.get()}
+    )
+
+# ----------------- CONSEGNA (WORKER) -----------------
+CLAIM_SQL = text("""
+    SELECT id, destinatario, oggetto, corpo, tentativi, request_id
+    FROM email_outbox
+    WHERE inviata_at IS NULL
+      AND tentativi < :max_attempts
+      AND prossimo_tentativo <= now()
+    ORDER BY id
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+""")
+
+def consegna_batch(conn, limit=OUTBOX_BATCH_SIZE):
+    """
+    Prende un blocco di messaggi (FOR UPDATE SKIP LOCKED: più worker non si pestano i piedi),
+    li invia sulla sessione SMTP condivisa e registra l'esito nella stessa transazione.
+    Restituisce il numero di messaggi presi in carico.
+    """
+    rows = models.db.execute(CLAIM_SQL, {"max_attempts": OUTBOX_MAX_ATTEMPTS, "limit": limit}).fetchall()
+    inviate, fallite = [], []
+    for row in rows:
+        # i log dell'invio riportano il request id della richiesta che ha accodato la mail
+        token = request_id.set(row.request_id)
+        try:
+            conn.send(build_message(conn.config["sender"], row.destinatario, row.oggetto, row.corpo))
+            inviate.append(row.id)
+            logger.debug("Email inviata", extra={"to": row.destinatario})
+        except Exception as e:
+            conn.close()
+            logger.warning("Invio mail fallito, da ritentare", extra={"to": row.destinatario, "tentativi": row.tentativi + 1})
+            fallite.append({
+                "id": row.id,
+                "errore": str(e)[:500],
+                "ritardo": OUTBOX_RETRY_BACKOFF * (2 ** row.tentativi),
+            })
+        finally:
+            request_id.reset(token)
+
+    if inviate:
+        models.db.execute(
+            text("UPDATE email_outbox SET inviata_at = now(), tentativi = tentativi + 1, errore = NULL WHERE id = ANY(:ids)"),
+            {"ids": inviate}
+        )
+    if fallite:
+        models.db.execute(
+            text("""
+                UPDATE email_outbox
+                SET tentativi = tentativi + 1,
+                    errore = :errore,
+                    prossimo_tentativo = now() + make_interval(secs => :ritardo)
+                WHERE id = :id
+            """),
+            fallite
+        )
+    models.db.commit()
+    if rows:
+        logger.info("Outbox: %d inviate, %d da ritentare", len(inviate), len(fallite),
+                    extra={"inviate": len(inviate), "da_ritentare": len(fallite)})
+    return len(rows)
+
+def pulisci_inviate():
+    """Cancella le righe già inviate più vecchie di OUTBOX_RETENTION_DAYS"""
+    models.db.execute(
+        text("DELETE FROM email_outbox WHERE inviata_at < now() - make_interval(days => :giorni)"),
+        {"giorni": OUTBOX_RETENTION_DAYS}
+    )
+    models.db.commit()
+
+def run_worker(should_stop=lambda: False):
+    """Ciclo del worker di consegna: svuota la outbox a blocchi, poi attende OUTBOX_POLL_INTERVAL"""
+    config = mail_config()
+    if not config:
+        raise Exception("⚠️ Config mail non completa, worker outbox non avviato")
+
+    conn = SMTPConnection(config)
+    ultima_pulizia = None
+    try:
+        while not should_stop():
+            try:
+                presi = consegna_batch(conn)
+                if ultima_pulizia is None or time.monotonic() - ultima_pulizia > 3600:
+                    pulisci_inviate()
+                    ultima_pulizia = time.monotonic()
+            except Exception:
+                models.db.rollback()
+                conn.close()
+                logger.exception("Errore worker outbox")
+                presi = 0
+            if presi == 0:
+                conn.close()  # coda vuota: non tenere aperta la sessione SMTP
+            if presi < OUTBOX_BATCH_SIZE:
+                time.sleep(OUTBOX_POLL_INTERVAL)
+    finally:
+        conn.close()
+        models.db.remove()
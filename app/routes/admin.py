@@ -1,18 +1,38 @@
+import io
+import logging
 import os
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
-from ..models import db
-from ..utils import send_email_async
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify, Response, current_app
+from .. import models
+from ..models import db, read_only, unit_of_work
+from ..database import pool_stats
+from ..utils import parse_data
+from ..outbox import accoda_email, accoda_email_batch
+from ..auth_sync import accoda_sync, accoda_sync_batch
+from ..booking import rilascia_posti_utenti, promuovi_lista_attesa
+from ..listing import roster_classi, MIN_ISCRITTI
+from ..cache import invalida_elenco, cache_stats
+from ..sessioni import revoca_sessioni
+from ..stato_utenti import invalida_stato
+from ..export import EXPORTS, genera_csv, genera_xlsx, xlsx_disponibile
+from ..importazione import importa_csv, TIPI as TIPI_IMPORT
+from ..serie import crea_serie, modifica_serie, elimina_serie, elenco_serie, GIORNI_SETTIMANA, TUTTE, FUTURE
 from sqlalchemy import text
 from functools import wraps
 from sqlalchemy.exc import IntegrityError
-from supabase import create_client
-import traceback
+from datetime import date
 
 admin_bp = Blueprint("admin_bp", __name__, url_prefix="/admin")  # url_prefix per tutte le route admin
+logger = logging.getLogger(__name__)
 
-supabase_admin=create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_KEY"))
-
-MIN_ISCRITTI = 2  # minimo iscritti per classe
+# query calde delle route, verificate anche da flask db explain (migrate.py)
+UTENTI_SQL = text("""
+    SELECT id,nome,cognome,email,telefono,username,stato,
+           data_nascita,luogo_nascita,indirizzo,citta,comune,cap
+    FROM utenti
+    ORDER BY stato DESC, cognome ASC, nome ASC
+""")
+ELIMINA_PRENOTAZIONI_CLASSE_SQL = text("DELETE FROM prenotazioni WHERE classe_id = :cid")
+ELIMINA_PRENOTAZIONI_UTENTI_SQL = text("DELETE FROM prenotazioni WHERE user_id = ANY(CAST(:ids AS uuid[]))")
 
 # ----------------- DECORATOR DB SAFE -----------------
 def db_safe(f):
@@ -20,16 +40,14 @@ def db_safe(f):
     def wrapper(*args, **kwargs):
         try:
             return f(*args, **kwargs)
-        except IntegrityError as e:
+        except IntegrityError:
             db.rollback()
-            print("⚠️ IntegrityError:", e)
-            traceback.print_exc()
+            logger.warning("IntegrityError", exc_info=True)
             flash("Errore: dati già esistenti o non validi.")
             return redirect(url_for("admin_bp.dashboard"))
-        except Exception as e:
+        except Exception:
             db.rollback()
-            print("❌ Errore DB generico:", e)
-            traceback.print_exc()
+            logger.exception("Errore DB generico")
             flash("Si è verificato un errore. Riprova più tardi.")
             return redirect(url_for("admin_bp.dashboard"))
     return wrapper
@@ -65,27 +83,21 @@ def admin_login():
 # ----------------- DASHBOARD -----------------
 @admin_bp.route("/")
 @admin_required
+@read_only
 def dashboard():
-    classi = db.execute(text("SELECT * FROM classi ORDER BY data ASC, ora ASC")).fetchall()
-    dati = []
-    for c in classi:
-        prenotati = db.execute(
-            text("SELECT u.username FROM prenotazioni p JOIN utenti u ON u.id=p.user_id WHERE p.classe_id=:cid"),
-            {"cid": c.id}
-        ).fetchall()
-        count = len(prenotati)
-        stato = "ok"
-        if count >= c.max_posti:
-            stato = "piena"
-        elif count < MIN_ISCRITTI:
-            stato = "sotto_minimo"
-        dati.append({
-            "classe": c,
-            "prenotati": [p.username for p in prenotati],
-            "stato": stato,
-            "count": count
-        })
-    return render_template("admin.html", dati=dati, min_iscritti=MIN_ISCRITTI)
+    da = parse_data(request.args.get("da"))
+    a = parse_data(request.args.get("a"))
+    if not da and not a:
+        da = date.today()  # di default solo le lezioni da oggi in poi
+    classi, next_cursor = roster_classi(da=da, a=a, cursor=request.args.get("dopo"))
+    return render_template(
+        "admin.html",
+        classi=classi,
+        da=da,
+        a=a,
+        next_cursor=next_cursor,
+        min_iscritti=MIN_ISCRITTI
+    )
 
 # ----------------- GESTIONE CLASSI -----------------
 @admin_bp.route("/add", methods=["POST"])
@@ -95,9 +107,10 @@ def add_classe():
     data = request.form["data"]
     ora = request.form["ora"]
     max_posti = request.form["max_posti"]
-    db.execute(text("INSERT INTO classi (data, ora, max_posti) VALUES (:data,:ora,:max_posti)"),
-               {"data": data, "ora": ora, "max_posti": max_posti})
-    db.commit()
+    with unit_of_work():
+        db.execute(text("INSERT INTO classi (data, ora, max_posti) VALUES (:data,:ora,:max_posti)"),
+                   {"data": data, "ora": ora, "max_posti": max_posti})
+    invalida_elenco()
     flash("✅ Lezione aggiunta con successo!")
     return redirect(url_for("admin_bp.dashboard"))
 
@@ -105,9 +118,10 @@ def add_classe():
 @admin_required
 @db_safe
 def delete_classe(classe_id):
-    db.execute(text("DELETE FROM prenotazioni WHERE classe_id=:cid"), {"cid": classe_id})
-    db.execute(text("DELETE FROM classi WHERE id=:cid"), {"cid": classe_id})
-    db.commit()
+    with unit_of_work():
+        db.execute(ELIMINA_PRENOTAZIONI_CLASSE_SQL, {"cid": classe_id})
+        db.execute(text("DELETE FROM classi WHERE id=:cid"), {"cid": classe_id})
+    invalida_elenco()
     flash("🗑️ Lezione eliminata con successo!")
     return redirect(url_for("admin_bp.dashboard"))
 
@@ -119,17 +133,77 @@ def edit_classe(classe_id):
         data = request.form["data"]
         ora = request.form["ora"]
         max_posti = request.form["max_posti"]
-        db.execute(
-            text("UPDATE classi SET data=:data, ora=:ora, max_posti=:max_posti WHERE id=:cid"),
-            {"data": data, "ora": ora, "max_posti": max_posti, "cid": classe_id}
-        )
-        db.commit()
+        with unit_of_work():
+            db.execute(
+                text("UPDATE classi SET data=:data, ora=:ora, max_posti=:max_posti WHERE id=:cid"),
+                {"data": data, "ora": ora, "max_posti": max_posti, "cid": classe_id}
+            )
+            # se max_posti è aumentato, i nuovi posti vanno ai primi in lista d'attesa
+            promuovi_lista_attesa(classe_id)
+        invalida_elenco()
         flash("✏️ Lezione modificata con successo!")
         return redirect(url_for("admin_bp.dashboard"))
 
     classe = db.execute(text("SELECT * FROM classi WHERE id=:cid"), {"cid": classe_id}).fetchone()
     return render_template("edit_classe.html", classe=classe)
 
+# ----------------- SERIE RICORRENTI -----------------
+@admin_bp.route("/serie")
+@admin_required
+@read_only
+def admin_serie():
+    return render_template("admin_serie.html", serie=elenco_serie(), giorni_settimana=GIORNI_SETTIMANA)
+
+@admin_bp.route("/serie", methods=["POST"])
+@admin_required
+@db_safe
+def add_serie():
+    giorni = [int(g) for g in request.form.getlist("giorni") if g.isdigit() and int(g) < 7]
+    data_inizio = parse_data(request.form.get("data_inizio"))
+    data_fine = parse_data(request.form.get("data_fine"))
+    # date escluse separate da virgole, spazi o a capo
+    escluse_raw = request.form.get("escluse", "").replace(",", " ").split()
+    escluse = [parse_data(d) for d in escluse_raw]
+    if not giorni or not data_inizio or not data_fine or None in escluse:
+        flash("❌ Indica almeno un giorno, un periodo valido e date escluse nel formato AAAA-MM-GG.")
+        return redirect(url_for("admin_bp.admin_serie"))
+    if data_fine < data_inizio:
+        flash("❌ La data di fine precede quella di inizio.")
+        return redirect(url_for("admin_bp.admin_serie"))
+
+    try:
+        with unit_of_work():
+            serie_id, n = crea_serie(giorni, request.form["ora"], data_inizio, data_fine,
+                                     request.form["max_posti"], escluse)
+    except ValueError as e:
+        flash(f"❌ {e}")
+        return redirect(url_for("admin_bp.admin_serie"))
+    invalida_elenco()
+    flash(f"✅ Serie creata: {n} lezioni aggiunte.")
+    return redirect(url_for("admin_bp.admin_serie"))
+
+@admin_bp.route("/serie/<int:serie_id>/edit", methods=["POST"])
+@admin_required
+@db_safe
+def edit_serie(serie_id):
+    ambito = TUTTE if request.form.get("ambito") == TUTTE else FUTURE
+    with unit_of_work():
+        n = modifica_serie(serie_id, request.form["ora"], request.form["max_posti"], ambito)
+    invalida_elenco()
+    flash(f"✏️ Serie modificata: {n} lezioni aggiornate.")
+    return redirect(url_for("admin_bp.admin_serie"))
+
+@admin_bp.route("/serie/<int:serie_id>/delete", methods=["POST"])
+@admin_required
+@db_safe
+def delete_serie(serie_id):
+    ambito = TUTTE if request.form.get("ambito") == TUTTE else FUTURE
+    with unit_of_work():
+        n = elimina_serie(serie_id, ambito)
+    invalida_elenco()
+    flash(f"🗑️ Serie eliminata: {n} lezioni rimosse.")
+    return redirect(url_for("admin_bp.admin_serie"))
+
 # ----------------- GESTIONE UTENTI -----------------
 import uuid
 
@@ -143,15 +217,19 @@ def validate_uuid4(uuid_string):
 
 @admin_bp.route("/users")
 @admin_required
+@read_only
 def admin_users():
-    users = db.execute(text("""
-        SELECT id,nome,cognome,email,telefono,username,stato,
-               data_nascita,luogo_nascita,indirizzo,citta,comune,cap
-        FROM utenti
-        ORDER BY stato DESC, cognome ASC, nome ASC
-    """)).fetchall()
+    users = db.execute(UTENTI_SQL).fetchall()
     return render_template("admin_users.html", users=users)
 
+def mail_approvazione(user):
+    """(destinatario, oggetto, corpo) della notifica di approvazione"""
+    return (
+        user.email,
+        "Account approvato",
+        f"Ciao {user.nome} {user.cognome},\n\nIl tuo account (username: {user.username}) è stato approvato dall'admin.\nOra puoi accedere e prenotare le lezioni.\n\nGrazie!"
+    )
+
 @admin_bp.route("/users/<user_id>/approve")
 @admin_required
 @db_safe
@@ -159,16 +237,16 @@ def admin_users_approve(user_id):
     if not validate_uuid4(user_id):
         flash("❌ ID utente non valido")
         return redirect(url_for("admin_bp.admin_users"))
-    db.execute(text("UPDATE utenti SET stato='attivo' WHERE id=:uid"), {"uid": str(validate_uuid4(user_id))})
-    db.commit()
-    supabase_admin.auth.admin.update_user_by_id(str(validate_uuid4(user_id)), {"email_confirmed": True})
-    user = db.execute(text("SELECT nome,cognome,email,username FROM utenti WHERE id=:uid"), {"uid": str(validate_uuid4(user_id))}).fetchone()
-    if user and user.email:
-        send_email_async(
-            user.email,
-            "Account approvato",
-            f"Ciao {user.nome} {user.cognome},\n\nIl tuo account (username: {user.username}) è stato approvato dall'admin.\nOra puoi accedere e prenotare le lezioni.\n\nGrazie!"
-        )
+    with unit_of_work():
+        user = db.execute(
+            text("UPDATE utenti SET stato='attivo' WHERE id=:uid RETURNING nome,cognome,email,username"),
+            {"uid": str(validate_uuid4(user_id))}
+        ).fetchone()
+        accoda_sync(str(validate_uuid4(user_id)))
+        if user and user.email:
+            accoda_email(*mail_approvazione(user))
+    # gli altri processi ricevono la NOTIFY del trigger, questo si aggiorna subito
+    invalida_stato(validate_uuid4(user_id))
     flash("✅ Utente approvato e notifica inviata via mail.")
     return redirect(url_for("admin_bp.admin_users"))
 
@@ -179,9 +257,11 @@ def admin_users_suspend(user_id):
     if not validate_uuid4(user_id):
         flash("❌ ID utente non valido")
         return redirect(url_for("admin_bp.admin_users"))    
-    db.execute(text("UPDATE utenti SET stato='sospeso' WHERE id=:uid"), {"uid": str(validate_uuid4(user_id))})
-    db.commit()
-    supabase_admin.auth.admin.update_user_by_id(str(validate_uuid4(user_id)), {"disabled": True})
+    with unit_of_work():
+        db.execute(text("UPDATE utenti SET stato='sospeso' WHERE id=:uid"), {"uid": str(validate_uuid4(user_id))})
+        accoda_sync(str(validate_uuid4(user_id)))
+    invalida_stato(validate_uuid4(user_id))
+    revoca_sessioni(current_app, [validate_uuid4(user_id)])
     flash("⏸️ Utente sospeso.")
     return redirect(url_for("admin_bp.admin_users"))
 
@@ -192,13 +272,177 @@ def admin_users_delete(user_id):
     if not validate_uuid4(user_id):
         flash("❌ ID utente non valido")
         return redirect(url_for("admin_bp.admin_users"))    
-    db.execute(text("DELETE FROM prenotazioni WHERE user_id=:uid"), {"uid": str(validate_uuid4(user_id))})
-    db.execute(text("DELETE FROM utenti WHERE id=:uid"), {"uid": str(validate_uuid4(user_id))})
-    db.commit()
-    supabase_admin.auth.admin.delete_user(str(validate_uuid4(user_id)))
+    with unit_of_work():
+        classi_liberate = rilascia_posti_utenti([validate_uuid4(user_id)])
+        db.execute(ELIMINA_PRENOTAZIONI_UTENTI_SQL, {"ids": [str(validate_uuid4(user_id))]})
+        db.execute(text("DELETE FROM utenti WHERE id=:uid"), {"uid": str(validate_uuid4(user_id))})
+        accoda_sync(str(validate_uuid4(user_id)))
+        for classe_id in classi_liberate:
+            promuovi_lista_attesa(classe_id)
+    invalida_stato(validate_uuid4(user_id))
+    revoca_sessioni(current_app, [validate_uuid4(user_id)])  # su Postgres già sparite in cascata, su Redis no
+    invalida_elenco()  # posti delle sue prenotazioni liberati
     flash("🗑️ Utente eliminato (e prenotazioni rimosse).")
     return redirect(url_for("admin_bp.admin_users"))
 
+# ----------------- OPERAZIONI MASSIVE SU UTENTI -----------------
+AZIONI_BULK = {
+    "approve": ("approvato", "già attivo"),
+    "suspend": ("sospeso", "già sospeso"),
+    "delete": ("eliminato", None),
+}
+
+@admin_bp.route("/users/bulk", methods=["POST"])
+@admin_required
+@db_safe
+def admin_users_bulk():
+    azione = request.form.get("azione")
+    if azione not in AZIONI_BULK:
+        flash("❌ Azione non valida")
+        return redirect(url_for("admin_bp.admin_users"))
+
+    richiesti = request.form.getlist("ids")
+    validi = [str(u) for u in map(validate_uuid4, richiesti) if u]
+    if not validi:
+        flash("Nessun utente selezionato.")
+        return redirect(url_for("admin_bp.admin_users"))
+
+    # un solo statement per l'intero blocco, nella stessa transazione di outbox e job Auth
+    with unit_of_work():
+        if azione == "approve":
+            rows = db.execute(
+                text("""
+                    UPDATE utenti SET stato='attivo'
+                    WHERE id = ANY(CAST(:ids AS uuid[])) AND stato <> 'attivo'
+                    RETURNING id, nome, cognome, email, username
+                """),
+                {"ids": validi}
+            ).fetchall()
+            accoda_email_batch([mail_approvazione(u) for u in rows if u.email])
+        elif azione == "suspend":
+            rows = db.execute(
+                text("""
+                    UPDATE utenti SET stato='sospeso'
+                    WHERE id = ANY(CAST(:ids AS uuid[])) AND stato <> 'sospeso'
+                    RETURNING id
+                """),
+                {"ids": validi}
+            ).fetchall()
+        else:
+            classi_liberate = rilascia_posti_utenti(validi)
+            db.execute(ELIMINA_PRENOTAZIONI_UTENTI_SQL, {"ids": validi})
+            rows = db.execute(
+                text("DELETE FROM utenti WHERE id = ANY(CAST(:ids AS uuid[])) RETURNING id"),
+                {"ids": validi}
+            ).fetchall()
+            for classe_id in classi_liberate:
+                promuovi_lista_attesa(classe_id)
+        modificati = {str(r.id) for r in rows}
+        accoda_sync_batch(sorted(modificati))
+
+        # per gli utenti non modificati: esistono (stato già corretto) o no?
+        esistenti = {
+            str(r.id) for r in db.execute(
+                text("SELECT id FROM utenti WHERE id = ANY(CAST(:ids AS uuid[]))"),
+                {"ids": [u for u in validi if u not in modificati]}
+            )
+        }
+
+    for uid in modificati:
+        invalida_stato(uid)
+    if azione in ("suspend", "delete"):
+        revoca_sessioni(current_app, sorted(modificati))
+    if azione == "delete":
+        invalida_elenco()  # posti delle prenotazioni liberati
+
+    fatto, invariato = AZIONI_BULK[azione]
+    risultati = []
+    for uid in richiesti:
+        u = validate_uuid4(uid)
+        if not u:
+            esito = "ID non valido"
+        elif str(u) in modificati:
+            esito = fatto
+        elif str(u) in esistenti and invariato:
+            esito = invariato
+        else:
+            esito = "non trovato"
+        risultati.append({"id": uid, "esito": esito})
+
+    flash(f"✅ Operazione completata: {len(modificati)} utenti {fatto}.")
+    return render_template("admin_users_bulk.html", risultati=risultati)
+
+# ----------------- EXPORT CSV / XLSX -----------------
+FORMATI_EXPORT = {
+    "csv": ("text/csv; charset=utf-8", genera_csv),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", genera_xlsx),
+}
+
+@admin_bp.route("/export/<nome>.<formato>")
+@admin_required
+def export(nome, formato):
+    if nome not in EXPORTS or formato not in FORMATI_EXPORT:
+        return "Export non disponibile", 404
+    if formato == "xlsx" and not xlsx_disponibile():
+        return "Export XLSX non disponibile: installare openpyxl", 501
+
+    classe = request.args.get("classe", type=int)
+    params = {
+        "classe": classe,
+        "da": parse_data(request.args.get("da")),
+        "a": parse_data(request.args.get("a")),
+    }
+    mimetype, genera = FORMATI_EXPORT[formato]
+    nome_file = f"{nome}-{classe}" if classe else f"{nome}-{date.today().isoformat()}"
+    # le righe arrivano dal cursore lato server mentre la risposta viene inviata
+    return Response(
+        genera(nome, params),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{nome_file}.{formato}"'}
+    )
+
+# ----------------- IMPORT CSV -----------------
+@admin_bp.route("/import", methods=["GET", "POST"])
+@admin_required
+@db_safe
+def admin_import():
+    if request.method == "GET":
+        return render_template("admin_import.html", tipi=TIPI_IMPORT, esito=None)
+
+    tipo = request.form.get("tipo")
+    file = request.files.get("file")
+    if tipo not in TIPI_IMPORT or not file or not file.filename:
+        flash("❌ Scegli il tipo di import e un file CSV.")
+        return redirect(url_for("admin_bp.admin_import"))
+
+    # il file viene letto e validato in streaming mentre COPY lo carica
+    testo = io.TextIOWrapper(file.stream, encoding="utf-8-sig", newline="")
+    try:
+        with unit_of_work():
+            esito = importa_csv(
+                tipo, testo,
+                tutto_o_niente=bool(request.form.get("tutto_o_niente")),
+                link_recupero=url_for("user_bp.recover_password", _external=True),
+            )
+    except (ValueError, UnicodeDecodeError) as e:
+        flash(f"❌ File non importato: {e}")
+        return redirect(url_for("admin_bp.admin_import"))
+    if tipo == "classi" and esito["importate"]:
+        invalida_elenco()
+    return render_template("admin_import.html", tipi=TIPI_IMPORT, esito=esito)
+
+# ----------------- STATISTICHE POOL -----------------
+@admin_bp.route("/pool")
+@admin_required
+def admin_pool_stats():
+    return jsonify(pool_stats(models.engine))
+
+# ----------------- STATISTICHE CACHE -----------------
+@admin_bp.route("/cache")
+@admin_required
+def admin_cache_stats():
+    return jsonify(cache_stats())
+
 # ----------------- LOGOUT ADMIN -----------------
 @admin_bp.route("/logout")
 def admin_logout():
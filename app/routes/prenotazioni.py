@@ -1,10 +1,18 @@
-from flask import Blueprint, session, redirect, url_for, flash
-from ..models import db
+import logging
+from flask import Blueprint, session, redirect, url_for, flash, request, jsonify, render_template
+from ..models import db, read_only, unit_of_work
+from ..booking import (prenota_classe, annulla_prenotazione, prenotazioni_utente,
+                       iscrivi_lista_attesa, esci_lista_attesa, CANCELLAZIONE_CUTOFF_ORE,
+                       PRENOTATA, PIENA, GIA_PRENOTATA, INESISTENTE, IN_ATTESA, POSTI_LIBERI,
+                       ANNULLATA, NON_PRENOTATA, FUORI_TEMPO)
+from ..cache import invalida_elenco
+from ..stato_utenti import stato_utente
+from ..limiti import limita, ammetti, utente_sessione, PRENOTA
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import text
 from functools import wraps
 
 prenotazioni_bp = Blueprint("prenotazioni_bp", __name__, url_prefix="/prenota")  # aggiunto url_prefix
+logger = logging.getLogger(__name__)
 
 # ----------------- DECORATOR DB SAFE -----------------
 def db_safe(f):
@@ -12,72 +20,126 @@ def db_safe(f):
     def wrapper(*args, **kwargs):
         try:
             return f(*args, **kwargs)
-        except IntegrityError as e:
+        except IntegrityError:
             db.rollback()
-            print("⚠️ IntegrityError:", e)
+            logger.warning("IntegrityError", exc_info=True)
             flash("Errore: dati già esistenti o non validi.")
             return redirect(url_for("user_bp.home"))
-        except Exception as e:
+        except Exception:
             db.rollback()
-            print("❌ Errore DB generico:", e)
+            logger.exception("Errore DB generico")
             flash("Si è verificato un errore. Riprova più tardi.")
             return redirect(url_for("user_bp.home"))
     return wrapper
 
 # ----------------- DECORATOR LOGIN UTENTE -----------------
+MESSAGGIO_LOGIN = "Devi effettuare il login per prenotare."
+MESSAGGIO_NON_ATTIVO = "Il tuo account non è ancora attivo. Attendi l’approvazione dell’admin."
+
 def user_login_required(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         if not session.get("user_id"):
-            flash("Devi effettuare il login per prenotare.")
+            flash(MESSAGGIO_LOGIN)
+            return redirect(url_for("user_bp.user_login"))
+        # stato letto dalla cache del processo, invalidata appena l'admin lo cambia
+        stato = stato_utente(session["user_id"])
+        if stato is None:
+            session.clear()  # utente eliminato
+            flash(MESSAGGIO_LOGIN)
             return redirect(url_for("user_bp.user_login"))
-        if session.get("user_status") != "attivo":
-            flash("Il tuo account non è ancora attivo. Attendi l’approvazione dell’admin.")
+        if stato != "attivo":
+            flash(MESSAGGIO_NON_ATTIVO)
             return redirect(url_for("user_bp.user_login"))
         return f(*args, **kwargs)
     return wrapper
 
 # ----------------- PRENOTA CLASSE -----------------
+MESSAGGI_PRENOTA = {
+    PRENOTATA: "✅ Prenotazione effettuata!",
+    PIENA: "Classe piena! Puoi iscriverti alla lista d'attesa: ti avviseremo per email se si libera un posto.",
+    GIA_PRENOTATA: "Hai già una prenotazione per questa classe.",
+    INESISTENTE: "Classe inesistente.",
+}
+
 @prenotazioni_bp.route("/<int:classe_id>", methods=["POST"])
+@limita("prenota", identita=utente_sessione)
 @user_login_required
+@ammetti(PRENOTA)
 @db_safe
 def prenota(classe_id):
-    user_id = session["user_id"]
+    with unit_of_work():
+        esito = prenota_classe(classe_id, session["user_id"])
+    if esito in (PRENOTATA, PIENA):
+        # posti cambiati (o l'elenco in cache mostrava ancora posti liberi)
+        invalida_elenco()
 
-    # Verifica esistenza classe
-    row = db.execute(
-        text("SELECT max_posti FROM classi WHERE id=:cid"),
-        {"cid": classe_id}
-        ).fetchone()
+    flash(MESSAGGI_PRENOTA[esito])
+    return redirect(url_for("user_bp.home"))
 
-    if not row:
-        flash("Classe inesistente.")
-        return redirect(url_for("user_bp.home"))
+# ----------------- ANNULLA PRENOTAZIONE -----------------
+MESSAGGI_ANNULLA = {
+    ANNULLATA: ("🗑️ Prenotazione annullata.", 200),
+    NON_PRENOTATA: ("Non hai una prenotazione per questa classe.", 404),
+    INESISTENTE: ("Classe inesistente.", 404),
+    FUORI_TEMPO: (f"Non è più possibile annullare: mancano meno di {CANCELLAZIONE_CUTOFF_ORE:g} ore alla lezione.", 409),
+}
 
-    max_posti = row.max_posti
+@prenotazioni_bp.route("/<int:classe_id>", methods=["DELETE"])
+@prenotazioni_bp.route("/<int:classe_id>/annulla", methods=["POST"])
+@user_login_required
+@db_safe
+def annulla(classe_id):
+    # posto liberato, contatore e promozione dalla lista d'attesa nella stessa transazione
+    with unit_of_work():
+        esito = annulla_prenotazione(classe_id, session["user_id"])
+    if esito == ANNULLATA:
+        invalida_elenco()
 
-    # Conta prenotazioni attuali
-    count = db.execute(
-        text("SELECT COUNT(*) AS n FROM prenotazioni WHERE classe_id=:cid"), {"cid": classe_id}
-        ).fetchone().n
+    messaggio, status = MESSAGGI_ANNULLA[esito]
+    if request.method == "DELETE":
+        return jsonify({"esito": esito, "messaggio": messaggio}), status
+    flash(messaggio)
+    return redirect(url_for("prenotazioni_bp.mie_prenotazioni"))
 
-    if count >= max_posti:
-        flash("Classe piena!")
-        return redirect(url_for("user_bp.home"))
+@prenotazioni_bp.route("/mie")
+@user_login_required
+@db_safe
+@read_only
+def mie_prenotazioni():
+    prenotate, in_attesa = prenotazioni_utente(session["user_id"])
+    return render_template(
+        "mie_prenotazioni.html",
+        prenotate=prenotate,
+        in_attesa=in_attesa,
+        cutoff_ore=f"{CANCELLAZIONE_CUTOFF_ORE:g}"
+    )
 
-    # Controllo prenotazione già esistente
-    already = db.execute(
-        text("SELECT 1 FROM prenotazioni WHERE user_id=:uid AND classe_id=:cid"),
-        {"uid": user_id, "cid": classe_id}
-        ).fetchone()
-    if already:
+# ----------------- LISTA D'ATTESA -----------------
+@prenotazioni_bp.route("/<int:classe_id>/attesa", methods=["POST"])
+@user_login_required
+@db_safe
+def iscrivi_attesa(classe_id):
+    with unit_of_work():
+        esito, posizione = iscrivi_lista_attesa(classe_id, session["user_id"])
+
+    if esito == INESISTENTE:
+        flash("Classe inesistente.")
+    elif esito == GIA_PRENOTATA:
         flash("Hai già una prenotazione per questa classe.")
-        return redirect(url_for("user_bp.home"))
-    
-    # Inserimento prenotazione
-    db.execute(text("INSERT INTO prenotazioni (user_id, classe_id) VALUES (:uid,:cid)"),
-            {"uid": user_id, "cid": classe_id}
-            )
-    db.commit()
-    flash("✅ Prenotazione effettuata!")
+    elif esito == POSTI_LIBERI:
+        flash("Ci sono ancora posti liberi: puoi prenotare direttamente.")
+    elif esito == IN_ATTESA:
+        flash(f"⏳ Sei in lista d'attesa (posizione {posizione}). Se si libera un posto verrai iscritto automaticamente e avvisato per email.")
+    else:
+        flash(f"Sei già in lista d'attesa (posizione {posizione}).")
+    return redirect(url_for("user_bp.home"))
+
+@prenotazioni_bp.route("/<int:classe_id>/attesa/annulla", methods=["POST"])
+@user_login_required
+@db_safe
+def esci_attesa(classe_id):
+    with unit_of_work():
+        rimosso = esci_lista_attesa(classe_id, session["user_id"])
+    flash("Sei uscito dalla lista d'attesa." if rimosso else "Non eri in lista d'attesa per questa classe.")
     return redirect(url_for("user_bp.home"))
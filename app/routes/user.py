@@ -1,18 +1,28 @@
+import logging
 import os
-from flask import Blueprint, render_template, request, redirect, session, url_for, flash
-from ..models import db
-from ..utils import hash_password, verify_password, send_email_async
+from flask import Blueprint, render_template, request, redirect, session, url_for, flash, make_response
+from ..models import db, unit_of_work
+from ..utils import hash_password, verify_password, needs_rehash, parse_data
+from ..outbox import accoda_email
+from ..auth_sync import accoda_sync
+from ..cache import elenco_classi, ultima_modifica
+from ..sessioni import nuovo_id_sessione
+from ..stato_utenti import stato_utente
+from ..limiti import limita
+from ..token_reset import crea_token, controlla_token, consuma_token
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy import text
-import secrets
-import traceback
-from datetime import datetime, timedelta, timezone
+import hashlib
+import uuid
 from functools import wraps
-from supabase import create_client
+from werkzeug.http import is_resource_modified
 
 user_bp = Blueprint("user_bp", __name__, url_prefix="/user")
+logger = logging.getLogger(__name__)
 
-supabase=create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY"))
+# query calde delle route, verificate anche da flask db explain (migrate.py)
+LOGIN_SQL = text("SELECT * FROM utenti WHERE username = :username")
+UTENTE_PER_EMAIL_SQL = text("SELECT id, username, email FROM utenti WHERE email = :email")
 
 # ----------------- DECORATORE GESTIONE ERRORI DB -----------------
 def handle_db_errors(f):
@@ -20,19 +30,16 @@ def handle_db_errors(f):
     def wrapper(*args, **kwargs):
         try:
             return f(*args, **kwargs)
-        except SQLAlchemyError as e:
+        except SQLAlchemyError:
             db.rollback()
-            print(f"❌ Errore DB in {f.__name__}: {str(e)}")
-            print(f"   Route corrente: {request.path}")
+            logger.exception("Errore DB in %s", f.__name__, extra={"path": request.path})
             if request.path == "/user/register":
                 flash("Si è verificato un errore durante la registrazione. Riprova.")
                 return redirect(url_for("user_bp.login"))  # o home, come preferisci
-            traceback.print_exc()
             flash("⚠️ Problema di connessione al database. Riprova più tardi.", "danger")
             return redirect(url_for("user_bp.home"))
-        except Exception as e:
-            print("❌ Errore generico in {f.__name__}: {str(e)}")
-            traceback.print_exc()
+        except Exception:
+            logger.exception("Errore generico in %s", f.__name__, extra={"path": request.path})
             flash("Si è verificato un errore. Controlla i log.", "danger")
             return redirect(url_for("user_bp.home"))
     return wrapper
@@ -41,32 +48,41 @@ def handle_db_errors(f):
 @user_bp.route("/")
 @handle_db_errors
 def home():
-    print("🚀 Home route chiamata")
-    classi = db.execute(text("SELECT * FROM classi ORDER BY data ASC, ora ASC")).fetchall()
-    prenotazioni_count = {}
-    for c in classi:
-        count = db.execute(
-            text("SELECT COUNT(*) AS n FROM prenotazioni WHERE classe_id=:cid"),
-            {"cid": c.id}
-        ).fetchone().n
-        prenotazioni_count[c.id] = count
-    return render_template(
-        "home.html",
-        classi=classi,
-        prenotazioni=prenotazioni_count,
-        user_id=session.get("user_id"),
-        user_status=session.get("user_status")
-    )
+    da = parse_data(request.args.get("da"))
+    a = parse_data(request.args.get("a"))
+    # elenco dalla cache (TTL breve): su un hit, con sessione e stato utente anch'essi in cache
+    # (sessioni.py, stato_utenti.py), nessuna connessione al database finché la sessione non cambia
+    elenco = elenco_classi(da=da, a=a, cursor=request.args.get("dopo"))
+    user_id = session.get("user_id")
+    user_status = stato_utente(user_id)
+
+    # la pagina cambia con i dati e con l'utente: l'ETag li comprende entrambi
+    etag = hashlib.sha1(f"{elenco['etag']}|{user_id}|{user_status}".encode("utf-8")).hexdigest()
+    last_modified = ultima_modifica(elenco)
+    # con messaggi flash in sospeso la pagina va sempre renderizzata, altrimenti andrebbero persi
+    if not session.get("_flashes") and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response("", 304)
+    else:
+        response = make_response(render_template(
+            "home.html",
+            classi=elenco["righe"],
+            da=da,
+            a=a,
+            next_cursor=elenco["next_cursor"],
+            user_id=user_id,
+            user_status=user_status
+        ))
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # il browser rivalida sempre (304 se nulla è cambiato)
+    return response
 
 # ----------------- REGISTRAZIONE -----------------
 @user_bp.route("/register", methods=["GET", "POST"])
 @handle_db_errors
 def register():
-    print("✅ Register route chiamata", request.method)
     if request.method == "POST":
-
-        print("💡 Inizio registrazione")  # debug iniziale
-
         nome = request.form["nome"].strip()
         cognome = request.form["cognome"].strip()
         data_nascita = request.form["data_nascita"]
@@ -81,78 +97,63 @@ def register():
         password = request.form["password"]
         consenso_privacy = request.form.get("consenso_privacy") == "on"
 
-        print("💡 Dati letti:", nome, cognome, email, username, consenso_privacy)
+        logger.debug("Registrazione: dati letti", extra={"username": username, "consenso_privacy": consenso_privacy})
 
         if not consenso_privacy:
             flash("Devi acconsentire al trattamento dei dati per proseguire.")
             return redirect(url_for("user_bp.register"))
 
         password_hash = hash_password(password)
-        print("💡 Password hash generata")
 
         try:
-            # 1️⃣ Crea utente su Supabase Auth
-            auth_response = supabase.auth.sign_up({
-                "email": email,
-                "password": password
-            })
-
-            if auth_response.user is None:
-                flash("Errore durante la creazione dell'utente Auth")
-                return redirect(url_for("user.register"))
-
-            user_id = auth_response.user.id  # ID generato da Supabase
-            print("💡 ID generato su Supabase")
-
-            db.execute(
-                text("""
-                    INSERT INTO utenti (
-                        id, nome, cognome, data_nascita, luogo_nascita, indirizzo, citta, comune, cap,
-                        email, telefono, username, password_hash, consenso_privacy, stato
-                    ) VALUES (
-                        :id, :nome, :cognome, :data_nascita, :luogo_nascita, :indirizzo, :citta, :comune, :cap,
-                        :email, :telefono, :username, :password_hash, :consenso_privacy, 'pending'
+            # ID generato localmente: l'utente Supabase Auth viene creato dal worker (auth_sync)
+            user_id = str(uuid.uuid4())
+
+            with unit_of_work():
+                db.execute(
+                    text("""
+                        INSERT INTO utenti (
+                            id, nome, cognome, data_nascita, luogo_nascita, indirizzo, citta, comune, cap,
+                            email, telefono, username, password_hash, consenso_privacy, stato
+                        ) VALUES (
+                            :id, :nome, :cognome, :data_nascita, :luogo_nascita, :indirizzo, :citta, :comune, :cap,
+                            :email, :telefono, :username, :password_hash, :consenso_privacy, 'pending'
+                        )
+                    """),
+                    {
+                        "id":user_id,
+                        "nome": nome,
+                        "cognome": cognome,
+                        "data_nascita": data_nascita,
+                        "luogo_nascita": luogo_nascita,
+                        "indirizzo": indirizzo,
+                        "citta": citta,
+                        "comune": comune,
+                        "cap": cap,
+                        "email": email,
+                        "telefono": telefono,
+                        "username": username,
+                        "password_hash": password_hash,
+                        "consenso_privacy": consenso_privacy
+                    }
+                )
+                accoda_sync(user_id)
+                # Mail admin (outbox, stessa transazione dell'utente)
+                admin_email = os.environ.get("ADMIN_EMAIL")
+                if admin_email:
+                    accoda_email(
+                        admin_email,
+                        "Nuova registrazione in attesa",
+                        f"Nuovo utente registrato:\n\nNome: {nome}\nCognome: {cognome}\nUsername: {username}\nEmail: {email}"
                     )
-                """),
-                {
-                    "id":user_id,
-                    "nome": nome,
-                    "cognome": cognome,
-                    "data_nascita": data_nascita,
-                    "luogo_nascita": luogo_nascita,
-                    "indirizzo": indirizzo,
-                    "citta": citta,
-                    "comune": comune,
-                    "cap": cap,
-                    "email": email,
-                    "telefono": telefono,
-                    "username": username,
-                    "password_hash": password_hash,
-                    "consenso_privacy": consenso_privacy
-                }
-            )
-            db.commit()
 
-            print("💡 Utente inserito nel DB")
+            logger.info("Nuova registrazione", extra={"user_id": user_id})
 
-        except Exception as e:
+        except Exception:
             db.rollback()
-            print("❌ Errore generico durante registrazione:", e)
+            logger.exception("Errore durante la registrazione")
             flash("Errore durante la registrazione. Contatta l'admin.")
             return redirect(url_for("user_bp.register"))
-        
-        # Mail admin
-        try:
-            admin_email = os.environ.get("ADMIN_EMAIL")
-            if admin_email:
-                send_email_async(
-                    admin_email,
-                    "Nuova registrazione in attesa",
-                    f"Nuovo utente registrato:\n\nNome: {nome}\nCognome: {cognome}\nUsername: {username}\nEmail: {email}"
-                )
-                print("💡 Mail inviata all'admin")
-        except Exception as e:
-            print("⚠️ Errore invio mail admin:", e)
 
         flash("✅ Registrazione inviata! Attendi l’approvazione dell’admin.")
         return redirect(url_for("user_bp.user_login"))
@@ -161,16 +162,14 @@ def register():
 
 # ----------------- LOGIN UTENTE -----------------
 @user_bp.route("/login", methods=["GET", "POST"])
+@limita("login", identita=lambda: request.form.get("username"))
 @handle_db_errors
 def user_login():
     if request.method == "POST":
         username = request.form["username"].strip()
         password = request.form["password"]
 
-        user = db.execute(
-            text("SELECT * FROM utenti WHERE username=:username"),
-            {"username": username}
-        ).fetchone()
+        user = db.execute(LOGIN_SQL, {"username": username}).fetchone()
 
         if not user or not verify_password(user.password_hash, password):
             flash("Credenziali non valide.")
@@ -180,9 +179,17 @@ def user_login():
             flash("Account non attivo. Attendi l’approvazione dell’admin.")
             return redirect(url_for("user_bp.user_login"))
 
+        # hash con parametri superati: si aggiorna ora che abbiamo la password in chiaro
+        if needs_rehash(user.password_hash):
+            with unit_of_work():
+                db.execute(
+                    text("UPDATE utenti SET password_hash = :pw WHERE id = :id"),
+                    {"pw": hash_password(password), "id": user.id}
+                )
+
+        nuovo_id_sessione(session)
         session["user_id"] = user.id
         session["username"] = user.username
-        session["user_status"] = user.stato
         flash(f"Benvenuto, {user.nome}!")
         return redirect(url_for("user_bp.home"))
 
@@ -193,28 +200,29 @@ def user_login():
 def user_logout():
     session.pop("user_id", None)
     session.pop("username", None)
-    session.pop("user_status", None)
     flash("Logout effettuato.")
     return redirect(url_for("user_bp.home"))
 
 # ----------------- RECUPERO USERNAME UTENTE -----------------
 @user_bp.route("/recover_username", methods=["GET", "POST"])
+@limita("recupero", identita=lambda: request.form.get("email"))
 @handle_db_errors
 def recover_username():
     if request.method == "POST":
         email = request.form["email"].strip().lower()
-        user = db.execute(text("SELECT username FROM utenti WHERE email=:email"), {"email": email}).fetchone()
+        user = db.execute(UTENTE_PER_EMAIL_SQL, {"email": email}).fetchone()
 
         if not user:
             flash("Nessun utente trovato con questa email.")
             return redirect(url_for("user_bp.recover_username"))
 
         # Invio mail
-        send_email_async(
-            email,
-            "Recupero username",
-            f"Ciao! Il tuo username è: {user.username}"
-        )
+        with unit_of_work():
+            accoda_email(
+                email,
+                "Recupero username",
+                f"Ciao! Il tuo username è: {user.username}"
+            )
         flash("✅ Ti abbiamo inviato una mail con il tuo username.")
         return redirect(url_for("user_bp.user_login"))
 
@@ -222,51 +230,34 @@ def recover_username():
 
 # ----------------- RESET PASSWORD UTENTE (GENERA TOKEN) -----------------
 @user_bp.route("/recover_password", methods=["GET", "POST"])
+@limita("recupero", identita=lambda: request.form.get("email"))
 @handle_db_errors
 def recover_password():
     if request.method == "POST":
         email = request.form.get("email", "").strip().lower()
         try:
-            user = db.execute(
-                text("SELECT id, username, email FROM utenti WHERE email = :email"),
-                {"email": email}
-            ).fetchone()
+            user = db.execute(UTENTE_PER_EMAIL_SQL, {"email": email}).fetchone()
 
             if not user:
                 flash("Nessun account trovato con questa email.")
                 return redirect(url_for("user_bp.recover_password"))
 
-            # genera token + scadenza (1 ora)
-            token = secrets.token_urlsafe(32)
-            expiry = datetime.now(timezone.utc) + timedelta(hours=1)
-
-            # salva nel DB
-            db.execute(
-                text("UPDATE utenti SET reset_token = :token, reset_token_expiry = :expiry WHERE id = :id"),
-                {"token": token, "expiry": expiry, "id": user.id}
-            )
-            db.commit()
-
-            # link assoluto
-            reset_link = url_for("user_bp.reset_password", token=token, _external=True)
-
-            # invio mail (non deve far fallire la route)
-            try:
-                send_email_async(
+            # salva l'hash del token (scade tra 1 ora) e accoda la mail nella stessa transazione
+            with unit_of_work():
+                token = crea_token(user.id)
+                # link assoluto
+                reset_link = url_for("user_bp.reset_password", token=token, _external=True)
+                accoda_email(
                     user.email,
                     "Reimposta la tua password",
                     f"Ciao {user.username},\n\nPer reimpostare la password clicca qui:\n{reset_link}\n\nIl link scade tra 1 ora."
                 )
-            except Exception as e:
-                print("❌ Errore invio mail (recover_password):", e)
-                traceback.print_exc()  # utile per debug, controlla i log
 
             flash("Se l'email esiste, abbiamo inviato il link per reimpostare la password.")
             return redirect(url_for("user_bp.user_login"))
 
-        except Exception as e:
-            print("❌ Errore in recover_password:", e)
-            traceback.print_exc()
+        except Exception:
+            logger.exception("Errore in recover_password")
             flash("Si è verificato un errore. Controlla i log.")
             return redirect(url_for("user_bp.recover_password"))
 
@@ -274,29 +265,16 @@ def recover_password():
 
 # ----------------- RESET PASSWORD UTENTE (CREA NUOVA PASSWORD) -----------------
 @user_bp.route("/reset_password/<token>", methods=["GET", "POST"])
+@limita("reset")
 @handle_db_errors
 def reset_password(token):
     try:
-        user = db.execute(
-            text("SELECT id, reset_token_expiry FROM utenti WHERE reset_token = :token"),
-            {"token": token}
-        ).fetchone()
-
-        if not user:
+        # lettura per chiave primaria: un token inventato o scaduto non arriva all'hash della password
+        row = controlla_token(token)
+        if not row:
             flash("Token non valido o già usato.")
             return redirect(url_for("user_bp.recover_password"))
-
-        expiry = user.reset_token_expiry
-        now = datetime.now(timezone.utc)
-
-        # gestione naive/aware
-        if expiry is None:
-            flash("Token non valido.")
-            return redirect(url_for("user_bp.recover_password"))
-        if expiry.tzinfo is None:
-            expiry = expiry.replace(tzinfo=timezone.utc)
-
-        if now > expiry:
+        if not row.valido:
             flash("Il link per reimpostare la password è scaduto.")
             return redirect(url_for("user_bp.recover_password"))
 
@@ -307,18 +285,24 @@ def reset_password(token):
                 return redirect(url_for("user_bp.reset_password", token=token))
 
             pw_hash = hash_password(new_pw)
-            db.execute(
-                text("UPDATE utenti SET password_hash = :pw, reset_token = NULL, reset_token_expiry = NULL WHERE id = :id"),
-                {"pw": pw_hash, "id": user.id}
-            )
-            db.commit()
+            # verifica e consuma il token nella transazione che cambia la password
+            # (due richieste concorrenti con lo stesso token: solo una lo trova)
+            with unit_of_work():
+                user_id = consuma_token(token)
+                if user_id is not None:
+                    db.execute(
+                        text("UPDATE utenti SET password_hash = :pw WHERE id = :id"),
+                        {"pw": pw_hash, "id": user_id}
+                    )
+            if user_id is None:
+                flash("Token non valido, già usato o scaduto.")
+                return redirect(url_for("user_bp.recover_password"))
             flash("✅ Password aggiornata. Ora puoi effettuare il login.")
             return redirect(url_for("user_bp.user_login"))
 
         return render_template("reset_password.html", token=token)
 
-    except Exception as e:
-        print("❌ Errore in reset_password:", e)
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Errore in reset_password")
         flash("Si è verificato un errore. Controlla i log.")
         return redirect(url_for("user_bp.recover_password"))
@@ -0,0 +1,131 @@
+import os
+from datetime import date, timedelta
+from sqlalchemy import text
+from . import models
+from .booking import promuovi_lista_attesa
+
+# Limite di sicurezza alle occorrenze generate da una sola serie (~2 anni a 5 lezioni/settimana)
+SERIE_MAX_OCCORRENZE = int(os.environ.get("SERIE_MAX_OCCORRENZE", "500"))
+GIORNI_SETTIMANA = ["Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom"]  # indice = date.weekday()
+
+# Ambito di modifica/eliminazione
+TUTTE = "tutte"
+FUTURE = "future"
+
+# ----------------- ESPANSIONE -----------------
+def espandi_occorrenze(giorni, data_inizio, data_fine, escluse=()):
+    """Date tra data_inizio e data_fine (incluse) che cadono nei giorni indicati, tolte le escluse"""
+    giorni = set(giorni)
+    escluse = set(escluse)
+    # primo giorno utile per ogni giorno della settimana, poi passi di 7 giorni
+    date_serie = []
+    for offset in range(7):
+        giorno = data_inizio + timedelta(days=offset)
+        if giorno.weekday() not in giorni:
+            continue
+        while giorno <= data_fine:
+            if giorno not in escluse:
+                date_serie.append(giorno)
+            giorno += timedelta(days=7)
+    return sorted(date_serie)
+
+# ----------------- CREAZIONE -----------------
+# Serie e tutte le occorrenze con un solo statement (INSERT ... SELECT da unnest)
+CREA_SERIE_SQL = text("""
+    WITH s AS (
+        INSERT INTO serie (giorni, ora, data_inizio, data_fine, max_posti, escluse)
+        VALUES (CAST(:giorni AS smallint[]), :ora, :data_inizio, :data_fine, :max_posti, CAST(:escluse AS date[]))
+        RETURNING id
+    ), occorrenze AS (
+        INSERT INTO classi (data, ora, max_posti, serie_id)
+        SELECT d, :ora, :max_posti, s.id
+        FROM s, unnest(CAST(:date AS date[])) AS d
+        RETURNING id
+    )
+    SELECT (SELECT id FROM s) AS serie_id, (SELECT COUNT(*) FROM occorrenze) AS occorrenze
+""")
+
+def crea_serie(giorni, ora, data_inizio, data_fine, max_posti, escluse=()):
+    """
+    Crea la serie e le sue lezioni. Restituisce (serie_id, numero di occorrenze).
+    ValueError se i parametri non generano occorrenze o ne generano troppe.
+    Il commit spetta al chiamante (unit_of_work).
+    """
+    date_serie = espandi_occorrenze(giorni, data_inizio, data_fine, escluse)
+    if not date_serie:
+        raise ValueError("Nessuna lezione nel periodo indicato")
+    if len(date_serie) > SERIE_MAX_OCCORRENZE:
+        raise ValueError(f"Troppe lezioni ({len(date_serie)}), massimo {SERIE_MAX_OCCORRENZE}")
+    row = models.db.execute(CREA_SERIE_SQL, {
+        "giorni": sorted(set(giorni)),
+        "ora": ora,
+        "data_inizio": data_inizio,
+        "data_fine": data_fine,
+        "max_posti": max_posti,
+        "escluse": sorted(set(escluse)),
+        "date": date_serie,
+    }).fetchone()
+    return row.serie_id, row.occorrenze
+
+# ----------------- MODIFICA / ELIMINAZIONE -----------------
+def _da_data(ambito, oggi):
+    return (oggi or date.today()) if ambito == FUTURE else date.min
+
+def modifica_serie(serie_id, ora, max_posti, ambito=FUTURE, oggi=None):
+    """
+    Cambia ora e posti di tutte le occorrenze o solo di quelle da oggi in poi, con un solo UPDATE.
+    Se i posti aumentano, le classi con lista d'attesa promuovono i primi in coda.
+    Restituisce il numero di lezioni modificate; il commit spetta al chiamante.
+    """
+    rows = models.db.execute(
+        text("""
+            WITH s AS (
+                UPDATE serie SET ora = :ora, max_posti = :max_posti WHERE id = :sid
+            )
+            UPDATE classi c SET ora = :ora, max_posti = :max_posti
+            WHERE c.serie_id = :sid AND c.data >= :da
+            RETURNING c.id, EXISTS (SELECT 1 FROM lista_attesa la WHERE la.classe_id = c.id) AS con_attesa
+        """),
+        {"sid": serie_id, "ora": ora, "max_posti": max_posti, "da": _da_data(ambito, oggi)}
+    ).fetchall()
+    for r in rows:
+        if r.con_attesa:
+            promuovi_lista_attesa(r.id)
+    return len(rows)
+
+def elimina_serie(serie_id, ambito=FUTURE, oggi=None):
+    """
+    Elimina tutte le occorrenze (e la serie) o solo quelle da oggi in poi, con un solo statement.
+    Nel secondo caso la serie finisce il giorno prima (data_fine), o sparisce se non le
+    resta nessuna lezione. Prenotazioni e liste d'attesa delle lezioni eliminate vanno via in cascata.
+    Restituisce il numero di lezioni eliminate; il commit spetta al chiamante.
+    """
+    return models.db.execute(
+        text("""
+            WITH occorrenze AS (
+                DELETE FROM classi WHERE serie_id = :sid AND data >= :da
+                RETURNING id
+            ), s AS (
+                DELETE FROM serie WHERE id = :sid AND (:tutte OR data_inizio >= :da)
+            ), accorciata AS (
+                UPDATE serie SET data_fine = LEAST(data_fine, CAST(:da AS date) - 1)
+                WHERE id = :sid AND NOT :tutte AND data_inizio < :da
+            )
+            SELECT COUNT(*) FROM occorrenze
+        """),
+        {"sid": serie_id, "da": _da_data(ambito, oggi), "tutte": ambito == TUTTE}
+    ).scalar()
+
+def elenco_serie():
+    """Serie con numero di occorrenze totali e future, per la pagina admin"""
+    return models.db.execute(
+        text("""
+            SELECT s.id, s.giorni, s.ora, s.data_inizio, s.data_fine, s.max_posti, s.escluse,
+                   COUNT(c.id) AS occorrenze,
+                   COUNT(c.id) FILTER (WHERE c.data >= CURRENT_DATE) AS future
+            FROM serie s
+            LEFT JOIN classi c ON c.serie_id = s.id
+            GROUP BY s.id
+            ORDER BY s.data_inizio DESC, s.id DESC
+        """)
+    ).fetchall()
@@ -0,0 +1,304 @@
+import hashlib
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from sqlalchemy import text
+from werkzeug.datastructures import CallbackDict
+from . import models, stato_utenti
+
+logger = logging.getLogger(__name__)
+
+# ----------------- CONFIGURAZIONE -----------------
+# SESSION_BACKEND=postgres -> tabella sessioni (default), nel cookie solo un id casuale
+# SESSION_BACKEND=redis    -> Redis locale (pacchetto "redis" richiesto), con REDIS_URL
+# SESSION_BACKEND=cookie   -> cookie firmato di Flask (nessuna revoca lato server)
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "postgres").lower()
+# la scadenza lato server si allunga al massimo una volta ogni SESSION_REFRESH_SECONDI,
+# non a ogni richiesta: una sessione solo letta non genera scritture
+SESSION_REFRESH_SECONDI = int(os.environ.get("SESSION_REFRESH_SECONDI", "3600"))
+SESSION_PULIZIA_SECONDI = 600  # ogni quanto un processo cancella un blocco di sessioni scadute
+SESSION_PULIZIA_BLOCCO = 1000
+# con SESSION_BACKEND=postgres le sessioni lette restano nella memoria del processo:
+# una richiesta con il cookie non rilegge la tabella (vedi CACHE NEL PROCESSO)
+SESSION_CACHE = os.environ.get("SESSION_CACHE", "true").lower() == "true"
+SESSION_CACHE_MAX_ENTRIES = int(os.environ.get("SESSION_CACHE_MAX_ENTRIES", "50000"))
+
+def hash_sid(sid):
+    return hashlib.sha256(sid.encode("utf-8")).hexdigest()
+
+# ----------------- CACHE NEL PROCESSO -----------------
+# Coerente tra processi grazie al canale di stato_utenti.py: il trigger su sessioni
+# (migrazione 0009) notifica "sessione:<id>:<md5 dei dati>" a ogni aggiornamento e
+# "sessione:<id>" a ogni cancellazione. Una sessione in cache con gli stessi dati resta
+# (è la scrittura appena fatta da questo processo), le altre vengono tolte. Finché
+# l'ascolto non è attivo la cache non viene usata.
+NOTIFICA_PREFISSO = "sessione:"
+
+_lock = threading.Lock()
+_cache = {}  # sha256 del sid -> (dati, scadenza)
+_gen = 0  # come in stato_utenti.py: un caricamento iniziato prima di un'invalidazione non viene salvato
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def generazione():
+    """Generazione corrente da passare a memorizza(), None se la cache non è attiva"""
+    if not SESSION_CACHE or not stato_utenti.in_ascolto():
+        return None
+    with _lock:
+        return _gen
+
+def da_cache(chiave):
+    """((dati, scadenza) o None, generazione); usate anche dalla modalità asincrona"""
+    gen = generazione()
+    if gen is None:
+        return None, None
+    with _lock:
+        trovata = _cache.get(chiave)
+        if trovata is not None and trovata[1] <= datetime.now(timezone.utc):
+            del _cache[chiave]
+            trovata = None
+        _stats["hits" if trovata is not None else "misses"] += 1
+        return trovata, _gen
+
+def memorizza(chiave, trovata, gen):
+    with _lock:
+        if gen is not None and gen == _gen and trovata is not None:
+            if chiave not in _cache and len(_cache) >= SESSION_CACHE_MAX_ENTRIES:
+                _cache.pop(next(iter(_cache)))
+            _cache[chiave] = trovata
+
+def invalida_sessione(notifica=None):
+    """Dalle notifiche ("<id>" o "<id>:<md5>") e dalle cancellazioni locali; None svuota tutto"""
+    global _gen
+    chiave, _, md5 = (notifica or "").partition(":")
+    with _lock:
+        _gen += 1
+        _stats["invalidations"] += 1
+        if notifica is None:
+            _cache.clear()
+            return
+        trovata = _cache.get(chiave)
+        if trovata is not None and (not md5 or hashlib.md5(trovata[0].encode("utf-8")).hexdigest() != md5):
+            del _cache[chiave]
+
+def sessioni_cache_stats():
+    with _lock:
+        return dict(_stats, entries=len(_cache))
+
+stato_utenti.registra_invalidazione(NOTIFICA_PREFISSO, invalida_sessione)
+
+# ----------------- SESSIONE -----------------
+class SessioneServer(CallbackDict, SessionMixin):
+    def __init__(self, dati=None, sid=None, scadenza=None):
+        def on_update(s):
+            s.modified = True
+        super().__init__(dati, on_update)
+        self.sid = sid
+        self.scadenza = scadenza
+        self.new = sid is None
+        self.modified = False
+        self.ruota = False
+
+def nuovo_id_sessione(session):
+    """Al login: stessa sessione con un id nuovo, quello vecchio non vale più (session fixation)"""
+    if isinstance(session, SessioneServer):
+        session.ruota = True
+        session.modified = True
+
+# ----------------- INTERFACCIA COMUNE -----------------
+class _SessioniServer(SessionInterface):
+    serializer = session_json_serializer
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            trovata = self.carica(hash_sid(sid))
+            if trovata is not None:
+                dati, scadenza = trovata
+                return SessioneServer(self.serializer.loads(dati), sid, scadenza)
+        return SessioneServer()
+
+    def save_session(self, app, session, response):
+        nome = self.get_cookie_name(app)
+        dominio = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session:
+            # sessione svuotata (logout): via la riga e il cookie
+            if session.sid:
+                self.elimina(hash_sid(session.sid))
+                response.delete_cookie(nome, domain=dominio, path=path)
+            return
+
+        scadenza = self.da_salvare(app, session)
+        if scadenza is None:
+            return
+
+        if session.ruota and session.sid:
+            self.elimina(hash_sid(session.sid))
+            session.sid = None
+        nuovo_cookie = session.sid is None
+        if nuovo_cookie:
+            session.sid = secrets.token_urlsafe(32)
+        user_id = session.get("user_id")
+        try:
+            self.salva(hash_sid(session.sid), str(user_id) if user_id else None,
+                       self.serializer.dumps(dict(session)), scadenza)
+        except Exception:
+            # es. utente eliminato nel frattempo (FK): la risposta parte comunque
+            logger.exception("Salvataggio sessione non riuscito")
+            return
+
+        if nuovo_cookie or session.permanent:
+            response.set_cookie(
+                nome, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=dominio,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+    def da_salvare(self, app, session):
+        """Nuova scadenza se la sessione va scritta, None se è stata solo letta e non va ancora rinnovata"""
+        adesso = datetime.now(timezone.utc)
+        da_rinnovare = session.scadenza is None or \
+            session.scadenza - adesso < app.permanent_session_lifetime - timedelta(seconds=SESSION_REFRESH_SECONDI)
+        if session.modified or session.new or da_rinnovare:
+            return adesso + app.permanent_session_lifetime
+        return None
+
+    def crea_sessione(self, app, dati):
+        """Sessione creata direttamente (bench e strumenti): restituisce il valore del cookie"""
+        sid = secrets.token_urlsafe(32)
+        self.salva(hash_sid(sid), str(dati["user_id"]) if dati.get("user_id") else None,
+                   self.serializer.dumps(dati), datetime.now(timezone.utc) + app.permanent_session_lifetime)
+        return sid
+
+# ----------------- POSTGRES -----------------
+class PostgresSessioni(_SessioniServer):
+    """
+    Tabella sessioni (migrazione 0005), su connessioni proprie: lettura e salvataggio
+    non fanno parte della transazione della route. Le letture passano dalla cache del processo.
+    """
+    # usati anche dalla modalità asincrona (asincrono.py) con l'engine asyncpg
+    CARICA_SQL = text("SELECT dati, scadenza FROM sessioni WHERE id = :id AND scadenza > now()")
+    SALVA_SQL = text("""
+        INSERT INTO sessioni (id, user_id, dati, scadenza)
+        VALUES (:id, CAST(:uid AS uuid), :dati, :scadenza)
+        ON CONFLICT (id) DO UPDATE
+        SET user_id = EXCLUDED.user_id, dati = EXCLUDED.dati, scadenza = EXCLUDED.scadenza
+    """)
+    ELIMINA_SQL = text("DELETE FROM sessioni WHERE id = :id")
+    REVOCA_SQL = text("DELETE FROM sessioni WHERE user_id = ANY(CAST(:ids AS uuid[]))")
+    PULIZIA_SQL = text("""
+        DELETE FROM sessioni WHERE id IN (
+            SELECT id FROM sessioni WHERE scadenza < now() LIMIT :n
+        )
+    """)
+
+    def __init__(self):
+        self.ultima_pulizia = time.monotonic()
+        self.lock = threading.Lock()
+
+    def carica(self, chiave):
+        trovata, gen = da_cache(chiave)
+        if trovata is None:
+            with models.engine.connect() as conn:
+                row = conn.execute(self.CARICA_SQL, {"id": chiave}).fetchone()
+            trovata = (row.dati, row.scadenza) if row else None
+            memorizza(chiave, trovata, gen)
+        return trovata
+
+    def salva(self, chiave, user_id, dati, scadenza):
+        # in cache prima del commit: la notifica della scrittura (stesso md5) la trova e la lascia
+        memorizza(chiave, (dati, scadenza), generazione())
+        try:
+            with models.engine.begin() as conn:
+                conn.execute(self.SALVA_SQL, {"id": chiave, "uid": user_id, "dati": dati, "scadenza": scadenza})
+        except Exception:
+            invalida_sessione(chiave)
+            raise
+        self._pulisci()
+
+    def elimina(self, chiave):
+        with models.engine.begin() as conn:
+            conn.execute(self.ELIMINA_SQL, {"id": chiave})
+        invalida_sessione(chiave)
+
+    def revoca(self, user_ids):
+        with models.engine.begin() as conn:
+            conn.execute(self.REVOCA_SQL, {"ids": user_ids})
+        # la cache non sa a chi appartengono le sessioni: in questo processo si svuota subito,
+        # negli altri arrivano le notifiche delle righe cancellate
+        invalida_sessione()
+
+    def _pulisci(self):
+        with self.lock:
+            if time.monotonic() - self.ultima_pulizia < SESSION_PULIZIA_SECONDI:
+                return
+            self.ultima_pulizia = time.monotonic()
+        with models.engine.begin() as conn:
+            conn.execute(self.PULIZIA_SQL, {"n": SESSION_PULIZIA_BLOCCO})
+
+# ----------------- REDIS -----------------
+class RedisSessioni(_SessioniServer):
+    """Chiave per sessione con TTL e un set per utente con le sue sessioni (per la revoca)"""
+    PREFIX = "fundbooking:sessione:"
+    PREFIX_UTENTE = "fundbooking:sessioni_utente:"
+
+    def __init__(self, url):
+        import redis  # dipendenza opzionale (requirements-extra.txt), solo con SESSION_BACKEND=redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+    def carica(self, chiave):
+        pipe = self.client.pipeline()
+        pipe.get(self.PREFIX + chiave)
+        pipe.pttl(self.PREFIX + chiave)
+        dati, ttl = pipe.execute()
+        if dati is None:
+            return None
+        return dati.decode("utf-8"), datetime.now(timezone.utc) + timedelta(milliseconds=max(ttl, 0))
+
+    def salva(self, chiave, user_id, dati, scadenza):
+        ttl = max(1, int((scadenza - datetime.now(timezone.utc)).total_seconds()))
+        pipe = self.client.pipeline()
+        pipe.set(self.PREFIX + chiave, dati, ex=ttl)
+        if user_id:
+            pipe.sadd(self.PREFIX_UTENTE + user_id, chiave)
+            pipe.expire(self.PREFIX_UTENTE + user_id, ttl)
+        pipe.execute()
+
+    def elimina(self, chiave):
+        self.client.delete(self.PREFIX + chiave)
+
+    def revoca(self, user_ids):
+        for uid in user_ids:
+            chiavi = self.client.smembers(self.PREFIX_UTENTE + uid)
+            self.client.delete(self.PREFIX_UTENTE + uid, *[self.PREFIX + c.decode("utf-8") for c in chiavi])
+
+# ----------------- REGISTRAZIONE -----------------
+def init_app(app):
+    if SESSION_BACKEND == "postgres":
+        app.session_interface = PostgresSessioni()
+    elif SESSION_BACKEND == "redis":
+        from .cache import REDIS_URL
+        app.session_interface = RedisSessioni(REDIS_URL)
+    # "cookie": resta l'interfaccia standard di Flask
+
+def revoca_sessioni(app, user_ids):
+    """Chiude tutte le sessioni degli utenti indicati (sospensione, eliminazione)"""
+    interfaccia = app.session_interface
+    if not isinstance(interfaccia, _SessioniServer) or not user_ids:
+        return
+    try:
+        interfaccia.revoca([str(u) for u in user_ids])
+    except Exception:
+        # lo stato in cache è già invalidato: l'utente sospeso non può comunque prenotare
+        logger.exception("Revoca sessioni non riuscita")
@@ -0,0 +1,164 @@
+import logging
+import os
+import select
+import threading
+import time
+from sqlalchemy import text
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# ----------------- CONFIGURAZIONE -----------------
+# Cache nel processo dello stato degli utenti (attivo/pending/sospeso), usata dai controlli
+# di login a ogni richiesta. Resta coerente perché ogni processo ascolta il canale
+# "stato_utenti" (trigger su utenti, migrazione 0005): finché l'ascolto non è attivo
+# la cache non viene usata e lo stato si legge dal database. Sullo stesso canale arrivano
+# anche le invalidazioni di altre cache del processo (es. sessioni.py), con un prefisso nel payload.
+STATO_CACHE = os.environ.get("STATO_CACHE", "true").lower() == "true"
+STATO_CACHE_MAX_ENTRIES = int(os.environ.get("STATO_CACHE_MAX_ENTRIES", "50000"))
+# LISTEN non funziona dietro PgBouncer/Supavisor in transaction mode: in quel caso
+# STATO_LISTEN_URL deve puntare alla connessione diretta (porta 5432)
+STATO_LISTEN_URL = os.environ.get("STATO_LISTEN_URL")
+CANALE = "stato_utenti"
+RICONNESSIONE_SECONDI = 5
+
+_lock = threading.Lock()
+_stati = {}  # user_id (str) -> stato
+_gen = 0  # incrementata a ogni invalidazione: un caricamento iniziato prima non viene salvato
+_in_ascolto = threading.Event()
+_listener = None
+_pid = None
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_invalidazioni = {}  # prefisso del payload -> funzione di invalidazione di un'altra cache
+
+# ----------------- ASCOLTO NOTIFY -----------------
+def registra_invalidazione(prefisso, funzione):
+    """
+    Le notifiche con payload che inizia per prefisso vanno a funzione(resto del payload)
+    invece che alla cache degli stati; funzione(None) quando va svuotato tutto (ascolto interrotto).
+    """
+    _invalidazioni[prefisso] = funzione
+
+def _notifica(payload):
+    for prefisso, funzione in _invalidazioni.items():
+        if payload.startswith(prefisso):
+            funzione(payload[len(prefisso):])
+            return
+    invalida_stato(payload)
+
+def _invalida_tutto():
+    invalida_stato()
+    for funzione in _invalidazioni.values():
+        funzione(None)
+
+def _url_ascolto():
+    from .database import database_url
+    # URL SQLAlchemy -> DSN libpq
+    return (STATO_LISTEN_URL or database_url()).replace("postgresql+psycopg2://", "postgresql://", 1)
+
+def _ascolta():
+    import psycopg2
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(_url_ascolto())
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {CANALE}")
+            # notifiche perse mentre non si ascoltava: si riparte da cache vuote
+            _invalida_tutto()
+            _in_ascolto.set()
+            logger.info("Cache stato utenti in ascolto su %s", CANALE)
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    conn.cursor().execute("SELECT 1")  # keepalive: scopre le connessioni cadute
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    _notifica(conn.notifies.pop(0).payload)
+        except Exception as e:
+            _in_ascolto.clear()
+            _invalida_tutto()
+            logger.warning("Ascolto %s interrotto, cache stato utenti disattivata: %s", CANALE, e)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(RICONNESSIONE_SECONDI)
+
+def _avvia_ascolto():
+    """Thread di ascolto avviato al primo utilizzo in ogni processo (quindi dopo il fork)"""
+    global _listener, _pid
+    with _lock:
+        if _pid == os.getpid() and _listener is not None and _listener.is_alive():
+            return
+        _in_ascolto.clear()
+        _stati.clear()
+        _listener = threading.Thread(target=_ascolta, name="stato-utenti", daemon=True)
+        _listener.start()
+        _pid = os.getpid()
+
+def in_ascolto():
+    """True se in questo processo l'ascolto delle notifiche è attivo (avviato al primo utilizzo)"""
+    if _pid != os.getpid():
+        _avvia_ascolto()
+    return _in_ascolto.is_set()
+
+# ----------------- API -----------------
+LEGGI_SQL = text("SELECT stato FROM utenti WHERE id = CAST(:id AS uuid)")
+
+def _leggi(user_id):
+    # connessione propria: il controllo avviene prima della route e non deve aprire
+    # la transazione della sessione di richiesta (es. route @read_only)
+    with models.engine.connect() as conn:
+        return conn.execute(LEGGI_SQL, {"id": user_id}).scalar()
+
+def stato_utente(user_id):
+    """Stato corrente dell'utente (None se non esiste più); dalla cache quando possibile"""
+    if not user_id:
+        return None
+    user_id = str(user_id)
+    stato, gen = da_cache(user_id)
+    if stato is None:
+        stato = _leggi(user_id)
+        memorizza(user_id, stato, gen)
+    return stato
+
+def da_cache(user_id):
+    """
+    (stato, generazione) dalla cache; stato None se va letto dal database, poi passato
+    a memorizza() con la stessa generazione (usate anche dalla modalità asincrona)
+    """
+    if not STATO_CACHE or not in_ascolto():
+        return None, None
+    with _lock:
+        stato = _stati.get(user_id)
+        if stato is not None:
+            _stats["hits"] += 1
+        return stato, _gen
+
+def memorizza(user_id, stato, gen):
+    with _lock:
+        _stats["misses"] += 1
+        if gen is not None and gen == _gen and _in_ascolto.is_set() and stato is not None:
+            if len(_stati) >= STATO_CACHE_MAX_ENTRIES:
+                _stati.pop(next(iter(_stati)))
+            _stati[user_id] = stato
+
+def invalida_stato(user_id=None):
+    """Toglie dalla cache un utente (o tutti). Chiamata dalle notifiche e dalle route admin."""
+    global _gen
+    with _lock:
+        _gen += 1
+        _stats["invalidations"] += 1
+        if user_id is None:
+            _stati.clear()
+        else:
+            _stati.pop(str(user_id), None)
+
+def stato_cache_stats():
+    with _lock:
+        stats = dict(_stats, entries=len(_stati))
+    stats["in_ascolto"] = _in_ascolto.is_set()
+    return stats
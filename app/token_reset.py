@@ -0,0 +1,85 @@
+import hashlib
+import logging
+import os
+import secrets
+import time
+from datetime import timedelta
+from sqlalchemy import text
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# ----------------- CONFIGURAZIONE -----------------
+TOKEN_RESET_DURATA = timedelta(hours=1)
+TOKEN_PULIZIA_SECONDI = int(os.environ.get("TOKEN_PULIZIA_SECONDI", "600"))  # ogni quanto il worker cancella i token scaduti
+TOKEN_PULIZIA_BLOCCO = int(os.environ.get("TOKEN_PULIZIA_BLOCCO", "1000"))   # righe per DELETE
+
+def hash_token(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+# ----------------- EMISSIONE E USO (WEB) -----------------
+SOSTITUISCI_SQL = text("DELETE FROM token_reset WHERE user_id = :uid")
+CREA_SQL = text("INSERT INTO token_reset (id, user_id, scadenza) VALUES (:id, :uid, now() + :durata)")
+CONTROLLA_SQL = text("SELECT user_id, scadenza > now() AS valido FROM token_reset WHERE id = :id")
+CONSUMA_SQL = text("DELETE FROM token_reset WHERE id = :id AND scadenza > now() RETURNING user_id")
+PULIZIA_SQL = text("""
+    DELETE FROM token_reset WHERE id IN (
+        SELECT id FROM token_reset WHERE scadenza < now() LIMIT :n
+    )
+""")
+
+def crea_token(user_id):
+    """
+    Genera un token per user_id nella transazione corrente e ne salva solo l'hash,
+    sostituendo quelli emessi in precedenza. Restituisce il token in chiaro (va nel link).
+    """
+    token = secrets.token_urlsafe(32)
+    models.db.execute(SOSTITUISCI_SQL, {"uid": user_id})
+    models.db.execute(CREA_SQL, {"id": hash_token(token), "uid": user_id, "durata": TOKEN_RESET_DURATA})
+    return token
+
+def controlla_token(token):
+    """
+    Per la pagina del form (GET), senza consumare il token: None se non esiste,
+    altrimenti la riga (user_id, valido) con valido = False se è scaduto.
+    """
+    return models.db.execute(CONTROLLA_SQL, {"id": hash_token(token)}).fetchone()
+
+def consuma_token(token):
+    """
+    Verifica e cancella il token con un solo statement (lettura per chiave primaria).
+    Restituisce lo user_id, None se il token non esiste, è già stato usato o è scaduto
+    (quelli scaduti restano alla pulizia del worker). Da chiamare nella transazione
+    che cambia la password: se questa fallisce il token torna valido.
+    """
+    return models.db.execute(CONSUMA_SQL, {"id": hash_token(token)}).scalar()
+
+# ----------------- PULIZIA (WORKER) -----------------
+def pulisci_scaduti(blocco=TOKEN_PULIZIA_BLOCCO):
+    """Cancella un blocco di token scaduti. Restituisce il numero di righe cancellate."""
+    cancellati = models.db.execute(PULIZIA_SQL, {"n": blocco}).rowcount
+    models.db.commit()
+    return cancellati
+
+def run_worker(should_stop=lambda: False):
+    """Ogni TOKEN_PULIZIA_SECONDI svuota i token scaduti a blocchi (una transazione breve per blocco)"""
+    ultima_pulizia = None
+    try:
+        while not should_stop():
+            if ultima_pulizia is None or time.monotonic() - ultima_pulizia >= TOKEN_PULIZIA_SECONDI:
+                ultima_pulizia = time.monotonic()
+                try:
+                    totale = 0
+                    while not should_stop():
+                        cancellati = pulisci_scaduti()
+                        totale += cancellati
+                        if cancellati < TOKEN_PULIZIA_BLOCCO:
+                            break
+                    if totale:
+                        logger.info("Token reset scaduti cancellati: %d", totale, extra={"cancellati": totale})
+                except Exception:
+                    models.db.rollback()
+                    logger.exception("Errore pulizia token reset")
+            time.sleep(1)  # attesa breve: l'arresto del worker non aspetta l'intervallo intero
+    finally:
+        models.db.remove()
@@ -0,0 +1,11 @@
+# Modalità di servizio asincrona (ASGI), alternativa a "gunicorn run:app" con worker sync:
+#
+#     pip install -r requirements-async.txt
+#     hypercorn asgi:app --workers 2 --bind 0.0.0.0:$PORT
+#
+# Stesse route dell'app Flask; POST /prenota/<id> gira su asyncio con asyncpg
+# (vedi app/asincrono.py). quart, hypercorn e asyncpg sono facoltativi e fissati
+# in requirements-async.txt, non in requirements.txt.
+from app.asincrono import create_asgi_app
+
+app = create_asgi_app()
@@ -0,0 +1,108 @@
+"""
+Memoria dell'export CSV/XLSX in streaming al crescere delle righe.
+
+    DATABASE_URL=postgresql://postgres@localhost/bjj_test python bench/export_bench.py --righe 100000
+
+Inserisce utenti sintetici (username "bench-export-*") e misura con tracemalloc il picco
+di memoria Python di /admin/export/utenti.csv (e .xlsx con --xlsx, richiede openpyxl)
+a 1/10 delle righe e a tutte le righe, confrontandolo con un export ingenuo che
+legge tutto con fetchall(). Con lo streaming il picco deve restare piatto.
+"""
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def semina(db, text, n, gia):
+    if n <= gia:
+        return
+    db.execute(
+        text("""
+            INSERT INTO utenti (nome, cognome, data_nascita, luogo_nascita, indirizzo, citta, comune, cap,
+                                email, telefono, username, password_hash, consenso_privacy, stato)
+            SELECT 'Nome' || g, 'Cognome' || g, DATE '1990-01-01' + (g % 9000), 'Città', 'Via Roma ' || g,
+                   'Città', 'Comune', '00100', 'bench-export-' || g || '@bench.local', '333' || g,
+                   'bench-export-' || g, '-', true, (ARRAY['attivo', 'pending', 'sospeso'])[1 + g % 3]
+            FROM generate_series(:da, :a) AS g
+        """),
+        {"da": gia + 1, "a": n}
+    )
+    db.commit()
+
+
+def misura(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    byte = fn()
+    durata = time.perf_counter() - start
+    _, picco = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return byte, durata, picco
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--righe", type=int, default=100_000)
+    parser.add_argument("--xlsx", action="store_true", help="misura anche l'export XLSX (lento sotto tracemalloc)")
+    parser.add_argument("--keep", action="store_true", help="non cancellare gli utenti creati")
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("DATABASE_URL non impostata")
+    os.environ["DATABASE_URL"] = args.url
+
+    from sqlalchemy import text
+    from app import create_app, models, migrate
+    from app.export import EXPORTS, xlsx_disponibile
+
+    app = create_app()
+    migrate.upgrade(models.engine)
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s["admin"] = True
+
+    def streaming(formato):
+        def esegui():
+            risposta = client.get(f"/admin/export/utenti.{formato}", buffered=False)
+            byte = sum(len(chunk) for chunk in risposta.response)
+            risposta.close()
+            return byte
+        return esegui
+
+    def ingenuo():
+        righe = models.db.execute(text(EXPORTS["utenti"][1])).fetchall()
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(righe)
+        models.db.rollback()
+        return len(buffer.getvalue().encode("utf-8"))
+
+    if args.xlsx and not xlsx_disponibile():
+        parser.error("--xlsx richiede openpyxl")
+    formati = ["csv"] + (["xlsx"] if args.xlsx else [])
+    casi = [("fetchall + CSV", ingenuo)] + [(f"streaming {f.upper()}", streaming(f)) for f in formati]
+
+    gia = models.db.execute(text("SELECT COUNT(*) FROM utenti WHERE username LIKE 'bench-export-%'")).scalar()
+    try:
+        print(f"{'righe':>8}  {'export':<16} {'MB file':>8} {'picco MB':>9} {'secondi':>8}")
+        for n in (args.righe // 10, args.righe):
+            semina(models.db, text, n, gia)
+            gia = max(gia, n)
+            totale = models.db.execute(text("SELECT COUNT(*) FROM utenti")).scalar()
+            models.db.rollback()
+            for nome, fn in casi:
+                byte, durata, picco = misura(fn)
+                print(f"{totale:>8}  {nome:<16} {byte / 1e6:8.1f} {picco / 1e6:9.1f} {durata:8.2f}")
+    finally:
+        if not args.keep:
+            models.db.execute(text("DELETE FROM utenti WHERE username LIKE 'bench-export-%'"))
+            models.db.commit()
+
+
+if __name__ == "__main__":
+    main()
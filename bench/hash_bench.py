@@ -0,0 +1,63 @@
+"""
+Micro-benchmark dell'hashing password: hash al secondo per core.
+
+    PASSWORD_HASH_METHOD=scrypt:32768:8:1 python bench/hash_bench.py --seconds 5
+
+Misura prima il calcolo in linea su un solo core, poi il pool di processi
+di app.hashing con HASH_WORKERS processi alimentati da più thread (come i
+thread di gunicorn durante un picco di login).
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import hashing  # noqa: E402
+
+
+def inline(seconds):
+    n = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        generate_password_hash("password-di-prova", hashing.PASSWORD_HASH_METHOD, hashing.PASSWORD_SALT_LENGTH)
+        n += 1
+    return n / seconds
+
+
+def pooled(seconds, threads):
+    hashing.hash_password("warm-up")  # avvia i processi del pool
+    end = time.perf_counter() + seconds
+
+    def loop():
+        n = 0
+        while time.perf_counter() < end:
+            hashing.hash_password("password-di-prova")
+            n += 1
+        return n
+
+    with ThreadPoolExecutor(threads) as ex:
+        total = sum(ex.map(lambda _: loop(), range(threads)))
+    return total / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--threads", type=int, default=max(hashing.HASH_WORKERS, 1) * 2)
+    args = parser.parse_args()
+
+    print(f"Metodo: {hashing.PASSWORD_HASH_METHOD}  core: {os.cpu_count()}  HASH_WORKERS: {hashing.HASH_WORKERS}")
+    single = inline(args.seconds)
+    print(f"In linea:  {single:8.1f} hash/s  (1 core)")
+    if hashing.HASH_WORKERS > 0:
+        total = pooled(args.seconds, args.threads)
+        print(f"Pool:      {total:8.1f} hash/s  ({total / hashing.HASH_WORKERS:.1f} hash/s per processo)")
+    hashing.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Costo del rate limit per richiesta (vedi app/limiti.py).
+
+    python bench/limiti_bench.py                                   # backend in memoria
+    DATABASE_URL=postgresql://postgres@localhost/bjj_test python bench/limiti_bench.py --backend postgres
+    REDIS_URL=redis://localhost:6379/0 python bench/limiti_bench.py --backend redis
+
+Misura il tempo per controllo (con --thread > 1 anche la contesa sul lock; il GIL
+serializza comunque i thread, quindi i tempi crescono con il loro numero) di:
+- consuma: un bucket (chiave già calcolata), il cuore del limitatore;
+- decoratore: la route decorata con @limita("login", identita=...) dentro un contesto
+  di richiesta POST (IP + username: due bucket) meno la stessa route senza decoratore.
+Le chiavi ruotano su --chiavi IP/utenti diversi; le regole sono alzate così che nessun
+controllo venga respinto (si misura il percorso "consentita", quello di ogni richiesta).
+Con il backend in memoria il costo deve restare nell'ordine dei microsecondi.
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def misura(fn, n, thread):
+    """Microsecondi per chiamata (mediana sui thread) di fn(i) ripetuta n volte per thread"""
+    tempi = []
+    barriera = threading.Barrier(thread)
+
+    def corri(t):
+        barriera.wait()
+        inizio = time.perf_counter()
+        for i in range(n):
+            fn(t * n + i)
+        tempi.append((time.perf_counter() - inizio) / n * 1e6)
+
+    threads = [threading.Thread(target=corri, args=(t,)) for t in range(thread)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return statistics.median(tempi)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["memory", "postgres", "redis"], default="memory")
+    parser.add_argument("--richieste", type=int, default=None, help="controlli per thread (default 100000, 2000 con backend condiviso)")
+    parser.add_argument("--thread", type=int, default=1)
+    parser.add_argument("--chiavi", type=int, default=10000, help="IP/utenti diversi")
+    args = parser.parse_args()
+    n = args.richieste or (100000 if args.backend == "memory" else 2000)
+
+    os.environ["RATE_LIMIT"] = "true"
+    os.environ["RATE_LIMIT_BACKEND"] = args.backend
+    os.environ["RATE_LIMIT_LOGIN_IP"] = os.environ["RATE_LIMIT_LOGIN_UTENTE"] = "1000000000/1"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    from flask import Flask
+    from app import limiti, models
+
+    if args.backend == "postgres":
+        from sqlalchemy.orm import scoped_session, sessionmaker
+        from app import migrate
+        from app.database import build_engine, database_url
+        models.engine = build_engine(database_url())
+        models.db = scoped_session(sessionmaker(bind=models.engine))
+        migrate.upgrade(models.engine)
+
+    regola = limiti.REGOLE["login_ip"]
+    chiavi = [limiti._chiave(regola, f"10.0.{i // 256 % 256}.{i % 256}") for i in range(args.chiavi)]
+    per_chiamata = misura(lambda i: limiti._consuma(chiavi[i % len(chiavi)], regola), n, args.thread)
+
+    app = Flask(__name__)
+
+    def route():
+        return "ok"
+    decorata = limiti.limita("login", identita=lambda: "utente")(route)
+    # contesti di richiesta creati prima della misura, separati per thread
+    # (lo stesso contesto non può essere attivo in due thread insieme)
+    per_thread = max(1, min(args.chiavi // args.thread, 250))
+    contesti = [[app.test_request_context("/user/login", method="POST",
+                                          environ_base={"REMOTE_ADDR": f"10.{t}.{i // 256 % 256}.{i % 256}"})
+                 for i in range(per_thread)] for t in range(args.thread)]
+
+    def chiama(fn):
+        def _chiama(i):
+            with contesti[i // n][i % per_thread]:
+                fn()
+        return _chiama
+    base = misura(chiama(route), n, args.thread)
+    con_limite = misura(chiama(decorata), n, args.thread)
+
+    print(f"backend={args.backend} thread={args.thread} chiavi={args.chiavi} controlli/thread={n}")
+    print(f"consuma (1 bucket)           {per_chiamata:8.2f} µs")
+    print(f"route senza limite           {base:8.2f} µs")
+    print(f"route con @limita (2 bucket) {con_limite:8.2f} µs  (+{con_limite - base:.2f} µs)")
+    if args.backend == "postgres":
+        from sqlalchemy import text
+        with models.engine.begin() as conn:
+            conn.execute(text("DELETE FROM rate_limit WHERE chiave LIKE 'login_%'"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,512 @@
+"""
+Benchmark delle route calde (home, dashboard, prenota) e della "corsa all'apertura" di una classe.
+
+    DATABASE_URL=postgresql://postgres@localhost/bjj_test python bench/load_bench.py
+    DATABASE_URL=... python bench/load_bench.py --mode gunicorn --workers 4 --concorrenza 32
+    DATABASE_URL=... python bench/load_bench.py --save-baseline            # salva bench/baseline.json
+    DATABASE_URL=... python bench/load_bench.py --compare                  # confronta con la baseline
+
+Al primo avvio popola il database (solo locale!) con dati sintetici: --classi lezioni
+attorno a oggi, --utenti iscritti attivi e --prenotazioni prenotazioni distribuite sulle
+lezioni. I dati restano per i run successivi; --pulisci li cancella ed esce.
+
+--mode inprocess guida l'app Flask con il test client da --concorrenza thread;
+--mode gunicorn avvia gunicorn (--workers processi) e la guida via HTTP.
+--mode asgi fa lo stesso con hypercorn e l'app ASGI (asgi.py, prenota su asyncio):
+confrontarla con gunicorn a parità di --workers e con --concorrenza alta, es.
+
+    DATABASE_URL=... python bench/load_bench.py --mode gunicorn --workers 1 --concorrenza 200 --scenari prenota,stampede
+    DATABASE_URL=... python bench/load_bench.py --mode asgi --workers 1 --concorrenza 200 --scenari prenota,stampede
+
+Con un database locale le query durano microsecondi e non c'è attesa da sovrapporre:
+--latenza-db 20 fa passare il server da un proxy che aggiunge 20 ms di round-trip,
+come un database remoto.
+Per ogni scenario riporta p50/p90/p99, richieste al secondo e query SQL per richiesta
+(lette dall'header Server-Timing, vedi app/metrics.py).
+
+Scenario "stampede": --stampede-utenti utenti prenotano nello stesso istante una classe
+nuova da --stampede-posti posti; alla fine le prenotazioni devono essere esattamente i posti
+e il contatore posti_prenotati deve coincidere.
+
+--compare esce con codice 1 se un p99 peggiora più di --tolleranza o aumentano le query
+per richiesta rispetto alla baseline. bench/baseline.json è registrata con i valori di default
+(--mode inprocess, Postgres locale) su una macchina di sviluppo: il blocco "meta" dice con
+quali parametri. I tempi valgono solo sulla stessa macchina: altrove va rigenerata con
+--save-baseline prima di usare --compare (le query per richiesta restano confrontabili).
+
+La colonna 503 conta le prenotazioni respinte dal controllo di ammissione (app/limiti.py,
+PRENOTA_MAX_CONCORRENTI): nello stampede sono attese, non sono errori.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TAG = "bench-load-"
+MARKER = date(1900, 1, 1)  # data esclusa fittizia che riconosce la serie del benchmark
+DATA_STAMPEDE = date(2099, 12, 31)  # classi create per lo stampede (cancellate subito dopo)
+BASELINE = os.path.join(ROOT, "bench", "baseline.json")
+
+
+# ----------------- DATI SINTETICI -----------------
+def semina(db, text, n_classi, n_utenti, n_prenotazioni):
+    """Crea i dati una volta sola: le lezioni appartengono a una serie "bench" per ritrovarle"""
+    if db.execute(text("SELECT 1 FROM utenti WHERE username LIKE :tag LIMIT 1"), {"tag": TAG + "%"}).first():
+        return False
+    start = time.perf_counter()
+    db.execute(
+        text("""
+            INSERT INTO utenti (nome, cognome, data_nascita, luogo_nascita, indirizzo, citta, comune, cap,
+                                email, telefono, username, password_hash, consenso_privacy, stato)
+            SELECT 'Nome' || g, 'Cognome' || g, DATE '1990-01-01' + (g % 9000), 'Città', 'Via Roma ' || g,
+                   'Città', 'Comune', '00100', :tag || g || '@bench.local', '333' || g, :tag || g, '-', true, 'attivo'
+            FROM generate_series(1, :n) AS g
+        """),
+        {"tag": TAG, "n": n_utenti}
+    )
+    # 6 lezioni al giorno, da un mese fa in avanti
+    serie_id = db.execute(
+        text("""
+            INSERT INTO serie (giorni, ora, data_inizio, data_fine, max_posti, escluse)
+            VALUES ('{0,1,2,3,4,5,6}', '07:00', CURRENT_DATE - 30, CURRENT_DATE - 30 + :n / 6, 30, CAST(:marker AS date[]))
+            RETURNING id
+        """),
+        {"n": n_classi, "marker": [MARKER]}
+    ).scalar()
+    db.execute(
+        text("""
+            INSERT INTO classi (data, ora, max_posti, serie_id)
+            SELECT CURRENT_DATE - 30 + g / 6, TIME '07:00' + make_interval(hours => 2 * (g % 6)), 30, :sid
+            FROM generate_series(0, :n - 1) AS g
+        """),
+        {"n": n_classi, "sid": serie_id}
+    )
+    # k prenotazioni per lezione su utenti diversi (indice utente pseudo-casuale ma deterministico)
+    per_classe = min(30, max(1, n_prenotazioni // n_classi))
+    db.execute(
+        text("""
+            WITH u AS (
+                SELECT id, row_number() OVER (ORDER BY id) - 1 AS i FROM utenti WHERE username LIKE :tag
+            ), c AS (
+                SELECT id, row_number() OVER (ORDER BY id) AS n FROM classi WHERE serie_id = :sid
+            )
+            INSERT INTO prenotazioni (user_id, classe_id)
+            SELECT u.id, c.id
+            FROM c CROSS JOIN generate_series(1, :k) AS j
+            JOIN u ON u.i = (c.n * 7919 + j * 104729) % :nu
+            ON CONFLICT DO NOTHING
+        """),
+        {"tag": TAG + "%", "k": per_classe, "nu": n_utenti, "sid": serie_id}
+    )
+    db.execute(text("""
+        UPDATE classi c SET posti_prenotati = (SELECT COUNT(*) FROM prenotazioni p WHERE p.classe_id = c.id)
+        WHERE c.serie_id = :sid
+    """), {"sid": serie_id})
+    db.execute(text("ANALYZE"))
+    db.commit()
+    print(f"Dati creati in {time.perf_counter() - start:.1f} s")
+    return True
+
+
+def pulisci(db, text):
+    db.execute(text("DELETE FROM utenti WHERE username LIKE :tag"), {"tag": TAG + "%"})
+    db.execute(text("DELETE FROM classi WHERE serie_id IN (SELECT id FROM serie WHERE :marker = ANY(escluse))"),
+               {"marker": MARKER})
+    db.execute(text("DELETE FROM serie WHERE :marker = ANY(escluse)"), {"marker": MARKER})
+    db.execute(text("DELETE FROM classi WHERE data = :data"), {"data": DATA_STAMPEDE})
+    db.commit()
+
+
+# ----------------- CLIENT -----------------
+def cookie_sessione(app, dati):
+    """
+    Cookie di una sessione già autenticata: creata nello store lato server (vedi app/sessioni.py)
+    o, con SESSION_BACKEND=cookie, firmata con la SECRET_KEY dell'app (la stessa dei worker gunicorn)
+    """
+    crea = getattr(app.session_interface, "crea_sessione", None)
+    valore = crea(app, dati) if crea else app.session_interface.get_signing_serializer(app).dumps(dati)
+    return f"{app.config['SESSION_COOKIE_NAME']}={valore}"
+
+
+def query_da_server_timing(header):
+    # db;dur=1.2;desc="3 query"
+    for parte in (header or "").split(","):
+        if 'desc="' in parte:
+            return int(parte.split('desc="')[1].split()[0])
+    return None
+
+
+class ClientInProcess:
+    def __init__(self, app):
+        self.client = app.test_client(use_cookies=False)
+
+    def richiesta(self, metodo, path, cookie):
+        r = self.client.open(path, method=metodo, headers={"Cookie": cookie})
+        r.close()
+        return r.status_code, r.headers.get("Server-Timing")
+
+
+class ClientHTTP:
+    def __init__(self, porta):
+        self.porta = porta
+
+    def richiesta(self, metodo, path, cookie):
+        # i worker sync di gunicorn chiudono la connessione a ogni risposta
+        conn = http.client.HTTPConnection("127.0.0.1", self.porta, timeout=60)
+        try:
+            conn.request(metodo, path, headers={"Cookie": cookie, "Content-Length": "0"})
+            r = conn.getresponse()
+            r.read()
+            return r.status, r.getheader("Server-Timing")
+        finally:
+            conn.close()
+
+
+def avvia_proxy_latenza(url, ritardo):
+    """
+    Proxy TCP locale verso il database che consegna ogni pacchetto dopo `ritardo` secondi
+    (per verso): simula un database remoto come Supabase. Restituisce l'URL da usare.
+    """
+    import asyncio
+    from sqlalchemy.engine import make_url
+
+    originale = make_url(url)
+    socket_dir = originale.query.get("host")  # connessione unix socket (?host=/percorso)
+    pronto = threading.Event()
+    porta = []
+
+    async def inoltra(lettore, scrittore):
+        loop = asyncio.get_running_loop()
+        while True:
+            dati = await lettore.read(65536)
+            if not dati:
+                loop.call_later(ritardo, scrittore.close)
+                return
+            # stesso ritardo per tutti i pacchetti: l'ordine resta quello di arrivo
+            loop.call_later(ritardo, scrittore.write, dati)
+
+    async def connessione(lettore_client, scrittore_client):
+        if socket_dir:
+            lettore_db, scrittore_db = await asyncio.open_unix_connection(
+                f"{socket_dir}/.s.PGSQL.{originale.port or 5432}")
+        else:
+            lettore_db, scrittore_db = await asyncio.open_connection(originale.host, originale.port or 5432)
+        await asyncio.gather(inoltra(lettore_client, scrittore_db), inoltra(lettore_db, scrittore_client))
+
+    async def servi():
+        server = await asyncio.start_server(connessione, "127.0.0.1", 0)
+        porta.append(server.sockets[0].getsockname()[1])
+        pronto.set()
+        await server.serve_forever()
+
+    threading.Thread(target=lambda: asyncio.run(servi()), daemon=True).start()
+    pronto.wait(5)
+    proxy = originale.set(host="127.0.0.1", port=porta[0]).difference_update_query(["host"])
+    return proxy.render_as_string(hide_password=False)
+
+
+def avvia_server(mode, workers, porta, database_url=None):
+    """gunicorn con worker sync (run:app) oppure hypercorn con l'app ASGI (asgi:app)"""
+    env = dict(os.environ, LOG_LEVEL="WARNING")
+    if database_url:
+        env["DATABASE_URL"] = database_url
+    if mode == "asgi":
+        comando = ["hypercorn", "asgi:app", "--workers", str(workers), "--bind", f"127.0.0.1:{porta}",
+                   "--backlog", "2048"]
+    else:
+        comando = ["gunicorn", "run:app", "-w", str(workers), "-b", f"127.0.0.1:{porta}"]
+    proc = subprocess.Popen([sys.executable, "-m", *comando], cwd=ROOT, env=env)
+    scadenza = time.monotonic() + 30
+    while time.monotonic() < scadenza:
+        try:
+            socket.create_connection(("127.0.0.1", porta), timeout=0.2).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{comando[0]} non si è avviato")
+
+
+# ----------------- ESECUZIONE -----------------
+def _esito(esiti, status):
+    # 503 = scartata dal controllo di ammissione (app/limiti.py): carico respinto, non un guasto
+    if status == 503:
+        esiti["scartate"] += 1
+    elif status >= 500:
+        esiti["errori"] += 1
+
+
+def esegui(nuovo_client, richieste, concorrenza):
+    """richieste: lista di (metodo, path, cookie). Restituisce latenze, query, esiti e durata."""
+    latenze, query, esiti = [], [], Counter()
+    lock = threading.Lock()
+    indice = iter(range(len(richieste)))
+
+    def lavora():
+        client = nuovo_client()
+        mie_latenze, mie_query, miei_esiti = [], [], Counter()
+        while True:
+            with lock:
+                i = next(indice, None)
+            if i is None:
+                break
+            metodo, path, cookie = richieste[i]
+            start = time.perf_counter()
+            try:
+                status, timing = client.richiesta(metodo, path, cookie)
+            except Exception:
+                miei_esiti["eccezioni"] += 1
+                continue
+            mie_latenze.append(time.perf_counter() - start)
+            _esito(miei_esiti, status)
+            q = query_da_server_timing(timing)
+            if q is not None:
+                mie_query.append(q)
+        with lock:
+            latenze.extend(mie_latenze)
+            query.extend(mie_query)
+            esiti.update(miei_esiti)
+
+    threads = [threading.Thread(target=lavora) for _ in range(concorrenza)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latenze, query, esiti, time.perf_counter() - start
+
+
+def stampede(nuovo_client, cookie_utente, user_ids, classe_id):
+    """Tutti i thread partono insieme (Barrier) con una sola prenotazione ciascuno"""
+    latenze, query, esiti = [], [], Counter()
+    lock = threading.Lock()
+    barriera = threading.Barrier(len(user_ids))
+
+    def lavora(uid):
+        client = nuovo_client()
+        cookie = cookie_utente(uid)
+        barriera.wait()
+        start = time.perf_counter()
+        try:
+            status, timing = client.richiesta("POST", f"/prenota/{classe_id}", cookie)
+        except Exception:
+            with lock:
+                esiti["eccezioni"] += 1
+            return
+        durata = time.perf_counter() - start
+        with lock:
+            latenze.append(durata)
+            q = query_da_server_timing(timing)
+            if q is not None:
+                query.append(q)
+            _esito(esiti, status)
+
+    threads = [threading.Thread(target=lavora, args=(u,)) for u in user_ids]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latenze, query, esiti, time.perf_counter() - start
+
+
+def percentile(valori, p):
+    if not valori:
+        return 0.0
+    valori = sorted(valori)
+    return valori[min(len(valori) - 1, int(round(p / 100 * (len(valori) - 1))))]
+
+
+def riepilogo(latenze, query, esiti, durata):
+    return {
+        "richieste": len(latenze) + esiti["eccezioni"],
+        "errori": esiti["errori"] + esiti["eccezioni"],
+        "scartate": esiti["scartate"],
+        "rps": round(len(latenze) / durata, 1) if durata else 0.0,
+        "p50_ms": round(percentile(latenze, 50) * 1000, 2),
+        "p90_ms": round(percentile(latenze, 90) * 1000, 2),
+        "p99_ms": round(percentile(latenze, 99) * 1000, 2),
+        "query_medie": round(statistics.mean(query), 2) if query else None,
+        "query_max": max(query) if query else None,
+    }
+
+
+def stampa(risultati):
+    print(f"{'scenario':<12} {'richieste':>9} {'errori':>6} {'503':>5} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'query':>6}")
+    for nome, r in risultati.items():
+        q = "-" if r["query_medie"] is None else f"{r['query_medie']:g}"
+        print(f"{nome:<12} {r['richieste']:>9} {r['errori']:>6} {r['scartate']:>5} {r['rps']:>8} {r['p50_ms']:>8} {r['p90_ms']:>8} {r['p99_ms']:>8} {q:>6}")
+
+
+def confronta(risultati, baseline, tolleranza, meta):
+    """Stampa le differenze e restituisce il numero di regressioni"""
+    regressioni = 0
+    print(f"\nConfronto con la baseline ({baseline['meta']}):")
+    if baseline["meta"] != meta:
+        print("   ⚠️ parametri diversi dal run attuale: il confronto è solo indicativo")
+    for nome, r in risultati.items():
+        base = baseline["scenari"].get(nome)
+        if not base:
+            continue
+        delta = (r["p99_ms"] - base["p99_ms"]) / base["p99_ms"] if base["p99_ms"] else 0.0
+        note = []
+        if delta > tolleranza:
+            note.append("p99 peggiorato")
+        # mezza query in più in media = almeno una query aggiunta su molte richieste (es. un N+1)
+        if r["query_medie"] is not None and base["query_medie"] is not None and r["query_medie"] > base["query_medie"] + 0.5:
+            note.append(f"query {base['query_medie']:g} -> {r['query_medie']:g}")
+        regressioni += bool(note)
+        print(f"   {nome:<12} p99 {base['p99_ms']:>8} -> {r['p99_ms']:>8} ms ({delta:+.0%})  "
+              f"req/s {base['rps']} -> {r['rps']}  {'❌ ' + ', '.join(note) if note else '✅'}")
+    return regressioni
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--mode", choices=["inprocess", "gunicorn", "asgi"], default="inprocess")
+    parser.add_argument("--workers", type=int, default=2, help="worker gunicorn")
+    parser.add_argument("--porta", type=int, default=8765)
+    parser.add_argument("--latenza-db", type=float, default=0, metavar="MS",
+                        help="round-trip aggiunto tra server e database (solo gunicorn/asgi), es. 20 come Supabase")
+    parser.add_argument("--concorrenza", type=int, default=16)
+    parser.add_argument("--richieste", type=int, default=500, help="richieste per scenario")
+    parser.add_argument("--riscaldamento", type=int, default=50, help="richieste iniziali non misurate (cache, connessioni)")
+    parser.add_argument("--scenari", default="home,dashboard,prenota,stampede")
+    parser.add_argument("--classi", type=int, default=3000)
+    parser.add_argument("--utenti", type=int, default=20000)
+    parser.add_argument("--prenotazioni", type=int, default=60000)
+    parser.add_argument("--stampede-utenti", type=int, default=200)
+    parser.add_argument("--stampede-posti", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save-baseline", nargs="?", const=BASELINE, metavar="FILE")
+    parser.add_argument("--compare", nargs="?", const=BASELINE, metavar="FILE")
+    parser.add_argument("--tolleranza", type=float, default=0.2, help="peggioramento p99 ammesso con --compare")
+    parser.add_argument("--pulisci", action="store_true", help="cancella i dati del benchmark ed esce")
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("DATABASE_URL non impostata")
+    if args.latenza_db and args.mode == "inprocess":
+        parser.error("--latenza-db richiede --mode gunicorn o asgi")
+    os.environ["DATABASE_URL"] = args.url
+    os.environ.setdefault("SECRET_KEY", "bench-secret")  # la stessa per il processo e per gunicorn
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # tutte le richieste arrivano da 127.0.0.1: il rate limit per IP misurerebbe solo i 429
+    # (il suo costo si misura a parte con bench/limiti_bench.py)
+    os.environ.setdefault("RATE_LIMIT", "false")
+
+    from sqlalchemy import text
+    from app import create_app, models, migrate
+
+    app = create_app()
+    migrate.upgrade(models.engine)
+    db = models.db
+    if args.pulisci:
+        pulisci(db, text)
+        print("Dati del benchmark cancellati")
+        return
+    semina(db, text, args.classi, args.utenti, args.prenotazioni)
+
+    user_ids = [str(u) for u in db.execute(
+        text("SELECT id FROM utenti WHERE username LIKE :tag ORDER BY id"), {"tag": TAG + "%"}
+    ).scalars()]
+    classi_future = db.execute(
+        text("SELECT id FROM classi WHERE data >= CURRENT_DATE AND serie_id IS NOT NULL ORDER BY id")
+    ).scalars().all()
+    db.rollback()
+
+    cookie_utenti = {}
+
+    def cookie_utente(uid):
+        if uid not in cookie_utenti:
+            cookie_utenti[uid] = cookie_sessione(app, {"user_id": uid, "username": uid})
+        return cookie_utenti[uid]
+    cookie_admin = cookie_sessione(app, {"admin": True})
+
+    proc = None
+    if args.mode in ("gunicorn", "asgi"):
+        url_server = avvia_proxy_latenza(args.url, args.latenza_db / 2000) if args.latenza_db else None
+        proc = avvia_server(args.mode, args.workers, args.porta, url_server)
+        nuovo_client = lambda: ClientHTTP(args.porta)  # noqa: E731
+    else:
+        nuovo_client = lambda: ClientInProcess(app)  # noqa: E731
+
+    rnd = random.Random(args.seed)
+    scenari = args.scenari.split(",")
+    risultati = {}
+    try:
+        for nome in scenari:
+            if nome == "home":
+                richieste = [("GET", "/user/", cookie_utente(rnd.choice(user_ids))) for _ in range(args.richieste)]
+            elif nome == "dashboard":
+                richieste = [("GET", "/admin/", cookie_admin)] * args.richieste
+            elif nome == "prenota":
+                richieste = [("POST", f"/prenota/{rnd.choice(classi_future)}", cookie_utente(rnd.choice(user_ids)))
+                             for _ in range(args.richieste)]
+            elif nome == "stampede":
+                classe_id = db.execute(
+                    text("INSERT INTO classi (data, ora, max_posti) VALUES (:data, '19:00', :p) RETURNING id"),
+                    {"data": DATA_STAMPEDE, "p": args.stampede_posti}
+                ).scalar()
+                db.commit()
+                esito = stampede(nuovo_client, cookie_utente, rnd.sample(user_ids, args.stampede_utenti), classe_id)
+                risultati[nome] = riepilogo(*esito)
+                righe, contatore = db.execute(
+                    text("""
+                        SELECT (SELECT COUNT(*) FROM prenotazioni WHERE classe_id = :cid), posti_prenotati
+                        FROM classi WHERE id = :cid
+                    """),
+                    {"cid": classe_id}
+                ).one()
+                db.execute(text("DELETE FROM classi WHERE id = :cid"), {"cid": classe_id})
+                db.commit()
+                atteso = min(args.stampede_posti, args.stampede_utenti - risultati[nome]["scartate"])
+                ok = righe == atteso and contatore == righe
+                print(f"Stampede: {righe} prenotazioni su {args.stampede_posti} posti, contatore {contatore} "
+                      f"{'✅' if ok else '❌ INCOERENTE'}")
+                if not ok:
+                    risultati[nome]["errori"] += 1
+                continue
+            else:
+                parser.error(f"scenario sconosciuto: {nome}")
+            esegui(nuovo_client, richieste[:args.riscaldamento], args.concorrenza)
+            risultati[nome] = riepilogo(*esegui(nuovo_client, richieste, args.concorrenza))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(10)
+
+    meta = f"mode={args.mode} workers={args.workers if args.mode != 'inprocess' else '-'} concorrenza={args.concorrenza} " \
+           f"classi={args.classi} utenti={args.utenti} prenotazioni={args.prenotazioni}"
+    if args.latenza_db:
+        meta += f" latenza_db={args.latenza_db:g}ms"
+    print(meta)
+    stampa(risultati)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"meta": meta, "scenari": risultati}, f, indent=2)
+        print(f"Baseline salvata in {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if confronta(risultati, baseline, args.tolleranza, meta):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Tempo di avvio di un worker: import dell'app e create_app, in processi Python nuovi.
+
+    DATABASE_URL=postgresql://postgres@localhost/bjj_test python bench/startup_bench.py --runs 10
+    python bench/startup_bench.py --runs 10 --json > startup.json   # da confrontare nel tempo
+    python bench/startup_bench.py --importtime 15                    # moduli più lenti da importare
+
+Ogni run avvia un interprete pulito (come un worker gunicorn senza --preload)
+e riporta le fasi registrate in app.STARTUP_TIMINGS più il tempo totale misurato
+da fuori. Nessuna connessione al database viene aperta durante l'avvio.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPET = """
+import json, time
+t0 = time.perf_counter()
+import app
+a = app.create_app()
+totale = time.perf_counter() - t0
+print(json.dumps(dict(app.STARTUP_TIMINGS, **{"create_app + import": totale})))
+"""
+
+
+def un_avvio(env):
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", SNIPPET], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    fasi = json.loads(out.strip().splitlines()[-1])
+    fasi["processo"] = time.perf_counter() - start
+    return fasi
+
+
+def import_lenti(env, top):
+    """Moduli con il tempo di import cumulativo più alto (python -X importtime)"""
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app; app.create_app()"],
+                         cwd=ROOT, env=env, capture_output=True, text=True, check=True).stderr
+    moduli = []
+    for riga in err.splitlines():
+        if not riga.startswith("import time:") or "cumulative" in riga:
+            continue
+        _, cumulativo, nome = riga[len("import time:"):].split("|")
+        livello = (len(nome) - len(nome.lstrip()) - 1) // 2  # i figli sono indentati di 2 spazi
+        if livello <= 1:  # app e i suoi import diretti (flask, sqlalchemy.orm, ...)
+            moduli.append((int(cumulativo), "  " * livello + nome.strip()))
+    return sorted(moduli, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="stampa le mediane in JSON")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N", help="mostra gli N import più lenti")
+    args = parser.parse_args()
+
+    env = dict(os.environ, STARTUP_REPORT="false", AUTO_MIGRATE="false", LOG_LEVEL="WARNING")
+    env.setdefault("DATABASE_URL", "postgresql://bench@localhost/bench")
+
+    if args.importtime:
+        for micro, nome in import_lenti(env, args.importtime):
+            print(f"{micro / 1000:8.1f} ms  {nome}")
+        return
+
+    un_avvio(env)  # riscalda la cache dei .pyc
+    runs = [un_avvio(env) for _ in range(args.runs)]
+    mediane = {fase: statistics.median(r[fase] for r in runs) for fase in runs[0]}
+
+    if args.json:
+        print(json.dumps({fase: round(sec * 1000, 2) for fase, sec in mediane.items()}, indent=2))
+        return
+    print(f"Avvio worker, {args.runs} run (mediana / minimo):")
+    for fase, med in mediane.items():
+        minimo = min(r[fase] for r in runs)
+        print(f"   {fase:<20} {med * 1000:8.1f} ms  {minimo * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Stress test di concorrenza per prenota_classe contro un Postgres locale.
+
+    DATABASE_URL=postgresql://postgres@localhost/bjj_test python bench/stress_prenota.py --posti 20 --utenti 300
+    DATABASE_URL=... python bench/stress_prenota.py --scenario annulla --posti 1 --utenti 100
+
+Scenario "prenota": molti thread prenotano la stessa classe nello stesso istante
+(ogni utente invia la richiesta due volte, come un doppio click).
+Scenario "annulla": la classe parte piena; chi ha il posto lo annulla e riprova
+subito a prenotarlo, mentre tutti gli altri cercano di prenderlo (con --posti 1
+è la corsa sull'ultimo posto). Un thread controlla di continuo che le righe non
+superino max_posti.
+
+In entrambi i casi alla fine la classe non deve superare max_posti e il contatore
+posti_prenotati deve coincidere con le righe di prenotazioni.
+"""
+import argparse
+import os
+import sys
+import threading
+import uuid
+from collections import Counter
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import models, migrate  # noqa: E402
+from app.booking import prenota_classe, annulla_prenotazione, PRENOTATA  # noqa: E402
+
+
+def crea_dati(posti, n_utenti):
+    tag = uuid.uuid4().hex[:8]
+    classe_id = models.db.execute(
+        text("INSERT INTO classi (data, ora, max_posti) VALUES (CURRENT_DATE + 1, '19:00', :posti) RETURNING id"),
+        {"posti": posti}
+    ).scalar()
+    user_ids = models.db.execute(
+        text("""
+            INSERT INTO utenti (nome, cognome, data_nascita, luogo_nascita, indirizzo, citta, comune, cap,
+                                email, username, password_hash, consenso_privacy, stato)
+            SELECT 'Stress', 'Test', '2000-01-01', '-', '-', '-', '-', '00000',
+                   :tag || '-' || g || '@stress.local', :tag || '-' || g, '-', true, 'attivo'
+            FROM generate_series(1, :n) AS g
+            RETURNING id
+        """),
+        {"tag": tag, "n": n_utenti}
+    ).scalars().all()
+    models.db.commit()
+    return classe_id, user_ids
+
+
+def pulisci(classe_id, user_ids):
+    models.db.execute(text("DELETE FROM classi WHERE id = :cid"), {"cid": classe_id})
+    models.db.execute(text("DELETE FROM utenti WHERE id = ANY(CAST(:ids AS uuid[]))"), {"ids": [str(u) for u in user_ids]})
+    models.db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--posti", type=int, default=20)
+    parser.add_argument("--utenti", type=int, default=200)
+    parser.add_argument("--connessioni", type=int, default=50, help="dimensione del pool (< max_connections)")
+    parser.add_argument("--keep", action="store_true", help="non cancellare i dati creati")
+    parser.add_argument("--scenario", choices=["prenota", "annulla"], default="prenota")
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("DATABASE_URL non impostata")
+
+    engine = create_engine(args.url, pool_size=args.connessioni, max_overflow=0, pool_timeout=120)
+    models.db = scoped_session(sessionmaker(bind=engine))
+    migrate.upgrade(engine)
+
+    classe_id, user_ids = crea_dati(args.posti, args.utenti)
+    esiti = Counter()
+    lock = threading.Lock()
+
+    def esegui(operazione, uid):
+        try:
+            with models.unit_of_work():
+                esito = operazione(classe_id, uid)
+        finally:
+            models.db.remove()
+        with lock:
+            esiti[f"{operazione.__name__}:{esito}"] += 1
+        return esito
+
+    if args.scenario == "prenota":
+        richieste = [uid for uid in user_ids for _ in range(2)]
+        barrier = threading.Barrier(len(richieste))
+
+        def worker(uid):
+            barrier.wait()
+            esegui(prenota_classe, uid)
+    else:
+        # classe piena prima di partire
+        titolari = user_ids[:args.posti]
+        for uid in titolari:
+            esegui(prenota_classe, uid)
+        esiti.clear()
+        richieste = user_ids
+        barrier = threading.Barrier(len(richieste))
+
+        def worker(uid):
+            barrier.wait()
+            if uid in titolari:
+                esegui(annulla_prenotazione, uid)
+            esegui(prenota_classe, uid)
+
+    # controllo continuo della capienza mentre i worker girano
+    sforamenti = []
+    fine = threading.Event()
+
+    def monitor():
+        try:
+            while not fine.is_set():
+                righe, max_posti = models.db.execute(
+                    text("SELECT (SELECT COUNT(*) FROM prenotazioni WHERE classe_id = :cid), max_posti FROM classi WHERE id = :cid"),
+                    {"cid": classe_id}
+                ).fetchone()
+                models.db.rollback()
+                if righe > max_posti:
+                    sforamenti.append(righe)
+        finally:
+            models.db.remove()
+
+    osservatore = threading.Thread(target=monitor)
+    osservatore.start()
+    threads = [threading.Thread(target=worker, args=(uid,)) for uid in richieste]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    fine.set()
+    osservatore.join()
+
+    righe, contatore, max_posti = models.db.execute(
+        text("""
+            SELECT (SELECT COUNT(*) FROM prenotazioni WHERE classe_id = :cid), posti_prenotati, max_posti
+            FROM classi WHERE id = :cid
+        """),
+        {"cid": classe_id}
+    ).fetchone()
+    models.db.rollback()
+
+    print(f"Richieste: {len(richieste)}  esiti: {dict(esiti)}")
+    print(f"Prenotazioni: {righe}  contatore: {contatore}  max_posti: {max_posti}")
+
+    if args.scenario == "prenota":
+        attese = esiti[f"prenota_classe:{PRENOTATA}"]
+    else:
+        # ogni posto liberato viene ripreso da qualcuno
+        attese = min(max_posti, len(user_ids))
+    ok = not sforamenti and righe == contatore == attese == min(max_posti, len(user_ids))
+    if sforamenti:
+        print(f"Sforamenti osservati durante il test: {sforamenti[:10]}")
+    if not args.keep:
+        pulisci(classe_id, user_ids)
+    print("✅ OK" if ok else "❌ Overbooking o contatore incoerente")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
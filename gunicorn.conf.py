@@ -0,0 +1,19 @@
+# Configurazione gunicorn (caricata automaticamente da "gunicorn run:app")
+import os
+
+# GUNICORN_PRELOAD=true (o "gunicorn --preload") -> l'app viene importata una volta nel master
+# e i worker nascono con fork già pronti: avvio e scale-out più rapidi.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() == "true"
+
+
+def post_fork(server, worker):
+    # con il preload l'engine è stato creato nel master: il figlio non deve riusare
+    # connessioni aperte dal padre (close=False le lascia al processo che le possiede)
+    from app import models, log, hashing
+    if models.engine is not None:
+        models.engine.dispose(close=False)
+    # il thread del listener dei log non sopravvive al fork: ogni worker crea il suo
+    log.configura_logging()
+    # pool di hashing in base a worker e thread effettivi (spento con i worker sync)
+    hashing.configura_pool(server.cfg.workers, server.cfg.threads)
+
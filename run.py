@@ -1,13 +1,17 @@
+import logging
 import os
 from app import create_app
 
 app = create_app()
+debug_mode = os.environ.get("_DEBUG", "False").lower() == "true"
+logger = logging.getLogger("run")
 
-print("✅ App Flask creata!")
-for rule in app.url_map.iter_rules():
-    print(f"Route: {rule} -> endpoint: {rule.endpoint}")
+logger.debug("App Flask creata")
+# elenco route solo in debug: stamparlo a ogni avvio dei worker gunicorn rallenta il boot
+if debug_mode:
+    for rule in app.url_map.iter_rules():
+        logger.debug("Route: %s -> endpoint: %s", rule, rule.endpoint)
 
 if __name__ == "__main__":
-    debug_mode = os.environ.get("_DEBUG", "False").lower() == "true"
-    print(f"🚀 Avvio server Flask (debug={debug_mode})")
+    logger.info("Avvio server Flask (debug=%s)", debug_mode)
     app.run(debug=debug_mode)
@@ -0,0 +1,51 @@
+import logging
+import signal
+import sys
+import threading
+from sqlalchemy.orm import scoped_session, sessionmaker
+from app.database import build_engine, database_url
+from app import models
+from app import outbox, auth_sync, token_reset, log
+
+# Worker in background, processo separato dal web (vedi Procfile):
+#   python worker.py              -> outbox email + allineamento Supabase Auth + pulizia token
+#   python worker.py outbox       -> solo consegna email
+#   python worker.py auth_sync    -> solo allineamento Supabase Auth
+#   python worker.py token_reset  -> solo pulizia dei token di reset scaduti
+LOOPS = {
+    "outbox": outbox.run_worker,
+    "auth_sync": auth_sync.run_worker,
+    "token_reset": token_reset.run_worker,
+}
+
+stop = threading.Event()
+logger = logging.getLogger("worker")
+
+def _handle_stop(signum, frame):
+    logger.info("Arresto worker richiesto, chiusura dopo il blocco corrente")
+    stop.set()
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _handle_stop)
+    signal.signal(signal.SIGINT, _handle_stop)
+
+    nomi = sys.argv[1:] or list(LOOPS)
+    for nome in nomi:
+        if nome not in LOOPS:
+            sys.exit(f"Worker sconosciuto: {nome} (disponibili: {', '.join(LOOPS)})")
+
+    log.configura_logging()
+    models.engine = build_engine(database_url())
+    # scoped_session: ogni thread di worker ha la sua sessione
+    models.db = scoped_session(sessionmaker(bind=models.engine))
+
+    threads = [
+        threading.Thread(target=LOOPS[nome], kwargs={"should_stop": stop.is_set}, name=nome)
+        for nome in nomi
+    ]
+    for t in threads:
+        t.start()
+    logger.info("Worker avviato: %s", ", ".join(nomi))
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(0.5)